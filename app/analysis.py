@@ -0,0 +1,172 @@
+# app/analysis.py
+"""
+Text analysis shared by indexing, the bulk builder and query parsing.
+
+An Analyzer turns text into a lazy stream of terms:
+
+    normalize   lowercase, or NFKC then lowercase ("nfkc")
+    tokenize    runs of word characters, as the original tokenizer split them
+    filter      drop terms shorter than min_length or longer than max_length
+    stopwords   drop the terms of a stopword list
+    stem        reduce terms to a stem, memoized in an LRU cache
+
+Positions count the terms that survive the filters, so a phrase query with a
+stopword in it matches the same phrase in a document. The default
+configuration only lowercases and tokenizes, which is what the index has
+always done; the other stages are chosen with INDEX_ANALYZER_* variables.
+
+Indexes record the configuration of the analyzer that built them, because
+queries have to be analyzed the same way as the documents they search.
+"""
+
+import functools
+import itertools
+import logging
+import os
+import re
+import unicodedata
+
+logger = logging.getLogger(__name__)
+
+TOKEN_PATTERN = re.compile(r"\b\w+\b")
+
+# Lucene's English stopword set
+ENGLISH_STOPWORDS = frozenset(
+    "a an and are as at be but by for if in into is it no not of on or such "
+    "that the their then there these they this to was will with".split()
+)
+
+STOPWORD_LISTS = {"none": frozenset(), "english": ENGLISH_STOPWORDS}
+
+# Distinct terms whose stems are remembered per analyzer
+STEM_CACHE_SIZE = int(os.getenv("INDEX_STEM_CACHE_SIZE", "100000"))
+
+
+def s_stem(term: str) -> str:
+    """Harman's S stemmer: conflate English plurals with their singular."""
+    if term.endswith("ies") and not term.endswith(("eies", "aies")):
+        return term[:-3] + "y"
+    if term.endswith("es") and not term.endswith(("aes", "ees", "oes")):
+        return term[:-1]
+    if term.endswith("s") and not term.endswith(("us", "ss")):
+        return term[:-1]
+    return term
+
+
+STEMMERS = {"none": None, "s": s_stem}
+
+
+class Analyzer:
+    """A configured analysis pipeline; see the module docstring."""
+
+    def __init__(
+        self,
+        normalization: str = "lowercase",
+        stopwords: str = "none",
+        stemmer: str = "none",
+        min_length: int = 1,
+        max_length: int = 0,
+        stem_cache_size: int = STEM_CACHE_SIZE,
+    ):
+        if normalization not in ("lowercase", "nfkc"):
+            raise ValueError(f"Unknown normalization '{normalization}'")
+        if stopwords not in STOPWORD_LISTS:
+            raise ValueError(f"Unknown stopword list '{stopwords}'")
+        if stemmer not in STEMMERS:
+            raise ValueError(f"Unknown stemmer '{stemmer}'")
+        self.config = {
+            "normalization": normalization,
+            "stopwords": stopwords,
+            "stemmer": stemmer,
+            "min_length": min_length,
+            "max_length": max_length,
+        }
+        self._stopwords = STOPWORD_LISTS[stopwords]
+        self._stem = None
+        if STEMMERS[stemmer] is not None:
+            self._stem = functools.lru_cache(maxsize=stem_cache_size)(STEMMERS[stemmer])
+
+        self._stages = []
+        if min_length > 1 or max_length > 0:
+            self._stages.append(self._filter_length)
+        if self._stopwords:
+            self._stages.append(self._filter_stopwords)
+        if self._stem is not None:
+            self._stages.append(self._stem_terms)
+
+    @classmethod
+    def from_env(cls) -> "Analyzer":
+        return cls(
+            normalization=os.getenv("INDEX_ANALYZER_NORMALIZATION", "lowercase"),
+            stopwords=os.getenv("INDEX_ANALYZER_STOPWORDS", "none"),
+            stemmer=os.getenv("INDEX_ANALYZER_STEMMER", "none"),
+            min_length=int(os.getenv("INDEX_ANALYZER_MIN_LENGTH", "1")),
+            max_length=int(os.getenv("INDEX_ANALYZER_MAX_LENGTH", "0")),
+        )
+
+    def _filter_length(self, terms):
+        min_length = self.config["min_length"]
+        max_length = self.config["max_length"] or float("inf")
+        return (term for term in terms if min_length <= len(term) <= max_length)
+
+    # Stages are built from map and filter so no Python frame runs per term
+
+    def _filter_stopwords(self, terms):
+        return itertools.filterfalse(self._stopwords.__contains__, terms)
+
+    def _stem_terms(self, terms):
+        return map(self._stem, terms)
+
+    def normalize(self, text: str) -> str:
+        if self.config["normalization"] == "nfkc":
+            text = unicodedata.normalize("NFKC", text)
+        return text.lower()
+
+    def words(self, text: str):
+        """Yield the normalized words of text, before any filter."""
+        return map(re.Match.group, TOKEN_PATTERN.finditer(self.normalize(text)))
+
+    def tokens(self, text: str):
+        """Yield the terms of text one at a time."""
+        terms = self.words(text)
+        for stage in self._stages:
+            terms = stage(terms)
+        return terms
+
+    def analyze(self, text: str) -> list:
+        return list(self.tokens(text))
+
+    def stem_cache_info(self):
+        return self._stem.cache_info() if self._stem is not None else None
+
+
+# The analyzer the original tokenizer amounts to, assumed for indexes built
+# before analyzer configurations were recorded
+LEGACY_CONFIG = Analyzer().config
+
+ANALYZER = Analyzer.from_env()
+
+
+def check_analyzer_config(storage, analyzer: Analyzer = ANALYZER) -> dict:
+    """
+    Compare analyzer with the configuration recorded for the index in storage,
+    recording it for a new index. A mismatch is logged: the index has to be
+    rebuilt before queries match it again.
+    """
+    recorded = storage.load_analyzer_config()
+    if recorded is None:
+        if storage.read_doc_stats()["docCount"] > 0:
+            recorded = LEGACY_CONFIG
+        else:
+            recorded = analyzer.config
+        storage.save_analyzer_config(recorded)
+    if recorded != analyzer.config:
+        if storage.name == "mongo":
+            rebuild = "rebuild it with app.build_index"
+        else:
+            rebuild = "re-add its documents to an empty INDEX_LOCAL_STORAGE_PATH"
+        logger.warning(
+            f"The index was built with analyzer {recorded} but is served with "
+            f"{analyzer.config}; {rebuild}."
+        )
+    return recorded
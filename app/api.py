@@ -1,20 +1,46 @@
 # app/api.py
 from fastapi import APIRouter, HTTPException, Request, Query
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
-from typing import Dict
+from typing import Dict, List, Optional
 from app.services import (
+    get_db,
     add_document_to_index,
     update_document_in_index,
     delete_document_from_index,
     search_documents,
+    resolve_search_terms,
+    stream_search,
+    decode_cursor,
+    parse_search_fields,
+    MAX_SEARCH_PAGE_SIZE,
+    SEARCH_PAGE_SIZE,
     get_document_metadata,
     get_total_doc_statistics,
+    get_term_statistics,
+    apply_batch_operations,
+    boolean_search,
+    phrase_search,
+    ranked_search,
+    reconcile_statistics,
+    find_near_duplicates,
+    get_ingest_statistics,
+    compact_index,
+    expand_term_pattern,
+    autocomplete,
+    fuzzy_terms,
 )
 from datetime import datetime
+import json
 import logging
+import os
 
 router = APIRouter()
 
+# Upper bound on the number of operations accepted by /ping/batch
+MAX_BATCH_OPERATIONS = int(os.getenv("INDEX_MAX_BATCH_OPERATIONS", "10000"))
+
 
 # Pydantic Models
 class PingIndexRequest(BaseModel):
@@ -23,6 +49,14 @@ class PingIndexRequest(BaseModel):
     timestamp: datetime
 
 
+class BatchPingRequest(BaseModel):
+    operations: List[PingIndexRequest]
+
+
+class TermStatisticsRequest(BaseModel):
+    terms: List[str]
+
+
 class DocumentMetadata(BaseModel):
     document_id: str
     total_terms: int
@@ -34,15 +68,22 @@ async def ping_index(request: Request, ping_request: PingIndexRequest):
     operation = ping_request.operation.lower()
     document_id = ping_request.document_id
 
+    if get_db(request).ingest_queue is not None:
+        return await queue_operations(request, [(document_id, operation)])
+
     try:
         if operation == "add":
-            add_document_to_index(request, document_id)
+            await get_db(request).run_write(add_document_to_index, request, document_id)
             op_past = "added"
         elif operation == "update":
-            update_document_in_index(request, document_id)
+            await get_db(request).run_write(
+                update_document_in_index, request, document_id
+            )
             op_past = "updated"
         elif operation == "delete":
-            delete_document_from_index(request, document_id)
+            await get_db(request).run_write(
+                delete_document_from_index, request, document_id
+            )
             op_past = "deleted"
         else:
             raise HTTPException(status_code=400, detail="Invalid operation type")
@@ -55,13 +96,115 @@ async def ping_index(request: Request, ping_request: PingIndexRequest):
     return {"message": f"Document {op_past} successfully"}
 
 
+@router.post("/ping/batch")
+async def ping_index_batch(request: Request, batch_request: BatchPingRequest):
+    if len(batch_request.operations) > MAX_BATCH_OPERATIONS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Batch exceeds {MAX_BATCH_OPERATIONS} operations",
+        )
+
+    operations = [
+        (ping_request.document_id, ping_request.operation.lower())
+        for ping_request in batch_request.operations
+    ]
+    if get_db(request).ingest_queue is not None:
+        return await queue_operations(request, operations)
+
+    try:
+        results = await get_db(request).run_write(
+            apply_batch_operations, request, operations
+        )
+    except Exception as e:
+        logging.error(f"Error in ping_index_batch: {e}")
+        raise HTTPException(status_code=500, detail="Server error")
+
+    return {"results": results}
+
+
+async def queue_operations(request: Request, operations: list):
+    """Accept operations into the ingestion queue, answering 202 Accepted."""
+    for _, operation in operations:
+        if operation not in ("add", "update", "delete"):
+            raise HTTPException(status_code=400, detail="Invalid operation type")
+    try:
+        db = get_db(request)
+        await db.run_write(db.ingest_queue.enqueue, operations)
+    except Exception as e:
+        logging.error(f"Error queueing operations: {e}")
+        raise HTTPException(status_code=500, detail="Server error")
+    return JSONResponse(
+        status_code=202,
+        content={"message": f"Queued {len(operations)} operations", "queued": True},
+    )
+
+
+async def ndjson_lines(db, batches, leading=()):
+    """
+    Encode the leading items and then the items of batches as
+    newline-delimited JSON, reading each batch on the read executor.
+    """
+    try:
+        for item in leading:
+            yield json.dumps(jsonable_encoder(item)) + "\n"
+        while True:
+            batch = await db.run_read(next, batches, None)
+            if batch is None:
+                return
+            for item in batch:
+                yield json.dumps(jsonable_encoder(item)) + "\n"
+    except Exception as e:
+        logging.error(f"Error while streaming search results: {e}")
+        raise
+
+
 @router.get("/search")
 async def search_index(
-    request: Request, term: str = Query(..., description="Search term")
+    request: Request,
+    term: str = Query(..., description="Search term"),
+    fuzzy: bool = Query(
+        False, description="Search the closest terms when term is not indexed"
+    ),
+    cursor: Optional[str] = Query(None, description="next_cursor of the last page"),
+    limit: Optional[int] = Query(
+        None,
+        ge=1,
+        le=MAX_SEARCH_PAGE_SIZE,
+        description=f"Documents per page, {SEARCH_PAGE_SIZE} by default with a "
+        "cursor, otherwise every document",
+    ),
+    fields: Optional[str] = Query(
+        None, description="Comma-separated metadata, frequency and positions"
+    ),
+    stream: bool = Query(False, description="Stream the results as NDJSON"),
 ):
     try:
-        results = search_documents(request, term)
-        return {"documents": results}
+        corrections = []
+        db = get_db(request)
+        if stream:
+            after = decode_cursor(cursor)
+            selected = parse_search_fields(fields)
+            terms = await db.run_read(
+                resolve_search_terms, request, term, fuzzy, corrections
+            )
+            batches = stream_search(request, terms, after, limit, selected)
+            leading = [{"corrections": corrections}] if corrections else []
+            return StreamingResponse(
+                ndjson_lines(db, batches, leading), media_type="application/x-ndjson"
+            )
+        page = await db.run_read(
+            search_documents,
+            request,
+            term,
+            fuzzy,
+            corrections,
+            cursor,
+            limit,
+            fields,
+        )
+        if corrections:
+            return {**page, "corrections": corrections}
+        return page
     except ValueError as ve:
         raise HTTPException(status_code=400, detail=str(ve))
     except Exception as e:
@@ -69,13 +212,139 @@ async def search_index(
         raise HTTPException(status_code=500, detail="Server error")
 
 
+@router.get("/search/boolean")
+async def search_index_boolean(
+    request: Request,
+    q: str = Query(..., description="Boolean query using AND, OR, NOT and parentheses"),
+):
+    try:
+        expansions = []
+        results = await get_db(request).run_read(boolean_search, request, q, expansions)
+        if expansions:
+            return {"documents": results, "wildcards": expansions}
+        return {"documents": results}
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=str(ve))
+    except Exception as e:
+        logging.error(f"Error in search_index_boolean: {e}")
+        raise HTTPException(status_code=500, detail="Server error")
+
+
+@router.get("/search/phrase")
+async def search_index_phrase(
+    request: Request,
+    q: str = Query(..., description="Phrase to search for"),
+    distance: Optional[int] = Query(
+        None,
+        ge=0,
+        description="Match the terms within this many words instead of as an exact phrase",
+    ),
+):
+    try:
+        results = await get_db(request).run_read(phrase_search, request, q, distance)
+        return {"documents": results}
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=str(ve))
+    except Exception as e:
+        logging.error(f"Error in search_index_phrase: {e}")
+        raise HTTPException(status_code=500, detail="Server error")
+
+
+@router.get("/search/ranked")
+async def search_index_ranked(
+    request: Request,
+    q: str = Query(..., description="Free-text query"),
+    limit: int = Query(10, ge=1, description="Results per page"),
+    offset: int = Query(0, ge=0, description="Number of top results to skip"),
+):
+    try:
+        results = await get_db(request).run_read(
+            ranked_search, request, q, limit, offset
+        )
+        return {"documents": results, "limit": limit, "offset": offset}
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=str(ve))
+    except Exception as e:
+        logging.error(f"Error in search_index_ranked: {e}")
+        raise HTTPException(status_code=500, detail="Server error")
+
+
+@router.get("/autocomplete")
+async def autocomplete_terms(
+    request: Request,
+    prefix: str = Query(..., description="Beginning of a term"),
+    limit: int = Query(10, ge=1, le=100, description="Completions to return"),
+):
+    try:
+        return await get_db(request).run_read(autocomplete, request, prefix, limit)
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=str(ve))
+    except Exception as e:
+        logging.error(f"Error in autocomplete endpoint: {e}")
+        raise HTTPException(status_code=500, detail="Server error")
+
+
+@router.get("/terms")
+async def terms_matching(
+    request: Request,
+    pattern: str = Query(..., description="Term pattern, * matching any characters"),
+):
+    try:
+        return await get_db(request).run_read(expand_term_pattern, request, pattern)
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=str(ve))
+    except Exception as e:
+        logging.error(f"Error in terms endpoint: {e}")
+        raise HTTPException(status_code=500, detail="Server error")
+
+
+@router.get("/fuzzy")
+async def fuzzy_term_lookup(
+    request: Request,
+    term: str = Query(..., description="Possibly misspelled term"),
+    max_distance: int = Query(2, ge=0, le=2, description="Largest edit distance"),
+    limit: int = Query(10, ge=1, le=100, description="Candidates to return"),
+):
+    try:
+        return await get_db(request).run_read(
+            fuzzy_terms, request, term, max_distance, limit
+        )
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=str(ve))
+    except Exception as e:
+        logging.error(f"Error in fuzzy endpoint: {e}")
+        raise HTTPException(status_code=500, detail="Server error")
+
+
+@router.get("/near-duplicates/{document_id}")
+async def near_duplicates(
+    request: Request,
+    document_id: str,
+    max_distance: int = Query(3, ge=0, description="Largest SimHash bit distance"),
+):
+    try:
+        duplicates = await get_db(request).run_read(
+            find_near_duplicates, request, document_id, max_distance
+        )
+        return {"document_id": document_id, "duplicates": duplicates}
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=str(ve))
+    except Exception as e:
+        logging.error(f"Error in near_duplicates endpoint: {e}")
+        raise HTTPException(status_code=500, detail="Server error")
+
+
 @router.get("/metadata/{document_id}")
 async def metadata(request: Request, document_id: str):
     try:
-        metadata = get_document_metadata(request, document_id)
+        metadata = await get_db(request).run_read(
+            get_document_metadata, request, document_id
+        )
         if not metadata:
             raise HTTPException(status_code=404, detail="Document not found")
         return metadata
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Error in metadata endpoint: {e}")
         raise HTTPException(status_code=500, detail="Server error")
@@ -84,13 +353,112 @@ async def metadata(request: Request, document_id: str):
 @router.get("/doc-stats")
 async def doc_stats(request: Request):
     try:
-        stats = get_total_doc_statistics(request)
+        # Served from memory unless the snapshot is older than its staleness bound
+        stats = get_db(request).doc_stats.current()
+        if stats is None:
+            stats = await get_db(request).run_read(get_total_doc_statistics, request)
         return stats
     except Exception as e:
         logging.error(f"Error in doc_stats endpoint: {e}")
         raise HTTPException(status_code=500, detail="Server error")
 
 
+@router.post("/doc-stats/terms")
+async def doc_stats_terms(request: Request, stats_request: TermStatisticsRequest):
+    try:
+        return await get_db(request).run_read(
+            get_term_statistics, request, stats_request.terms
+        )
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=str(ve))
+    except Exception as e:
+        logging.error(f"Error in doc_stats_terms endpoint: {e}")
+        raise HTTPException(status_code=500, detail="Server error")
+
+
+@router.get("/ingest-stats")
+async def ingest_stats(request: Request):
+    try:
+        return await get_db(request).run_read(get_ingest_statistics, request)
+    except Exception as e:
+        logging.error(f"Error in ingest_stats endpoint: {e}")
+        raise HTTPException(status_code=500, detail="Server error")
+
+
+@router.post("/compact")
+async def compact(request: Request):
+    try:
+        db = get_db(request)
+        return await db.run_write(compact_index, db)
+    except Exception as e:
+        logging.error(f"Error in compact endpoint: {e}")
+        raise HTTPException(status_code=500, detail="Server error")
+
+
+@router.get("/cache-stats")
+async def cache_stats(request: Request):
+    try:
+        return get_db(request).cache_stats()
+    except Exception as e:
+        logging.error(f"Error in cache_stats endpoint: {e}")
+        raise HTTPException(status_code=500, detail="Server error")
+
+
+@router.post("/doc-stats/reconcile")
+async def doc_stats_reconcile(request: Request, apply: bool = True):
+    try:
+        return await get_db(request).run_write(reconcile_statistics, request, apply)
+    except Exception as e:
+        logging.error(f"Error in doc_stats reconcile endpoint: {e}")
+        raise HTTPException(status_code=500, detail="Server error")
+
+
+@router.get("/storage-stats")
+async def storage_stats(request: Request):
+    try:
+        return get_db(request).storage.storage_stats()
+    except Exception as e:
+        logging.error(f"Error in storage_stats endpoint: {e}")
+        raise HTTPException(status_code=500, detail="Server error")
+
+
+@router.post("/snapshots")
+async def create_snapshot(request: Request):
+    try:
+        db = get_db(request)
+        return await db.run_write(db.storage.create_snapshot)
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=str(ve))
+    except Exception as e:
+        logging.error(f"Error in create_snapshot endpoint: {e}")
+        raise HTTPException(status_code=500, detail="Server error")
+
+
+@router.get("/snapshots")
+async def list_snapshots(request: Request):
+    try:
+        db = get_db(request)
+        return {"snapshots": await db.run_read(db.storage.list_snapshots)}
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=str(ve))
+    except Exception as e:
+        logging.error(f"Error in list_snapshots endpoint: {e}")
+        raise HTTPException(status_code=500, detail="Server error")
+
+
+@router.delete("/snapshots/{name}")
+async def release_snapshot(request: Request, name: str):
+    try:
+        db = get_db(request)
+        await db.run_write(db.storage.release_snapshot, name)
+        return {"message": f"Snapshot {name} released."}
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=str(ve))
+    except Exception as e:
+        logging.error(f"Error in release_snapshot endpoint: {e}")
+        raise HTTPException(status_code=500, detail="Server error")
+
+
 # Test Endpoint to Verify Index DB Connection
 # @router.get("/test-connection")
 # async def test_connection(request: Request):
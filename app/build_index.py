@@ -0,0 +1,376 @@
+# app/build_index.py
+"""
+Rebuild the whole index offline from the Document Data Store.
+
+    python -m app.build_index --workers 8
+
+TRANSFORMED is streamed through a batched cursor and each batch is tokenized in
+a process pool. The main process writes forward and metadata entries as they
+arrive and inverts the postings in memory, SPIMI style: once the buffered
+postings pass --run-size positions they are sorted by term and doc id and
+spilled to a run file on disk. The runs are then heap-merged into posting
+blocks and headers, one block at a time, so a term's postings are never held
+in memory whole. Everything is bulk-loaded into fresh "<name>__build" collections,
+which get their indexes and then replace the live collections by renaming.
+The configuration of the analyzer (app.analysis) is recorded with the index.
+
+Each rename is atomic, but the swap as a whole is not: for a moment readers can
+see the new postings with the old forward index. Writes made to the live index
+during a rebuild are lost, and running servers keep serving cached results for
+up to INDEX_CACHE_TTL seconds. Only the Mongo backend can be rebuilt this
+way.
+"""
+
+import argparse
+import heapq
+import itertools
+import logging
+import os
+import pickle
+import shutil
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from app.analysis import ANALYZER
+from app.db import Database
+from app.fingerprint import content_fingerprint, simhash_fields
+from app.postings import (
+    BULK_WRITE_BATCH_SIZE,
+    POSTING_BLOCK_SIZE,
+    block_fields,
+    forward_terms_for_storage,
+)
+from app.schema import INDEXES
+from app.utils import analyze_document, document_to_index_input
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Documents per cursor batch and per tokenization task
+BUILD_BATCH_SIZE = int(os.getenv("INDEX_BUILD_BATCH_SIZE", "1000"))
+
+# Tokenizing processes
+BUILD_WORKERS = int(os.getenv("INDEX_BUILD_WORKERS", str(os.cpu_count() or 1)))
+
+# Positions buffered in memory before they are spilled to a sorted run
+BUILD_RUN_SIZE = int(os.getenv("INDEX_BUILD_RUN_SIZE", "5000000"))
+
+# Collections produced by a build, in the order they are swapped in
+BUILT_COLLECTIONS = (
+    "posting_blocks",
+    "inverted_index",
+    "forward_index",
+    "doc_metadata",
+    "doc_stats",
+)
+BUILD_SUFFIX = "__build"
+
+DOCUMENT_PROJECTION = {"text": 1, "url": 1, "type": 1, "text_length": 1}
+
+
+def tokenize_documents(documents: list) -> list:
+    """Turn TRANSFORMED documents into forward entries, with plain positions."""
+    entries = []
+    for document in documents:
+        document_content, document_metadata = document_to_index_input(document)
+        term_info, term_count = analyze_document(document_content)
+        entries.append(
+            {
+                "document_id": document["_id"],
+                "terms": term_info,
+                "metadata": document_metadata,
+                "total_terms": document_metadata.get("text_length", term_count),
+                "fingerprint": content_fingerprint(document_content, document_metadata),
+                **simhash_fields(term_info),
+            }
+        )
+    return entries
+
+
+def _batches(documents, batch_size: int):
+    documents = iter(documents)
+    while True:
+        batch = list(itertools.islice(documents, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def tokenized_batches(documents, workers: int, batch_size: int):
+    """
+    Yield tokenize_documents of each batch of documents, in order. At most two
+    batches per worker are in flight, which bounds the memory they hold.
+    """
+    if workers <= 1:
+        for batch in _batches(documents, batch_size):
+            yield tokenize_documents(batch)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for batch in _batches(documents, batch_size):
+            pending.append(pool.submit(tokenize_documents, batch))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def _read_run(run):
+    """Yield the (term, posting) pairs of a run, one chunk in memory at a time."""
+    while True:
+        try:
+            term, chunk = pickle.load(run)
+        except EOFError:
+            return
+        for posting in chunk:
+            yield term, posting
+
+
+class Inverter:
+    """
+    Memory-bounded SPIMI inverter. Postings are buffered per term as
+    (doc_id, frequency, positions, doc_length) and spilled to a run file, in
+    term and doc-id order, whenever run_size positions are buffered. Runs are
+    written in chunks of POSTING_BLOCK_SIZE postings so merging them holds one
+    chunk per run.
+    """
+
+    def __init__(self, directory: str, run_size: int):
+        self.directory = directory
+        self.run_size = run_size
+        self.postings = {}
+        self.size = 0
+        self.runs = []
+
+    def add(self, document_id: str, term_info: dict, doc_length: int):
+        for term, info in term_info.items():
+            self.postings.setdefault(term, []).append(
+                (document_id, info["frequency"], info["positions"], doc_length)
+            )
+            self.size += info["frequency"]
+        if self.size >= self.run_size:
+            self.spill()
+
+    def spill(self):
+        if not self.postings:
+            return
+        path = os.path.join(self.directory, f"run-{len(self.runs):05d}.pkl")
+        with open(path, "wb") as run:
+            for term in sorted(self.postings):
+                postings = sorted(self.postings[term], key=lambda posting: posting[0])
+                for start in range(0, len(postings), POSTING_BLOCK_SIZE):
+                    pickle.dump(
+                        (term, postings[start : start + POSTING_BLOCK_SIZE]),
+                        run,
+                        protocol=pickle.HIGHEST_PROTOCOL,
+                    )
+        self.runs.append(path)
+        self.postings = {}
+        self.size = 0
+
+    def merged(self):
+        """
+        Yield (term, iterator of its postings in doc-id order) over all runs,
+        in term order. Each iterator must be consumed before the next term.
+        """
+        self.spill()
+        runs = [open(path, "rb") for path in self.runs]
+        try:
+            merged = heapq.merge(
+                *(_read_run(run) for run in runs),
+                key=lambda item: (item[0], item[1][0]),
+            )
+            for term, group in itertools.groupby(merged, key=lambda item: item[0]):
+                yield term, (posting for _, posting in group)
+        finally:
+            for run in runs:
+                run.close()
+
+
+class _BulkLoader:
+    def __init__(self, collection):
+        self.collection = collection
+        self.buffer = []
+        self.loaded = 0
+
+    def add(self, document: dict):
+        self.buffer.append(document)
+        if len(self.buffer) >= BULK_WRITE_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.collection.insert_many(self.buffer, ordered=False)
+            self.loaded += len(self.buffer)
+            self.buffer = []
+
+
+def load_postings(targets: dict, merged, encoding: str = None) -> dict:
+    """Write the merged postings as term headers and posting blocks."""
+    headers = _BulkLoader(targets["inverted_index"])
+    blocks = _BulkLoader(targets["posting_blocks"])
+    postings_loaded = 0
+    for term, postings in merged:
+        firsts = []
+        df = max_tf = 0
+        min_doc_length = float("inf")
+        while True:
+            chunk = list(itertools.islice(postings, POSTING_BLOCK_SIZE))
+            if not chunk:
+                break
+            first = chunk[0][0] if firsts else ""
+            firsts.append(first)
+            df += len(chunk)
+            max_tf = max(max_tf, *(posting[1] for posting in chunk))
+            min_doc_length = min(min_doc_length, *(posting[3] for posting in chunk))
+            blocks.add(
+                {
+                    "term": term,
+                    "first": first,
+                    "count": len(chunk),
+                    "version": 1,
+                    **block_fields(
+                        {
+                            document_id: {
+                                "frequency": frequency,
+                                "positions": positions,
+                            }
+                            for document_id, frequency, positions, _ in chunk
+                        },
+                        encoding,
+                    ),
+                }
+            )
+        headers.add(
+            {
+                "term": term,
+                "df": df,
+                "max_tf": max_tf,
+                "min_doc_length": min_doc_length,
+                "blocks": firsts,
+            }
+        )
+        postings_loaded += df
+    headers.flush()
+    blocks.flush()
+    return {
+        "terms": headers.loaded,
+        "blocks": blocks.loaded,
+        "postings": postings_loaded,
+    }
+
+
+def build_index(
+    db,
+    documents,
+    workers: int = BUILD_WORKERS,
+    batch_size: int = BUILD_BATCH_SIZE,
+    run_size: int = BUILD_RUN_SIZE,
+    tmp_dir: str = None,
+    encoding: str = None,
+) -> dict:
+    """
+    Build a complete index of documents, an iterable of TRANSFORMED documents,
+    into fresh collections and swap them in for the live ones.
+    """
+    if db.storage.name != "mongo":
+        raise ValueError(
+            f"app.build_index rebuilds the Mongo collections and cannot build "
+            f"the {db.storage.name} backend; re-add the documents to an empty "
+            f"INDEX_LOCAL_STORAGE_PATH instead."
+        )
+    started = time.monotonic()
+    targets = {name: db.index_db[f"{name}{BUILD_SUFFIX}"] for name in BUILT_COLLECTIONS}
+    for target in targets.values():
+        target.drop()
+
+    run_directory = tempfile.mkdtemp(prefix="index-build-", dir=tmp_dir)
+    try:
+        inverter = Inverter(run_directory, run_size)
+        forward = _BulkLoader(targets["forward_index"])
+        metadata = _BulkLoader(targets["doc_metadata"])
+        total_length = 0
+        for entries in tokenized_batches(documents, workers, batch_size):
+            for entry in entries:
+                inverter.add(entry["document_id"], entry["terms"], entry["total_terms"])
+                forward.add(
+                    {
+                        **entry,
+                        "terms": forward_terms_for_storage(entry["terms"], encoding),
+                    }
+                )
+                metadata.add(
+                    {
+                        "document_id": entry["document_id"],
+                        "total_terms": entry["total_terms"],
+                        "metadata": entry["metadata"],
+                    }
+                )
+                total_length += entry["total_terms"]
+            forward.flush()
+            metadata.flush()
+            logger.info(f"Tokenized {forward.loaded} documents.")
+
+        report = load_postings(targets, inverter.merged(), encoding)
+        report["documents"] = forward.loaded
+        report["runs"] = len(inverter.runs)
+    finally:
+        shutil.rmtree(run_directory, ignore_errors=True)
+
+    targets["doc_stats"].insert_one(
+        {"shard": 0, "docCount": report["documents"], "totalLength": total_length}
+    )
+    for name, target in targets.items():
+        target.create_indexes(INDEXES[name])
+    for name in BUILT_COLLECTIONS:
+        targets[name].rename(name, dropTarget=True)
+    # Worker processes analyze with the same environment as this one
+    db.storage.save_analyzer_config(ANALYZER.config)
+    report["analyzer"] = ANALYZER.config
+
+    elapsed = time.monotonic() - started
+    report["seconds"] = round(elapsed, 2)
+    report["documents_per_second"] = round(report["documents"] / elapsed, 1)
+    logger.info(f"Built index: {report}")
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--workers", type=int, default=BUILD_WORKERS)
+    parser.add_argument("--batch-size", type=int, default=BUILD_BATCH_SIZE)
+    parser.add_argument(
+        "--run-size",
+        type=int,
+        default=BUILD_RUN_SIZE,
+        help="Positions held in memory before a run is spilled to disk",
+    )
+    parser.add_argument("--tmp-dir", help="Directory for spilled runs")
+    args = parser.parse_args()
+
+    db = Database()
+    db.connect_to_databases()
+    try:
+        if db.transformed_docs_col is None:
+            raise SystemExit("The Document Data Store is not reachable.")
+        documents = db.transformed_docs_col.find(
+            {}, DOCUMENT_PROJECTION, batch_size=args.batch_size
+        )
+        build_index(
+            db,
+            documents,
+            workers=args.workers,
+            batch_size=args.batch_size,
+            run_size=args.run_size,
+            tmp_dir=args.tmp_dir,
+        )
+    except ValueError as e:
+        raise SystemExit(str(e))
+    finally:
+        db.close_database_connections()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+# app/cache.py
+from collections import OrderedDict
+import threading
+import time
+
+
+class LRUCache:
+    """
+    Thread-safe, size-bounded least-recently-used cache with an optional TTL.
+
+    Entries can be tagged so that invalidate_tags drops every entry depending on
+    a tag. A reader that loads a value while a writer invalidates it would
+    otherwise put the stale value back, so readers take generation() before
+    loading and pass it to set, which then refuses the value if any of its tags
+    were invalidated in between.
+    """
+
+    def __init__(self, maxsize: int, ttl: float = 0, max_tracked_tags: int = 100000):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_tracked_tags = max_tracked_tags
+        self._entries = OrderedDict()  # key -> (value, expires_at, tags)
+        self._tagged = {}  # tag -> keys of the entries carrying it
+        self._generation = 0
+        self._invalidated = {}  # tag -> generation it was last invalidated at
+        self._floor = 0  # sets older than this are refused
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            value, expires_at, _ = item
+            if expires_at is not None and expires_at <= time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def generation(self) -> int:
+        return self._generation
+
+    def set(self, key, value, tags=(), generation: int = None) -> bool:
+        if self.maxsize <= 0:
+            return False
+        tags = tuple(tags)
+        with self._lock:
+            if generation is not None and not self._is_current(tags, generation):
+                return False
+            if key in self._entries:
+                self._remove(key)
+            expires_at = time.monotonic() + self.ttl if self.ttl > 0 else None
+            self._entries[key] = (value, expires_at, tags)
+            for tag in tags:
+                self._tagged.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+        return True
+
+    def _is_current(self, tags, generation: int) -> bool:
+        if generation < self._floor:
+            return False
+        return all(self._invalidated.get(tag, -1) <= generation for tag in tags)
+
+    def _remove(self, key):
+        _, _, tags = self._entries.pop(key)
+        for tag in tags:
+            keys = self._tagged.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tagged[tag]
+
+    def invalidate(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def invalidate_tags(self, tags):
+        with self._lock:
+            self._generation += 1
+            if len(self._invalidated) > self.max_tracked_tags:
+                # Forget individual tags; in-flight loads are refused instead
+                self._invalidated.clear()
+                self._floor = self._generation
+            for tag in tags:
+                self._invalidated[tag] = self._generation
+                for key in self._tagged.pop(tag, ()):
+                    if key in self._entries:
+                        self._remove(key)
+                        self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tagged.clear()
+            self._generation += 1
+            self._invalidated.clear()
+            self._floor = self._generation
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+        }
+
+    def __len__(self):
+        return len(self._entries)
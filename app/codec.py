@@ -0,0 +1,130 @@
+# app/codec.py
+"""
+Compact binary encodings for postings.
+
+Integers are written as LEB128 varints. Position lists are sorted, so they are
+stored as the gaps between consecutive positions. Doc ids are strings sorted
+within a block, so they are front coded: each id stores the length of the
+prefix it shares with the previous id and the remaining UTF-8 suffix.
+"""
+
+
+def encode_varints(values) -> bytes:
+    out = bytearray()
+    for value in values:
+        if value < 0:
+            raise ValueError("Varints must not be negative")
+        while value > 0x7F:
+            out.append((value & 0x7F) | 0x80)
+            value >>= 7
+        out.append(value)
+    return bytes(out)
+
+
+def decode_varints(data: bytes) -> list:
+    values = []
+    value = 0
+    shift = 0
+    for byte in data:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            values.append(value)
+            value = 0
+            shift = 0
+    if shift:
+        raise ValueError("Truncated varint")
+    return values
+
+
+def encode_positions(positions: list) -> bytes:
+    """Delta + varint encode a sorted list of positions."""
+    previous = 0
+    gaps = []
+    for position in positions:
+        gaps.append(position - previous)
+        previous = position
+    return encode_varints(gaps)
+
+
+def decode_positions(data: bytes) -> list:
+    positions = []
+    position = 0
+    for gap in decode_varints(data):
+        position += gap
+        positions.append(position)
+    return positions
+
+
+def encode_doc_ids(doc_ids: list) -> bytes:
+    """Front code a sorted list of doc ids."""
+    out = bytearray()
+    previous = b""
+    for doc_id in doc_ids:
+        current = doc_id.encode("utf-8")
+        shared = 0
+        limit = min(len(previous), len(current))
+        while shared < limit and previous[shared] == current[shared]:
+            shared += 1
+        suffix = current[shared:]
+        out += encode_varints((shared, len(suffix)))
+        out += suffix
+        previous = current
+    return bytes(out)
+
+
+def decode_doc_ids(data: bytes) -> list:
+    doc_ids = []
+    previous = b""
+    offset = 0
+    while offset < len(data):
+        header = []
+        while len(header) < 2:
+            value = 0
+            shift = 0
+            while True:
+                byte = data[offset]
+                offset += 1
+                value |= (byte & 0x7F) << shift
+                if not byte & 0x80:
+                    break
+                shift += 7
+            header.append(value)
+        shared, length = header
+        current = previous[:shared] + data[offset : offset + length]
+        offset += length
+        doc_ids.append(current.decode("utf-8"))
+        previous = current
+    return doc_ids
+
+
+def encode_posting_block(documents: dict) -> dict:
+    """
+    Encode {doc_id: {"frequency", "positions"}} into the binary fields of a
+    compact block. Positions are stored per document, back to back, with their
+    byte lengths kept separately so one document can be decoded on its own.
+    """
+    doc_ids = sorted(documents)
+    encoded_positions = [encode_positions(documents[d]["positions"]) for d in doc_ids]
+    return {
+        "doc_ids": encode_doc_ids(doc_ids),
+        "frequencies": encode_varints(documents[d]["frequency"] for d in doc_ids),
+        "position_lengths": encode_varints(len(p) for p in encoded_positions),
+        "positions": b"".join(encoded_positions),
+    }
+
+
+def iter_encoded_block(block: dict):
+    """
+    Yield (doc_id, frequency, encoded_positions) for every posting in the binary
+    fields of a compact block, in doc-id order, without decoding positions.
+    """
+    doc_ids = decode_doc_ids(bytes(block["doc_ids"]))
+    frequencies = decode_varints(bytes(block["frequencies"]))
+    lengths = decode_varints(bytes(block["position_lengths"]))
+    positions = bytes(block["positions"])
+    offset = 0
+    for doc_id, frequency, length in zip(doc_ids, frequencies, lengths):
+        yield doc_id, frequency, positions[offset : offset + length]
+        offset += length
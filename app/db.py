@@ -1,13 +1,34 @@
 # app/db.py
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
+from bson import ObjectId
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import functools
 import os
+import threading
+import uuid
 from dotenv import load_dotenv
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 import logging
 from pymongo.errors import ConnectionFailure
+from app.analysis import check_analyzer_config
+from app.cache import LRUCache
+from app.schema import apply_schema
+from app.stats import DocStatsSnapshot
+from app.storage import STORAGE_BACKEND, LocalStorage, MongoStorage
+from app.terms import TERM_DICTIONARY, TermDictionary
 
 load_dotenv()
 
+# Search cache tag for responses that depend on collection-wide statistics,
+# such as ranked results; any write invalidates it
+STATS_TAG = ("doc_stats",)
+
+# How far back each poll of the shared invalidation log looks, to catch entries
+# from other workers whose ids sort before the last one seen
+INVALIDATION_SYNC_OVERLAP = timedelta(seconds=5)
+
 # Initialize Logger
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -22,14 +43,187 @@ class Database:
         self.index_client = None
         self.index_db = None
         self.forward_index_col = None
-        self.inverted_index_col = None
+        self.inverted_index_col = None  # One header per term
+        self.posting_blocks_col = None  # Postings of each term, in doc-id blocks
         self.doc_stats_col = None
+        self.doc_metadata_col = None  # Lean per-document metadata store
+        self.doc_stats = DocStatsSnapshot()  # In-memory copy of doc_stats_col
+        self.storage = None  # IndexStorage the services read and write through
+        self.term_dictionary = TermDictionary()  # Indexed terms and their df
+        self.supports_transactions = False
+
+        # In-process cache of doc_metadata entries keyed by document_id
+        self.metadata_cache = LRUCache(
+            int(os.getenv("INDEX_METADATA_CACHE_SIZE", "100000"))
+        )
+
+        # Decoded postings per term and whole search responses, tagged by the
+        # terms they depend on so writes can drop exactly what they touched
+        cache_ttl = float(os.getenv("INDEX_CACHE_TTL", "300"))
+        self.postings_cache = LRUCache(
+            int(os.getenv("INDEX_POSTINGS_CACHE_SIZE", "10000")), ttl=cache_ttl
+        )
+        self.search_cache = LRUCache(
+            int(os.getenv("INDEX_SEARCH_CACHE_SIZE", "10000")), ttl=cache_ttl
+        )
+
+        # Optional invalidation log shared by several workers on one index
+        self.shared_cache = os.getenv("INDEX_SHARED_CACHE", "false").lower() == "true"
+        self.cache_invalidations_col = None
+        self.cache_origin = uuid.uuid4().hex
+        self._invalidations_synced_at = datetime.now(timezone.utc)
+        self._seen_invalidations = {}
+
+        # Documents whose postings outlived them on the last compaction sweep
+        self.compaction_suspects = set()
+
+        # Queue of pings indexed in the background, with INDEX_INGEST_MODE=queue
+        self.ingest_queue = None
+
+        # Per-worker counters of ingestion outcomes, such as skipped updates
+        self.ingest_counters = Counter()
+        self._counters_lock = threading.Lock()
 
         self.doc_store_client = None
         self.doc_store_db = None
         self.transformed_docs_col = None  # Collection in Document Data Store
 
+        # Bounded executors that keep blocking pymongo calls off the event loop.
+        # Reads and writes get separate pools so slow ingestion cannot starve
+        # concurrent searches.
+        self.read_concurrency = int(os.getenv("INDEX_DB_READ_CONCURRENCY", "16"))
+        self.write_concurrency = int(os.getenv("INDEX_DB_WRITE_CONCURRENCY", "4"))
+        self.read_executor = None
+        self.write_executor = None
+
+    def start_executors(self):
+        if self.read_executor is None:
+            self.read_executor = ThreadPoolExecutor(
+                max_workers=self.read_concurrency, thread_name_prefix="index-read"
+            )
+        if self.write_executor is None:
+            self.write_executor = ThreadPoolExecutor(
+                max_workers=self.write_concurrency, thread_name_prefix="index-write"
+            )
+        logger.info(
+            f"Started database executors: reads={self.read_concurrency}, "
+            f"writes={self.write_concurrency}"
+        )
+
+    def shutdown_executors(self):
+        for executor in (self.read_executor, self.write_executor):
+            if executor is not None:
+                executor.shutdown(wait=True)
+        self.read_executor = None
+        self.write_executor = None
+
+    async def _run(self, executor, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            executor, functools.partial(func, *args, **kwargs)
+        )
+
+    async def run_read(self, func, *args, **kwargs):
+        """Run a blocking read on the bounded read executor."""
+        return await self._run(self.read_executor, func, *args, **kwargs)
+
+    async def run_write(self, func, *args, **kwargs):
+        """Run a blocking write on the bounded write executor."""
+        return await self._run(self.write_executor, func, *args, **kwargs)
+
+    def with_transaction(self, callback):
+        """
+        Run callback(session) inside a multi-document transaction when the
+        deployment supports one, otherwise run it directly with no session.
+        """
+        if not self.supports_transactions:
+            return callback(None)
+        with self.index_client.start_session() as session:
+            return session.with_transaction(callback)
+
+    def _invalidate_local_caches(self, terms: list, documents: list = ()):
+        self.postings_cache.invalidate_tags(terms)
+        self.search_cache.invalidate_tags(terms + [STATS_TAG])
+        for document_id in documents:
+            self.metadata_cache.invalidate(document_id)
+
+    def invalidate_cached_terms(self, terms, documents=()):
+        """
+        Drop cached postings and search responses that depend on terms, the
+        responses that depend on collection statistics and the cached metadata
+        of documents. With a shared cache the invalidation is also logged for
+        the other workers.
+        """
+        terms = list(terms)
+        documents = list(documents)
+        self._invalidate_local_caches(terms, documents)
+        if self.shared_cache and self.cache_invalidations_col is not None:
+            chunks = max(len(terms), len(documents), 1)
+            self.cache_invalidations_col.insert_many(
+                [
+                    {
+                        "origin": self.cache_origin,
+                        "terms": terms[start : start + 10000],
+                        "documents": documents[start : start + 10000],
+                        "created": datetime.now(timezone.utc),
+                    }
+                    for start in range(0, chunks, 10000)
+                ]
+            )
+
+    def sync_cache_invalidations(self) -> int:
+        """Apply invalidations logged by other workers since the last poll."""
+        if self.cache_invalidations_col is None:
+            return 0
+        now = datetime.now(timezone.utc)
+        since = self._invalidations_synced_at - INVALIDATION_SYNC_OVERLAP
+        applied = 0
+        for entry in self.cache_invalidations_col.find(
+            {"_id": {"$gte": ObjectId.from_datetime(since)}}
+        ).sort("_id", 1):
+            if entry["_id"] in self._seen_invalidations:
+                continue
+            self._seen_invalidations[entry["_id"]] = entry["_id"].generation_time
+            if entry["origin"] != self.cache_origin:
+                self._invalidate_local_caches(
+                    entry["terms"], entry.get("documents", ())
+                )
+                self.term_dictionary.refresh(self.storage, entry["terms"])
+                applied += 1
+        self._seen_invalidations = {
+            entry_id: created
+            for entry_id, created in self._seen_invalidations.items()
+            if created >= since
+        }
+        self._invalidations_synced_at = now
+        return applied
+
+    def load_term_dictionary(self):
+        if TERM_DICTIONARY:
+            self.term_dictionary.load(self.storage.iter_term_frequencies())
+
+    def count(self, name: str, amount: int = 1):
+        with self._counters_lock:
+            self.ingest_counters[name] += amount
+
+    def cache_stats(self) -> dict:
+        return {
+            "metadata": self.metadata_cache.stats(),
+            "postings": self.postings_cache.stats(),
+            "search": self.search_cache.stats(),
+            "shared": self.shared_cache,
+        }
+
     def connect_to_databases(self):
+        if STORAGE_BACKEND == "local":
+            self.storage = LocalStorage()
+            self.doc_stats.refresh(self)
+            check_analyzer_config(self.storage)
+            self.load_term_dictionary()
+            logger.info(f"Opened the local index in {self.storage.path}.")
+            self.start_executors()
+            return
+
         try:
             # Indexing Component MongoDB Configuration
             INDEX_DB_URI = os.getenv("INDEX_DB_URI")
@@ -44,20 +238,29 @@ class Database:
             self.index_db = self.index_client[INDEX_DATABASE_NAME]
             self.forward_index_col = self.index_db["forward_index"]
             self.inverted_index_col = self.index_db["inverted_index"]
+            self.posting_blocks_col = self.index_db["posting_blocks"]
             self.doc_stats_col = self.index_db["doc_stats"]
+            self.doc_metadata_col = self.index_db["doc_metadata"]
+            self.storage = MongoStorage(self)
 
-            # Initialize doc_stats_col if empty
-            if self.doc_stats_col.count_documents({}) == 0:
-                self.doc_stats_col.insert_one(
-                    {
-                        "docCount": 0,
-                        "avgDocLength": 0.0,
-                        "last_updated": datetime.now(timezone.utc),
-                    }
+            # Transactions need a replica set or sharded cluster
+            try:
+                hello = self.index_client.admin.command("hello")
+                self.supports_transactions = bool(
+                    hello.get("setName") or hello.get("msg") == "isdbgrid"
                 )
-                logger.info("Initialized doc_stats_col with default values.")
-            else:
-                logger.info("doc_stats_col already initialized.")
+            except Exception as e:
+                logger.warning(f"Could not detect transaction support: {e}")
+                self.supports_transactions = False
+
+            if self.shared_cache:
+                self.cache_invalidations_col = self.index_db["cache_invalidations"]
+
+            # Bring the data up to the current schema and build its indexes
+            apply_schema(self)
+            self.doc_stats.refresh(self)
+            check_analyzer_config(self.storage)
+            self.load_term_dictionary()
 
             logger.info("Successfully connected to the Indexing Database.")
 
@@ -82,8 +285,40 @@ class Database:
             )
             self.transformed_docs_col = None  # Set to None if connection fails
 
+        self.start_executors()
+
+    def backfill_document_metadata(self):
+        batch = []
+        backfilled = 0
+        for forward_entry in self.forward_index_col.find(
+            {}, {"_id": 0, "document_id": 1, "total_terms": 1, "metadata": 1}
+        ):
+            batch.append(
+                UpdateOne(
+                    {"document_id": forward_entry["document_id"]},
+                    {
+                        "$setOnInsert": {
+                            "total_terms": forward_entry.get("total_terms", 0),
+                            "metadata": forward_entry.get("metadata", {}),
+                        }
+                    },
+                    upsert=True,
+                )
+            )
+            if len(batch) >= 1000:
+                self.doc_metadata_col.bulk_write(batch, ordered=False)
+                backfilled += len(batch)
+                batch = []
+        if batch:
+            self.doc_metadata_col.bulk_write(batch, ordered=False)
+            backfilled += len(batch)
+        logger.info(f"Backfilled doc_metadata_col with {backfilled} documents.")
+
     def close_database_connections(self):
         try:
+            self.shutdown_executors()
+            if self.storage is not None:
+                self.storage.close()
             if self.index_client:
                 self.index_client.close()
             if self.doc_store_client:
@@ -0,0 +1,63 @@
+# app/fingerprint.py
+"""
+Document fingerprints.
+
+content_fingerprint is a SHA-256 of a document's text and metadata, used to
+recognise re-crawls that changed nothing. simhash is a 64-bit SimHash of the
+document's terms weighted by frequency: near-identical documents get hashes a
+few bits apart. The hash is split into SIMHASH_BANDS bands so that candidates
+within SIMHASH_BANDS - 1 bits of each other always share at least one band and
+can be found with an exact-match lookup.
+"""
+
+import hashlib
+import json
+
+SIMHASH_BITS = 64
+SIMHASH_BANDS = 4
+
+
+def content_fingerprint(text: str, metadata: dict) -> str:
+    digest = hashlib.sha256(text.encode("utf-8"))
+    digest.update(json.dumps(metadata, sort_keys=True, default=str).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _feature_hash(feature: str) -> int:
+    return int.from_bytes(
+        hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "big"
+    )
+
+
+def simhash(term_info: dict) -> int:
+    """SimHash of {term: {"frequency", ...}}, each term weighted by frequency."""
+    weights = [0] * SIMHASH_BITS
+    for term, info in term_info.items():
+        feature = _feature_hash(term)
+        frequency = info["frequency"]
+        for bit in range(SIMHASH_BITS):
+            if feature >> bit & 1:
+                weights[bit] += frequency
+            else:
+                weights[bit] -= frequency
+    return sum(1 << bit for bit, weight in enumerate(weights) if weight > 0)
+
+
+def simhash_bands(value: int) -> list:
+    """Band keys of a SimHash, as "band:hex" strings."""
+    width = SIMHASH_BITS // SIMHASH_BANDS
+    mask = (1 << width) - 1
+    return [
+        f"{band}:{value >> (band * width) & mask:0{width // 4}x}"
+        for band in range(SIMHASH_BANDS)
+    ]
+
+
+def simhash_fields(term_info: dict) -> dict:
+    """The SimHash of term_info and its bands, as stored on forward entries."""
+    signature = simhash(term_info)
+    return {"simhash": f"{signature:016x}", "simhash_bands": simhash_bands(signature)}
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
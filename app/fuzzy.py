@@ -0,0 +1,148 @@
+# app/fuzzy.py
+"""
+Typo-tolerant term lookup over the term dictionary.
+
+Every term is indexed by its character trigrams, padded with "$$" on both
+sides ("cat" -> $$c $ca cat at$ t$$). One edit changes at most three trigrams,
+so a term within edit distance k of a query shares at least
+len(trigrams(query)) - 3k of its trigrams. Any term sharing that many must
+share one of the query's len(trigrams(query)) - threshold + 1 rarest trigrams,
+so only those trigrams' term sets are read ("prefix filtering"). Candidates
+are then filtered by length and by the trigrams they share, and verified
+with a Levenshtein distance that gives up as soon as it exceeds k. When the
+bound leaves nothing to require, as for short or repetitive terms at
+distance 2, every term of a compatible length is a candidate instead.
+
+The trigram sets hold references to the dictionary's term strings, so the
+index costs about one set entry per trigram of every term. Only the rarest
+trigrams' sets are read, so common trigrams such as "$$s", whose sets grow
+with the vocabulary, rarely cost a lookup anything.
+"""
+
+import os
+
+# Largest edit distance a fuzzy lookup accepts
+FUZZY_MAX_DISTANCE = 2
+
+# Whether the term dictionary keeps a trigram index for fuzzy lookups
+FUZZY_INDEX = os.getenv("INDEX_FUZZY_INDEX", "true").lower() == "true"
+
+# Most candidate terms one lookup verifies
+FUZZY_MAX_SCAN = int(os.getenv("INDEX_FUZZY_MAX_SCAN", "50000"))
+
+# Terms a fuzzy search expands a term missing from the index to
+FUZZY_EXPANSIONS = int(os.getenv("INDEX_FUZZY_EXPANSIONS", "3"))
+
+PADDING = "$$"
+
+
+def trigrams(term: str) -> set:
+    padded = f"{PADDING}{term}{PADDING}"
+    return {padded[index : index + 3] for index in range(len(padded) - 2)}
+
+
+def auto_distance(term: str, max_distance: int = FUZZY_MAX_DISTANCE) -> int:
+    """
+    The edit distance allowed for term: none up to 2 characters, 1 up to 5
+    and 2 beyond, capped at max_distance. Shorter terms have too many
+    neighbours for edits to say anything about them.
+    """
+    if len(term) < 3:
+        return 0
+    if len(term) < 6:
+        return min(1, max_distance)
+    return min(2, max_distance)
+
+
+def edit_distance(a: str, b: str, max_distance: int) -> int:
+    """Levenshtein distance of a and b, or max_distance + 1 if it is larger."""
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    previous = list(range(len(b) + 1))
+    for row, char_a in enumerate(a, 1):
+        current = [row]
+        for column, char_b in enumerate(b, 1):
+            current.append(
+                min(
+                    previous[column] + 1,
+                    current[column - 1] + 1,
+                    previous[column - 1] + (char_a != char_b),
+                )
+            )
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous = current
+    return min(previous[-1], max_distance + 1)
+
+
+class TrigramIndex:
+    """Trigram -> set of terms; the caller synchronizes access."""
+
+    def __init__(self):
+        self._terms = {}
+        self._lengths = {}  # length -> set of terms
+
+    def load(self, terms):
+        self._terms = {}
+        self._lengths = {}
+        for term in terms:
+            self.add(term)
+
+    def add(self, term: str):
+        for gram in trigrams(term):
+            self._terms.setdefault(gram, set()).add(term)
+        self._lengths.setdefault(len(term), set()).add(term)
+
+    def remove(self, term: str):
+        for gram in trigrams(term):
+            self._discard(self._terms, gram, term)
+        self._discard(self._lengths, len(term), term)
+
+    @staticmethod
+    def _discard(sets: dict, key, term: str):
+        terms = sets.get(key)
+        if terms is not None:
+            terms.discard(term)
+            if not terms:
+                del sets[key]
+
+    def _candidate_sets(self, grams: set, term: str, max_distance: int, threshold: int):
+        if threshold < 1:
+            lengths = range(len(term) - max_distance, len(term) + max_distance + 1)
+            return [self._lengths.get(length, ()) for length in lengths]
+        rarest = sorted(grams, key=lambda gram: len(self._terms.get(gram, ())))
+        return [
+            self._terms.get(gram, ()) for gram in rarest[: len(grams) - threshold + 1]
+        ]
+
+    def matches(self, term: str, max_distance: int, max_scan: int = FUZZY_MAX_SCAN):
+        """
+        Return the indexed terms within max_distance edits of term as
+        {term: distance}, with the number of candidates verified and whether
+        max_scan cut the lookup short.
+        """
+        grams = trigrams(term)
+        threshold = len(grams) - 3 * max_distance
+        matched = {}
+        seen = set()
+        truncated = False
+        for candidates in self._candidate_sets(grams, term, max_distance, threshold):
+            for candidate in candidates:
+                if candidate in seen:
+                    continue
+                if len(seen) >= max_scan:
+                    truncated = True
+                    break
+                seen.add(candidate)
+                # Length and shared trigrams are cheap to check before the
+                # distance is
+                if abs(len(candidate) - len(term)) > max_distance:
+                    continue
+                if threshold > 1 and len(grams & trigrams(candidate)) < threshold:
+                    continue
+                distance = edit_distance(term, candidate, max_distance)
+                if distance <= max_distance:
+                    matched[candidate] = distance
+            if truncated:
+                break
+        return matched, len(seen), truncated
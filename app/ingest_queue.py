@@ -0,0 +1,300 @@
+# app/ingest_queue.py
+"""
+Durable queue of index operations, for INDEX_INGEST_MODE=queue.
+
+Pings are appended to a SQLite table and acknowledged once committed; a pool
+of worker threads drains it. A worker claims one document at a time and takes
+all of its pending operations, so operations on one document run in the order
+they arrived while different documents are indexed in parallel. The claimed
+operations are folded into the one net operation they amount to (coalesce)
+before anything is fetched or written. Operations are removed from the table
+only after they were applied, so a crash replays them.
+
+Claims are recorded in the table itself (claimed_by, claimed_until), in the
+same BEGIN IMMEDIATE transaction that picks the document, so the queues of
+several server processes can share one file. A claim expires after
+INGEST_CLAIM_SECONDS, which lets another process take over the operations
+of a process that died while applying them.
+"""
+
+from collections import Counter, deque
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# "sync" indexes inside the request, "queue" acknowledges with 202 and indexes
+# in the background
+INGEST_MODE = os.getenv("INDEX_INGEST_MODE", "sync")
+if INGEST_MODE not in ("sync", "queue"):
+    raise ValueError(f"Unknown INDEX_INGEST_MODE '{INGEST_MODE}'")
+
+INGEST_QUEUE_PATH = os.getenv("INDEX_INGEST_QUEUE_PATH", "ingest_queue.db")
+INGEST_WORKERS = int(os.getenv("INDEX_INGEST_WORKERS", "4"))
+
+# A document whose operations fail is retried after INGEST_RETRY_SECONDS, and
+# its operations are dropped after INGEST_MAX_ATTEMPTS failures
+INGEST_RETRY_SECONDS = float(os.getenv("INDEX_INGEST_RETRY_SECONDS", "5"))
+INGEST_MAX_ATTEMPTS = int(os.getenv("INDEX_INGEST_MAX_ATTEMPTS", "5"))
+
+# How long a claim on a document holds before other workers may take it over
+INGEST_CLAIM_SECONDS = float(os.getenv("INDEX_INGEST_CLAIM_SECONDS", "300"))
+
+# Seconds of completed operations the reported throughput is averaged over
+THROUGHPUT_WINDOW = 60
+
+
+def coalesce(operations: list, exists: bool) -> tuple:
+    """
+    Fold a document's operations, in order, into one net operation given
+    whether the document is indexed now. Operations that would be rejected
+    at that point, such as adding an indexed document, are skipped. Returns
+    (net operation or None, number of rejected operations).
+
+        add, update, update   -> add
+        add, delete           -> None
+        delete, add           -> update
+    """
+    indexed = exists
+    changed = False
+    rejected = 0
+    for operation in operations:
+        if operation == "add" and not indexed:
+            indexed = changed = True
+        elif operation == "update" and indexed:
+            changed = True
+        elif operation == "delete" and indexed:
+            indexed = changed = False
+        else:
+            rejected += 1
+    if indexed and not exists:
+        return "add", rejected
+    if exists and not indexed:
+        return "delete", rejected
+    if indexed and changed:
+        return "update", rejected
+    return None, rejected
+
+
+class IngestQueue:
+    """The queue table and its worker pool."""
+
+    def __init__(self, path: str = INGEST_QUEUE_PATH):
+        self.path = path
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=FULL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS operations ("
+            "seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "document_id TEXT NOT NULL, "
+            "operation TEXT NOT NULL, "
+            "enqueued REAL NOT NULL, "
+            "attempts INTEGER NOT NULL DEFAULT 0, "
+            "retry_at REAL NOT NULL DEFAULT 0, "
+            "claimed_by TEXT, "
+            "claimed_until REAL NOT NULL DEFAULT 0)"
+        )
+        # Queue files created before claims were recorded in the table
+        columns = {
+            row[1] for row in self._connection.execute("PRAGMA table_info(operations)")
+        }
+        for column, definition in (
+            ("retry_at", "REAL NOT NULL DEFAULT 0"),
+            ("claimed_by", "TEXT"),
+            ("claimed_until", "REAL NOT NULL DEFAULT 0"),
+        ):
+            if column not in columns:
+                self._connection.execute(
+                    f"ALTER TABLE operations ADD COLUMN {column} {definition}"
+                )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS by_document ON operations (document_id, seq)"
+        )
+        self._connection.commit()
+
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+        self._active = set()  # documents claimed by this process's workers
+        self._completed = deque()  # (monotonic time, operations) of recent work
+        self.counters = Counter()
+        self._workers = []
+        self._stopping = False
+
+    def enqueue(self, operations: list):
+        """Durably append (document_id, operation) pairs."""
+        now = time.time()
+        with self._available:
+            self._connection.executemany(
+                "INSERT INTO operations (document_id, operation, enqueued) "
+                "VALUES (?, ?, ?)",
+                [
+                    (document_id, operation, now)
+                    for document_id, operation in operations
+                ],
+            )
+            self._connection.commit()
+            self.counters["enqueued"] += len(operations)
+            self._available.notify(len(operations))
+
+    def _claim(self):
+        """
+        Claim the document with the oldest pending operation that no worker
+        of any process holds and that is not waiting for a retry.
+        """
+        now = time.time()
+        self._connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = self._connection.execute(
+                "SELECT document_id FROM operations AS pending WHERE NOT EXISTS ("
+                "SELECT 1 FROM operations AS held "
+                "WHERE held.document_id = pending.document_id "
+                "AND (held.claimed_until > ? OR held.retry_at > ?)) "
+                "ORDER BY seq LIMIT 1",
+                (now, now),
+            ).fetchone()
+            if row is None:
+                self._connection.commit()
+                return None
+            document_id = row[0]
+            rows = self._connection.execute(
+                "SELECT seq, operation, attempts FROM operations "
+                "WHERE document_id = ? ORDER BY seq",
+                (document_id,),
+            ).fetchall()
+            self._connection.execute(
+                "UPDATE operations SET claimed_by = ?, claimed_until = ? "
+                "WHERE document_id = ? AND seq <= ?",
+                (self.owner, now + INGEST_CLAIM_SECONDS, document_id, rows[-1][0]),
+            )
+            self._connection.commit()
+        except BaseException:
+            self._connection.rollback()
+            raise
+        self._active.add(document_id)
+        return document_id, rows
+
+    def _finish(self, document_id: str, rows: list, remove: bool, counts: dict):
+        # Rows another process took over after our claim expired are its own
+        sequences = [(seq, self.owner) for seq, _, _ in rows]
+        with self._available:
+            self.counters.update(counts)
+            if remove:
+                self._connection.executemany(
+                    "DELETE FROM operations WHERE seq = ? AND claimed_by = ?",
+                    sequences,
+                )
+                self._completed.append((time.monotonic(), len(rows)))
+            else:
+                retry_at = time.time() + INGEST_RETRY_SECONDS
+                self._connection.executemany(
+                    "UPDATE operations SET attempts = attempts + 1, retry_at = ?, "
+                    "claimed_by = NULL, claimed_until = 0 "
+                    "WHERE seq = ? AND claimed_by = ?",
+                    [(retry_at, *sequence) for sequence in sequences],
+                )
+            self._connection.commit()
+            self._active.discard(document_id)
+            # Operations that arrived meanwhile are claimable again
+            self._available.notify()
+
+    def _work(self, process):
+        while True:
+            with self._available:
+                claimed = None
+                while not self._stopping:
+                    claimed = self._claim()
+                    if claimed is not None:
+                        break
+                    self._available.wait(INGEST_RETRY_SECONDS)
+                if claimed is None:
+                    return
+            document_id, rows = claimed
+            try:
+                outcome = process(document_id, [operation for _, operation, _ in rows])
+            except Exception as e:
+                attempts = max(attempts for _, _, attempts in rows) + 1
+                if attempts >= INGEST_MAX_ATTEMPTS:
+                    logger.error(
+                        f"Dropping {len(rows)} queued operations on {document_id} "
+                        f"after {attempts} failed attempts: {e}"
+                    )
+                    self._finish(document_id, rows, True, {"dropped": len(rows)})
+                else:
+                    logger.warning(
+                        f"Queued operations on {document_id} failed, retrying: {e}"
+                    )
+                    self._finish(document_id, rows, False, {"failed": 1})
+                continue
+            self._finish(document_id, rows, True, outcome)
+
+    def start(self, process, workers: int = INGEST_WORKERS):
+        """
+        Start draining the queue with workers threads. process(document_id,
+        operations) applies a document's operations and returns counts such
+        as {"applied": 1, "coalesced": 2}.
+        """
+        self._stopping = False
+        for number in range(workers):
+            worker = threading.Thread(
+                target=self._work, args=(process,), name=f"ingest-{number}", daemon=True
+            )
+            worker.start()
+            self._workers.append(worker)
+        logger.info(f"Started {workers} ingestion workers on {self.path}.")
+
+    def stop(self):
+        """Let the workers finish their current document and stop them."""
+        with self._available:
+            self._stopping = True
+            self._available.notify_all()
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+    def close(self):
+        self.stop()
+        with self._lock:
+            self._connection.close()
+
+    def wait_until_empty(self, timeout: float = None) -> bool:
+        """Block until every queued operation was processed or dropped."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                pending = self._connection.execute(
+                    "SELECT COUNT(*) FROM operations"
+                ).fetchone()[0]
+            if not pending:
+                return True
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.01)
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            depth, documents, oldest, claimed = self._connection.execute(
+                "SELECT COUNT(*), COUNT(DISTINCT document_id), MIN(enqueued), "
+                "COUNT(DISTINCT CASE WHEN claimed_until > ? THEN document_id END) "
+                "FROM operations",
+                (time.time(),),
+            ).fetchone()
+            while self._completed and self._completed[0][0] < now - THROUGHPUT_WINDOW:
+                self._completed.popleft()
+            completed = sum(count for _, count in self._completed)
+            return {
+                "depth": depth,
+                "documents": documents,
+                "in_flight": len(self._active),
+                "claimed": claimed,
+                "lag_seconds": round(time.time() - oldest, 3) if oldest else 0.0,
+                "operations_per_second": round(completed / THROUGHPUT_WINDOW, 2),
+                "workers": len(self._workers),
+                **self.counters,
+            }
@@ -1,18 +1,63 @@
 # app/main.py
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from app.api import router
 from app.db import Database
+from app.ingest_queue import INGEST_MODE, IngestQueue
+from app.services import apply_queued_operations, compact_index
+import asyncio
 import logging
 import contextlib
+import functools
+import os
 
 # Initialize Logger
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Seconds between background reconciliations of doc_stats; 0 disables them
+STATS_RECONCILE_INTERVAL = float(os.getenv("INDEX_STATS_RECONCILE_INTERVAL", "3600"))
+
+# Seconds between background compaction sweeps of the postings; 0 disables them
+COMPACTION_INTERVAL = float(os.getenv("INDEX_COMPACTION_INTERVAL", "21600"))
+
+# Seconds between polls of the shared cache invalidation log, which bounds how
+# long another worker's write can leave this worker's caches stale
+CACHE_SYNC_INTERVAL = float(os.getenv("INDEX_CACHE_SYNC_INTERVAL", "1"))
+
 # Create an instance of the Database class
 db = Database()
 
 
+async def run_periodically(interval: float, func, description: str):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await func()
+        except Exception as e:
+            logger.error(f"{description} failed: {e}")
+
+
+async def reconcile_stats():
+    report = await db.run_write(db.storage.reconcile_doc_stats)
+    if report["applied"]:
+        db.doc_stats.refresh(db)
+        db.invalidate_cached_terms([])
+    logger.info(f"Reconciled doc_stats: drift={report['drift']}")
+
+
+async def compact_postings():
+    report = await db.run_write(compact_index, db)
+    logger.info(f"Compaction reclaimed: {report}")
+
+
+async def refresh_doc_stats():
+    await db.run_read(db.doc_stats.refresh, db)
+
+
+async def sync_cache_invalidations():
+    await db.run_read(db.sync_cache_invalidations)
+
+
 @contextlib.asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup: Connect to databases
@@ -24,9 +69,63 @@ async def lifespan(app: FastAPI):
     except Exception as e:
         logger.error(f"Failed to connect to databases on startup: {e}")
         raise e
+    if INGEST_MODE == "queue":
+        db.ingest_queue = IngestQueue()
+        # Workers run the same services as the endpoints, outside any request
+        db.ingest_queue.start(
+            functools.partial(
+                apply_queued_operations, Request({"type": "http", "app": app})
+            )
+        )
+    background_tasks = []
+    if STATS_RECONCILE_INTERVAL > 0:
+        background_tasks.append(
+            asyncio.create_task(
+                run_periodically(
+                    STATS_RECONCILE_INTERVAL,
+                    reconcile_stats,
+                    "doc_stats reconciliation",
+                )
+            )
+        )
+    if COMPACTION_INTERVAL > 0:
+        background_tasks.append(
+            asyncio.create_task(
+                run_periodically(COMPACTION_INTERVAL, compact_postings, "Compaction")
+            )
+        )
+    if db.doc_stats.max_staleness > 0:
+        # Refresh twice per staleness window so reads never wait on Mongo
+        background_tasks.append(
+            asyncio.create_task(
+                run_periodically(
+                    db.doc_stats.max_staleness / 2,
+                    refresh_doc_stats,
+                    "doc_stats refresh",
+                )
+            )
+        )
+    if db.shared_cache and CACHE_SYNC_INTERVAL > 0:
+        background_tasks.append(
+            asyncio.create_task(
+                run_periodically(
+                    CACHE_SYNC_INTERVAL,
+                    sync_cache_invalidations,
+                    "Cache invalidation sync",
+                )
+            )
+        )
     try:
         yield
     finally:
+        for task in background_tasks:
+            task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+        if db.ingest_queue is not None:
+            # Unprocessed operations stay queued for the next start
+            db.ingest_queue.close()
+            db.ingest_queue = None
         # Shutdown: Close database connections
         try:
             logger.info("Closing database connections...")
@@ -0,0 +1,790 @@
+# app/postings.py
+"""
+Blocked storage for the inverted index.
+
+Each term has a small header document in inverted_index:
+
+    {"term", "df", "max_tf", "min_doc_length", "blocks": [first_doc_id, ...]}
+
+and its postings are split into blocks in posting_blocks, ordered by doc id:
+
+    {"term", "first", "count", "documents": {doc_id: {"frequency", "positions"}}}
+
+A block holds the doc ids from its "first" up to the next block's "first"; the
+first block of every term starts at "". Writes touch only the block a doc id
+falls into, and a block that grows past POSTING_BLOCK_SIZE is split in half.
+Every block write increments "version", which guards read-modify-write rewrites.
+Removals delete the blocks and term headers they leave empty, and
+compact_postings sweeps the whole index for anything left behind.
+
+With INDEX_POSTINGS_ENCODING=compact, blocks are re-encoded into the binary
+fields of app.codec ("doc_ids", "frequencies", "position_lengths",
+"positions"). Writes stay blind $set updates: new postings go into the plain
+"documents" map and removals into a "deleted" map of tombstones, both merged
+over the binary part on read, and a block is re-encoded once "pending" changes
+pass COMPACT_REENCODE_THRESHOLD. Switching the encoding back to bson requires
+rewriting existing blocks with app.rewrite_postings.
+"""
+
+from bisect import bisect_right
+from collections.abc import Mapping
+from bson import encode as bson_encode
+from pymongo import UpdateOne, InsertOne, DeleteOne, DeleteMany
+from app.codec import (
+    encode_positions,
+    decode_positions,
+    encode_posting_block,
+    iter_encoded_block,
+)
+import heapq
+import itertools
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Postings per block before it is split
+POSTING_BLOCK_SIZE = int(os.getenv("INDEX_POSTING_BLOCK_SIZE", "1024"))
+
+# Maximum number of operations sent in a single bulk_write call
+BULK_WRITE_BATCH_SIZE = int(os.getenv("INDEX_BULK_WRITE_BATCH_SIZE", "1000"))
+
+# Maximum number of terms or blocks per $in / $or query
+TERM_BATCH_SIZE = 1000
+
+# "bson" stores postings as plain arrays, "compact" as delta/varint binaries
+POSTINGS_ENCODING = os.getenv("INDEX_POSTINGS_ENCODING", "bson")
+if POSTINGS_ENCODING not in ("bson", "compact"):
+    raise ValueError(f"Unknown INDEX_POSTINGS_ENCODING '{POSTINGS_ENCODING}'")
+
+# Unencoded changes a compact block accumulates before it is re-encoded
+COMPACT_REENCODE_THRESHOLD = int(os.getenv("INDEX_COMPACT_REENCODE_THRESHOLD", "64"))
+
+# Attempts for a read-modify-write of a block that keeps changing underneath
+BLOCK_REWRITE_ATTEMPTS = 3
+
+
+class LazyPostings(Mapping):
+    """
+    Postings of one term, {doc_id: {"frequency", "positions"}}, gathered from
+    its blocks. Positions of compact blocks stay encoded until a posting is
+    looked up, and frequency() never decodes them. doc_ids() is computed once
+    and kept with the postings, so cached postings are not sorted per query.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._ordered = True  # whether _entries were added in doc-id order
+        self._last = None
+        self._doc_ids = None
+
+    def add_block(self, block: dict):
+        self._doc_ids = None
+        for document_id, entry in _iter_block_entries(block):
+            if self._ordered and self._entries and document_id <= self._last:
+                self._ordered = False
+            self._entries[document_id] = entry
+            self._last = document_id
+
+    def doc_ids(self) -> list:
+        """The doc ids in sorted order, sorting only blocks added out of order."""
+        if self._doc_ids is None:
+            if self._ordered:
+                self._doc_ids = list(self._entries)
+            else:
+                self._doc_ids = sorted(self._entries)
+        return self._doc_ids
+
+    def frequency(self, document_id: str) -> int:
+        entry = self._entries[document_id]
+        return entry[0] if isinstance(entry, tuple) else entry["frequency"]
+
+    def __getitem__(self, document_id: str) -> dict:
+        entry = self._entries[document_id]
+        if isinstance(entry, tuple):
+            entry = {"frequency": entry[0], "positions": decode_positions(entry[1])}
+            self._entries[document_id] = entry
+        return entry
+
+    def __contains__(self, document_id) -> bool:
+        return document_id in self._entries
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+def _iter_block_entries(block: dict):
+    """
+    Yield (doc_id, entry) for every live posting of a block in doc-id order,
+    where entry is a posting dict or a (frequency, encoded_positions) tuple.
+    """
+    documents = block.get("documents", {})
+    deleted = block.get("deleted", {})
+    updated = sorted(documents)
+    index = 0
+    if "doc_ids" in block:
+        for document_id, frequency, positions in iter_encoded_block(block):
+            while index < len(updated) and updated[index] < document_id:
+                yield updated[index], documents[updated[index]]
+                index += 1
+            if document_id in documents or document_id in deleted:
+                continue
+            yield document_id, (frequency, positions)
+    for document_id in updated[index:]:
+        yield document_id, documents[document_id]
+
+
+def _numbered_block_entries(number: int, block: dict):
+    for document_id, entry in _iter_block_entries(block):
+        yield document_id, number, entry
+
+
+def merge_block_entries(blocks: list):
+    """
+    Yield (doc_id, entry) for every live posting of several blocks in doc-id
+    order, decoding them as they go. A document in several blocks has the
+    entry of the last one, as with LazyPostings.
+    """
+    streams = [
+        _numbered_block_entries(number, block) for number, block in enumerate(blocks)
+    ]
+    merged = heapq.merge(*streams, key=lambda item: item[:2])
+    for document_id, entries in itertools.groupby(merged, key=lambda item: item[0]):
+        *_, (_, _, entry) = entries
+        yield document_id, entry
+
+
+def block_documents(block: dict) -> dict:
+    """Fully decoded {doc_id: posting} of a block."""
+    postings = LazyPostings()
+    postings.add_block(block)
+    return {document_id: postings[document_id] for document_id in postings}
+
+
+def block_fields(documents: dict, encoding: str = None) -> dict:
+    """The stored posting fields of a block holding documents."""
+    if (encoding or POSTINGS_ENCODING) == "compact":
+        return {
+            "encoding": "compact",
+            **encode_posting_block(documents),
+            "documents": {},
+            "deleted": {},
+            "pending": 0,
+        }
+    return {"encoding": "bson", "documents": documents}
+
+
+def forward_terms_for_storage(term_info: dict, encoding: str = None) -> dict:
+    """The forward index "terms" map, with compact positions when configured."""
+    if (encoding or POSTINGS_ENCODING) == "compact":
+        return {
+            term: {
+                "frequency": info["frequency"],
+                "positions": encode_positions(info["positions"]),
+            }
+            for term, info in term_info.items()
+        }
+    return term_info
+
+
+def decode_forward_terms(terms: dict) -> dict:
+    """Inverse of forward_terms_for_storage."""
+    return {
+        term: (
+            info
+            if isinstance(info["positions"], list)
+            else {
+                "frequency": info["frequency"],
+                "positions": decode_positions(bytes(info["positions"])),
+            }
+        )
+        for term, info in terms.items()
+    }
+
+
+def _change_for(changes: dict, term: str) -> dict:
+    return changes.setdefault(term, {"set": {}, "new": set(), "unset": set()})
+
+
+def stage_posting(
+    changes: dict, term: str, document_id: str, info: dict, doc_length, is_new=True
+):
+    """
+    Record that document_id now has posting info for term. is_new must be False
+    when the document already had a posting for the term, so df is unchanged.
+    max_tf and min_doc_length bound the BM25 score the term can contribute;
+    removals leave them in place, which only loosens the bound.
+    """
+    change = _change_for(changes, term)
+    change["set"][document_id] = info
+    if is_new:
+        change["new"].add(document_id)
+    change["max_tf"] = max(change.get("max_tf", 0), info["frequency"])
+    change["min_doc_length"] = min(change.get("min_doc_length", doc_length), doc_length)
+
+
+def stage_doc_length(changes: dict, term: str, doc_length):
+    """
+    Record that a document whose posting for term is unchanged now has
+    doc_length words, keeping the term's min_doc_length bound valid.
+    """
+    change = _change_for(changes, term)
+    change["min_doc_length"] = min(change.get("min_doc_length", doc_length), doc_length)
+
+
+def stage_removal(changes: dict, term: str, document_id: str):
+    """Record that document_id no longer has a posting for term."""
+    _change_for(changes, term)["unset"].add(document_id)
+
+
+def _block_for(boundaries: list, document_id: str) -> str:
+    return boundaries[max(bisect_right(boundaries, document_id) - 1, 0)]
+
+
+def load_term_headers(db, terms, projection=None) -> dict:
+    """Return the header of every indexed term among terms."""
+    headers = {}
+    terms = list(terms)
+    for start in range(0, len(terms), TERM_BATCH_SIZE):
+        for header in db.inverted_index_col.find(
+            {"term": {"$in": terms[start : start + TERM_BATCH_SIZE]}}, projection
+        ):
+            headers[header["term"]] = header
+    return headers
+
+
+def _bulk_write(collection, operations: list) -> int:
+    round_trips = 0
+    for start in range(0, len(operations), BULK_WRITE_BATCH_SIZE):
+        collection.bulk_write(
+            operations[start : start + BULK_WRITE_BATCH_SIZE], ordered=False
+        )
+        round_trips += 1
+    return round_trips
+
+
+def apply_posting_changes(db, changes: dict) -> dict:
+    """
+    Write staged posting changes: one update per touched block and one per term
+    header, sent as unordered bulk writes, then split any block that overflowed.
+    """
+    headers = load_term_headers(db, changes, {"_id": 0, "term": 1, "blocks": 1})
+
+    block_operations = []
+    header_operations = []
+    grown_blocks = []
+    shrunk_blocks = []
+    bytes_sent = 0
+    for term, change in changes.items():
+        header = headers.get(term)
+        if header is None and not change["set"]:
+            continue
+        boundaries = header.get("blocks", [""]) if header else [""]
+
+        compact = POSTINGS_ENCODING == "compact"
+        block_updates = {}
+
+        def block_update(document_id):
+            return block_updates.setdefault(
+                _block_for(boundaries, document_id),
+                {"$inc": {"count": 0, "version": 1, "pending": 0}},
+            )
+
+        for document_id, info in change["set"].items():
+            update = block_update(document_id)
+            update.setdefault("$set", {})[f"documents.{document_id}"] = info
+            if document_id in change["new"]:
+                update["$inc"]["count"] += 1
+            if compact:
+                update.setdefault("$unset", {})[f"deleted.{document_id}"] = ""
+                update["$inc"]["pending"] += 1
+        for document_id in change["unset"]:
+            update = block_update(document_id)
+            update.setdefault("$unset", {})[f"documents.{document_id}"] = ""
+            update["$inc"]["count"] -= 1
+            if compact:
+                update.setdefault("$set", {})[f"deleted.{document_id}"] = 1
+                update["$inc"]["pending"] += 1
+
+        for first, update in block_updates.items():
+            query = {"term": term, "first": first}
+            block_operations.append(
+                UpdateOne(query, update, upsert=update["$inc"]["count"] > 0)
+            )
+            bytes_sent += len(bson_encode({"q": query, "u": update}))
+            if update["$inc"]["count"] > 0 or update["$inc"]["pending"] > 0:
+                grown_blocks.append(query)
+            if update["$inc"]["count"] < 0:
+                shrunk_blocks.append(query)
+
+        header_update = {"$inc": {"df": len(change["new"]) - len(change["unset"])}}
+        if change["set"]:
+            header_update["$max"] = {"max_tf": change["max_tf"]}
+            header_update["$setOnInsert"] = {"blocks": [""]}
+        if "min_doc_length" in change:
+            header_update["$min"] = {"min_doc_length": change["min_doc_length"]}
+        query = {"term": term}
+        header_operations.append(
+            UpdateOne(query, header_update, upsert=bool(change["set"]))
+        )
+        bytes_sent += len(bson_encode({"q": query, "u": header_update}))
+
+    round_trips = _bulk_write(db.posting_blocks_col, block_operations)
+    round_trips += _bulk_write(db.inverted_index_col, header_operations)
+
+    splits = 0
+    reencoded = 0
+    for start in range(0, len(grown_blocks), TERM_BATCH_SIZE):
+        for block in db.posting_blocks_col.find(
+            {
+                "$and": [
+                    {"$or": grown_blocks[start : start + TERM_BATCH_SIZE]},
+                    {
+                        "$or": [
+                            {"count": {"$gt": POSTING_BLOCK_SIZE}},
+                            {"pending": {"$gt": COMPACT_REENCODE_THRESHOLD}},
+                        ]
+                    },
+                ]
+            },
+            {"_id": 0, "term": 1, "first": 1, "count": 1},
+        ):
+            if block["count"] > POSTING_BLOCK_SIZE:
+                splits += split_block(db, block["term"], block["first"])
+            else:
+                reencoded += rewrite_block(db, block["term"], block["first"])
+
+    # Collect what the removals emptied, limited to the blocks and terms touched
+    removed = _remove_empty_blocks(db, _find_empty_blocks(db, shrunk_blocks))
+    removed_terms = [term for term, change in changes.items() if change["unset"]]
+    if removed_terms:
+        removed["terms"] = _remove_empty_terms(db, removed_terms)
+
+    return {
+        "terms": len(header_operations),
+        "block_writes": len(block_operations),
+        "round_trips": round_trips,
+        "bytes_sent": bytes_sent,
+        "splits": splits,
+        "reencoded": reencoded,
+        "blocks_removed": removed["blocks"],
+        "terms_removed": removed.get("terms", 0),
+    }
+
+
+def _find_empty_blocks(db, block_queries: list) -> list:
+    empty_blocks = []
+    for start in range(0, len(block_queries), TERM_BATCH_SIZE):
+        empty_blocks.extend(
+            db.posting_blocks_col.find(
+                {
+                    "$and": [
+                        {"$or": block_queries[start : start + TERM_BATCH_SIZE]},
+                        {"count": {"$lte": 0}},
+                    ]
+                },
+                {"_id": 0, "term": 1, "first": 1},
+            )
+        )
+    return empty_blocks
+
+
+def _remove_empty_blocks(db, empty_blocks: list) -> dict:
+    """
+    Delete blocks that are still empty. A term's first block goes in one bulk
+    write; any other block is unpublished from its header only once it is
+    really gone, so a posting written into it meanwhile stays reachable.
+    """
+    first_blocks = [
+        DeleteOne({**block, "count": {"$lte": 0}})
+        for block in empty_blocks
+        if block["first"] == ""
+    ]
+    removed = 0
+    if first_blocks:
+        for start in range(0, len(first_blocks), BULK_WRITE_BATCH_SIZE):
+            result = db.posting_blocks_col.bulk_write(
+                first_blocks[start : start + BULK_WRITE_BATCH_SIZE], ordered=False
+            )
+            removed += result.deleted_count
+    for block in empty_blocks:
+        if block["first"] == "":
+            continue
+        result = db.posting_blocks_col.delete_one({**block, "count": {"$lte": 0}})
+        if result.deleted_count:
+            db.inverted_index_col.update_one(
+                {"term": block["term"]}, {"$pull": {"blocks": block["first"]}}
+            )
+            removed += 1
+    return {"blocks": removed}
+
+
+def _remove_empty_terms(db, terms: list) -> int:
+    """Delete the headers of terms among terms whose df has dropped to zero."""
+    operations = [DeleteOne({"term": term, "df": {"$lte": 0}}) for term in terms]
+    removed = 0
+    for start in range(0, len(operations), BULK_WRITE_BATCH_SIZE):
+        result = db.inverted_index_col.bulk_write(
+            operations[start : start + BULK_WRITE_BATCH_SIZE], ordered=False
+        )
+        removed += result.deleted_count
+    return removed
+
+
+def _replace_block(db, block: dict, documents: dict, encoding: str = None) -> bool:
+    """Replace a block's postings unless it was written since it was read."""
+    result = db.posting_blocks_col.replace_one(
+        {"_id": block["_id"], "version": block.get("version")},
+        {
+            "term": block["term"],
+            "first": block["first"],
+            "count": len(documents),
+            "version": block.get("version", 0) + 1,
+            **block_fields(documents, encoding),
+        },
+    )
+    return result.matched_count == 1
+
+
+def rewrite_block(db, term: str, first: str, encoding: str = None) -> int:
+    """Re-encode a block, folding pending changes into its binary fields."""
+    for _ in range(BLOCK_REWRITE_ATTEMPTS):
+        block = db.posting_blocks_col.find_one({"term": term, "first": first})
+        if not block:
+            return 0
+        if _replace_block(db, block, block_documents(block), encoding):
+            return 1
+    logger.warning(f"Gave up re-encoding block '{first}' of term '{term}'.")
+    return 0
+
+
+def split_block(db, term: str, first: str) -> int:
+    """
+    Move the upper half of an overflowing block into a new block. The new block
+    is written before it is published in the header, so readers never miss a
+    posting; a posting written concurrently into the old block's upper range
+    stays readable there and is moved back by compaction.
+    """
+    for _ in range(BLOCK_REWRITE_ATTEMPTS):
+        block = db.posting_blocks_col.find_one({"term": term, "first": first})
+        if not block:
+            return 0
+        documents = block_documents(block)
+        if len(documents) <= POSTING_BLOCK_SIZE:
+            return 0
+        document_ids = sorted(documents)
+        moved = document_ids[len(document_ids) // 2 :]
+        new_first = moved[0]
+
+        db.posting_blocks_col.replace_one(
+            {"term": term, "first": new_first},
+            {
+                "term": term,
+                "first": new_first,
+                "count": len(moved),
+                "version": 1,
+                **block_fields({d: documents[d] for d in moved}),
+            },
+            upsert=True,
+        )
+        db.inverted_index_col.update_one(
+            {"term": term, "blocks": {"$ne": new_first}},
+            {"$push": {"blocks": {"$each": [new_first], "$sort": 1}}},
+        )
+        kept = {d: documents[d] for d in document_ids[: len(document_ids) // 2]}
+        if _replace_block(db, block, kept):
+            logger.debug(
+                f"Split posting block '{first}' of term '{term}' at '{new_first}'."
+            )
+            return 1
+    logger.warning(f"Gave up splitting block '{first}' of term '{term}'.")
+    return 0
+
+
+def posting_entry(entry, positions: bool = True) -> dict:
+    """
+    The posting dict of a block entry, with only its frequency unless
+    positions is set. Encoded positions that are not needed are not decoded.
+    """
+    if isinstance(entry, tuple):
+        if not positions:
+            return {"frequency": entry[0]}
+        return {"frequency": entry[0], "positions": decode_positions(entry[1])}
+    return entry if positions else {"frequency": entry["frequency"]}
+
+
+def iter_postings(db, term: str, after: str = None, positions: bool = True):
+    """
+    Stream the postings of a term as (doc_id, posting) pairs in doc-id order,
+    reading one block at a time and starting after the doc id after.
+    """
+    query = {"term": term}
+    if after is not None:
+        # The block holding after holds the documents following it too
+        start = db.posting_blocks_col.find_one(
+            {"term": term, "first": {"$lte": after}},
+            {"_id": 0, "first": 1},
+            sort=[("first", -1)],
+        )
+        query["first"] = {"$gte": start["first"] if start else after}
+    for block in db.posting_blocks_col.find(query).sort("first", 1):
+        for document_id, entry in _iter_block_entries(block):
+            if after is not None and document_id <= after:
+                continue
+            yield document_id, posting_entry(entry, positions)
+
+
+def load_postings(db, terms) -> dict:
+    """
+    Return the LazyPostings of every indexed term among terms. Blocks are
+    read in doc-id order, so the postings need no sorting.
+    """
+    postings = {}
+    terms = list(terms)
+    for start in range(0, len(terms), TERM_BATCH_SIZE):
+        for block in db.posting_blocks_col.find(
+            {"term": {"$in": terms[start : start + TERM_BATCH_SIZE]}}
+        ).sort([("term", 1), ("first", 1)]):
+            postings.setdefault(block["term"], LazyPostings()).add_block(block)
+    return postings
+
+
+def remove_empty_postings(db) -> dict:
+    """
+    Delete every empty block and the header of every term without postings,
+    across the whole index.
+    """
+    empty_terms = [
+        header["term"]
+        for header in db.inverted_index_col.find(
+            {"df": {"$lte": 0}}, {"_id": 0, "term": 1}
+        )
+    ]
+    removed = _remove_empty_blocks(
+        db,
+        list(
+            db.posting_blocks_col.find(
+                {"count": {"$lte": 0}}, {"_id": 0, "term": 1, "first": 1}
+            )
+        ),
+    )
+    removed["terms"] = _remove_empty_terms(db, empty_terms) if empty_terms else 0
+    logger.debug(
+        f"Removed {removed['terms']} empty terms and {removed['blocks']} empty blocks."
+    )
+    return removed
+
+
+def _rebuild_header(db, term: str) -> bool:
+    """Recreate the header of a term whose blocks outlived it."""
+    documents = {}
+    firsts = []
+    for block in db.posting_blocks_col.find({"term": term}).sort("first", 1):
+        firsts.append(block["first"])
+        documents.update(_iter_block_entries(block))
+    if not documents:
+        return False
+    frequencies = (
+        entry[0] if isinstance(entry, tuple) else entry["frequency"]
+        for entry in documents.values()
+    )
+    # Without document lengths the bound falls back to 0, which is always safe
+    db.inverted_index_col.update_one(
+        {"term": term},
+        {
+            "$setOnInsert": {
+                "df": len(documents),
+                "max_tf": max(frequencies),
+                "min_doc_length": 0,
+                "blocks": firsts if firsts[0] == "" else [""] + firsts,
+            }
+        },
+        upsert=True,
+    )
+    return True
+
+
+def _relocate_postings(db, block: dict, boundaries: list) -> int:
+    """
+    Move the postings of a block that belong to other blocks of its term, such
+    as those written into the old block while it was being split. A posting
+    already present in its target block is the newer one and wins.
+    """
+    documents = block_documents(block)
+    misplaced = {}
+    for document_id, posting in documents.items():
+        target = _block_for(boundaries, document_id)
+        if target != block["first"]:
+            misplaced.setdefault(target, {})[document_id] = posting
+    if not misplaced:
+        return 0
+
+    for target, postings in misplaced.items():
+        target_block = db.posting_blocks_col.find_one(
+            {"term": block["term"], "first": target}
+        )
+        if target_block is None:
+            db.posting_blocks_col.update_one(
+                {"term": block["term"], "first": target},
+                {
+                    "$setOnInsert": {
+                        "count": len(postings),
+                        "version": 1,
+                        **block_fields(postings),
+                    }
+                },
+                upsert=True,
+            )
+        elif not _replace_block(
+            db, target_block, {**postings, **block_documents(target_block)}
+        ):
+            return 0
+
+    moved = [document_id for postings in misplaced.values() for document_id in postings]
+    remaining = {d: p for d, p in documents.items() if d not in set(moved)}
+    return len(moved) if _replace_block(db, block, remaining) else 0
+
+
+def compact_postings(db, suspects: set = None) -> dict:
+    """
+    Sweep the whole index for what the write paths leave behind:
+
+    - empty blocks and terms without postings,
+    - blocks whose term header is missing, which get the header rebuilt,
+    - blocks missing from their header's list of boundaries,
+    - postings stored in the wrong block of their term,
+    - postings of documents that are no longer in the forward index.
+
+    A document is only seen as gone when it was already among suspects, the
+    documents missing on the previous run, because an add writes its postings
+    before its forward entry. Returns what was reclaimed and the new suspects.
+    """
+    suspects = suspects or set()
+    report = {
+        "empty_terms": 0,
+        "empty_blocks": 0,
+        "headers_rebuilt": 0,
+        "boundaries_restored": 0,
+        "postings_relocated": 0,
+        "dead_postings": 0,
+    }
+    removed = remove_empty_postings(db)
+    report["empty_terms"] = removed["terms"]
+    report["empty_blocks"] = removed["blocks"]
+
+    missing = set()
+    cursor = db.posting_blocks_col.find({}).sort([("term", 1), ("first", 1)])
+    while True:
+        blocks = [block for _, block in zip(range(TERM_BATCH_SIZE), cursor)]
+        if not blocks:
+            break
+        headers = load_term_headers(
+            db, {block["term"] for block in blocks}, {"_id": 0, "term": 1, "blocks": 1}
+        )
+        placed = {}  # (term, document_id) of correctly placed postings
+        for block in blocks:
+            term = block["term"]
+            header = headers.get(term)
+            if header is None:
+                if _rebuild_header(db, term):
+                    report["headers_rebuilt"] += 1
+                    headers[term] = db.inverted_index_col.find_one(
+                        {"term": term}, {"_id": 0, "term": 1, "blocks": 1}
+                    )
+                continue
+            boundaries = header.get("blocks", [""])
+            if block["first"] not in boundaries:
+                db.inverted_index_col.update_one(
+                    {"term": term, "blocks": {"$ne": block["first"]}},
+                    {"$push": {"blocks": {"$each": [block["first"]], "$sort": 1}}},
+                )
+                report["boundaries_restored"] += 1
+                continue
+            relocated = _relocate_postings(db, block, boundaries)
+            report["postings_relocated"] += relocated
+            if relocated:
+                continue
+            for document_id, _ in _iter_block_entries(block):
+                placed[(term, document_id)] = True
+
+        document_ids = list({document_id for _, document_id in placed})
+        existing = set()
+        for start in range(0, len(document_ids), TERM_BATCH_SIZE):
+            existing.update(
+                entry["document_id"]
+                for entry in db.forward_index_col.find(
+                    {
+                        "document_id": {
+                            "$in": document_ids[start : start + TERM_BATCH_SIZE]
+                        }
+                    },
+                    {"_id": 0, "document_id": 1},
+                )
+            )
+        changes = {}
+        for term, document_id in placed:
+            if document_id in existing:
+                continue
+            missing.add(document_id)
+            if document_id in suspects:
+                stage_removal(changes, term, document_id)
+                report["dead_postings"] += 1
+        if changes:
+            applied = apply_posting_changes(db, changes)
+            report["empty_blocks"] += applied["blocks_removed"]
+            report["empty_terms"] += applied["terms_removed"]
+
+    logger.info(f"Compacted postings: {report}")
+    report["suspects"] = missing - suspects
+    return report
+
+
+def migrate_legacy_postings(db) -> int:
+    """
+    Rewrite terms stored as one inverted_index document with an embedded
+    documents map into a header and posting blocks. Safe to re-run.
+    """
+    migrated = 0
+    for entry in db.inverted_index_col.find({"documents": {"$exists": True}}):
+        term = entry["term"]
+        documents = entry.get("documents", {})
+        document_ids = sorted(documents)
+        blocks = []
+        for start in range(0, len(document_ids), POSTING_BLOCK_SIZE):
+            chunk = document_ids[start : start + POSTING_BLOCK_SIZE]
+            blocks.append(
+                {
+                    "term": term,
+                    "first": chunk[0] if start else "",
+                    "count": len(chunk),
+                    "version": 1,
+                    **block_fields(
+                        {document_id: documents[document_id] for document_id in chunk}
+                    ),
+                }
+            )
+
+        operations = [DeleteMany({"term": term})]
+        operations.extend(InsertOne(block) for block in blocks)
+        db.posting_blocks_col.bulk_write(operations, ordered=True)
+        db.inverted_index_col.update_one(
+            {"_id": entry["_id"]},
+            {
+                "$set": {
+                    "df": len(document_ids),
+                    "max_tf": entry.get(
+                        "max_tf",
+                        max((p["frequency"] for p in documents.values()), default=0),
+                    ),
+                    "min_doc_length": entry.get("min_doc_length", 0),
+                    "blocks": [block["first"] for block in blocks] or [""],
+                },
+                "$unset": {"documents": ""},
+            },
+        )
+        migrated += 1
+    logger.info(f"Migrated {migrated} terms to blocked posting storage.")
+    return migrated
@@ -0,0 +1,410 @@
+# app/query.py
+from bisect import bisect_left
+from itertools import accumulate
+import heapq
+import math
+import re
+from app.analysis import ANALYZER
+from app.utils import extract_terms
+
+OPERATORS = ("AND", "OR", "NOT")
+
+# Okapi BM25 parameters
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_TOKEN_PATTERN = re.compile(r'\(|\)|"[^"]*"?|[^\s()"]+')
+
+
+def _tokenize_query(query: str) -> list:
+    return _TOKEN_PATTERN.findall(query)
+
+
+def parse_query(query: str):
+    """
+    Parse a boolean query into a tree of tuples:
+
+        ("term", term) | ("phrase", [terms]) | ("wildcard", pattern)
+        | ("and", [children]) | ("or", [children]) | ("not", child)
+
+    Operators are the upper-case words AND, OR and NOT; adjacent operands are
+    joined with an implicit AND and double quotes delimit an exact phrase. Words
+    are normalized with extract_terms, so a word that splits into several terms
+    requires all of them, and a word the analyzer drops entirely, such as a
+    stopword, is left out of the query. A word containing * is a wildcard
+    pattern, only normalized; expand_wildcards replaces it by its terms.
+    """
+    tokens = _tokenize_query(query)
+    position = 0
+
+    def peek():
+        return tokens[position] if position < len(tokens) else None
+
+    def advance():
+        nonlocal position
+        position += 1
+        return tokens[position - 1]
+
+    def combine(kind, children):
+        children = [child for child in children if child is not None]
+        if len(children) <= 1:
+            return children[0] if children else None
+        return (kind, children)
+
+    def parse_or():
+        children = [parse_and()]
+        while peek() == "OR":
+            advance()
+            children.append(parse_and())
+        return combine("or", children)
+
+    def parse_and():
+        children = [parse_not()]
+        while peek() is not None and peek() not in ("OR", ")"):
+            if peek() == "AND":
+                advance()
+            children.append(parse_not())
+        return combine("and", children)
+
+    def parse_not():
+        if peek() == "NOT":
+            advance()
+            child = parse_not()
+            return ("not", child) if child is not None else None
+        return parse_primary()
+
+    def parse_primary():
+        token = peek()
+        if token is None:
+            raise ValueError("Unexpected end of query")
+        if token in OPERATORS or token == ")":
+            raise ValueError(f"Unexpected '{token}' in query")
+        advance()
+        if token == "(":
+            node = parse_or()
+            if peek() != ")":
+                raise ValueError("Unbalanced parentheses in query")
+            advance()
+            return node
+        if token.startswith('"'):
+            if len(token) < 2 or not token.endswith('"'):
+                raise ValueError("Unterminated phrase in query")
+            terms = extract_terms(token[1:-1])
+            if not terms:
+                raise ValueError(f"{token} contains no searchable terms")
+            return ("phrase", terms) if len(terms) > 1 else ("term", terms[0])
+        if "*" in token:
+            return ("wildcard", ANALYZER.normalize(token))
+        terms = extract_terms(token)
+        if not terms:
+            if next(ANALYZER.words(token), None) is not None:
+                return None
+            raise ValueError(f"'{token}' contains no searchable terms")
+        if len(terms) == 1:
+            return ("term", terms[0])
+        return ("and", [("term", term) for term in terms])
+
+    if not tokens:
+        raise ValueError("Empty query")
+    tree = parse_or()
+    if peek() is not None:
+        raise ValueError(f"Unexpected '{peek()}' in query")
+    if tree is None:
+        raise ValueError("Query contains no searchable terms")
+    return tree
+
+
+def expand_wildcards(node, expand):
+    """
+    Replace every wildcard of a query tree by the OR of the terms
+    expand(pattern) returns for it.
+    """
+    kind = node[0]
+    if kind == "wildcard":
+        terms = expand(node[1])
+        if len(terms) == 1:
+            return ("term", terms[0])
+        return ("or", [("term", term) for term in terms])
+    if kind == "not":
+        return ("not", expand_wildcards(node[1], expand))
+    if kind in ("and", "or"):
+        return (kind, [expand_wildcards(child, expand) for child in node[1]])
+    return node
+
+
+def has_wildcards(node) -> bool:
+    kind = node[0]
+    if kind == "wildcard":
+        return True
+    if kind == "not":
+        return has_wildcards(node[1])
+    if kind in ("and", "or"):
+        return any(has_wildcards(child) for child in node[1])
+    return False
+
+
+def query_terms(node, positive: bool = True) -> set:
+    """Collect the terms of a query tree that occur under an even number of NOTs."""
+    kind = node[0]
+    if kind == "term":
+        return {node[1]} if positive else set()
+    if kind == "phrase":
+        return set(node[1]) if positive else set()
+    if kind == "not":
+        return query_terms(node[1], not positive)
+    terms = set()
+    for child in node[1]:
+        terms |= query_terms(child, positive)
+    return terms
+
+
+def all_query_terms(node) -> set:
+    return query_terms(node, True) | query_terms(node, False)
+
+
+def _gallop(postings: list, target, low: int) -> int:
+    """Index of the first entry >= target at or after low, by exponential search."""
+    step = 1
+    high = low
+    while high < len(postings) and postings[high] < target:
+        low = high + 1
+        high += step
+        step *= 2
+    return bisect_left(postings, target, low, min(high, len(postings)))
+
+
+def intersect_postings(posting_lists: list) -> list:
+    """
+    Intersect sorted doc-id lists, starting from the shortest and galloping
+    through the longer ones, so the cost follows the rarest term.
+    """
+    if not posting_lists:
+        return []
+    ordered = sorted(posting_lists, key=len)
+    result = ordered[0]
+    for postings in ordered[1:]:
+        if not result:
+            break
+        matched = []
+        index = 0
+        for doc_id in result:
+            index = _gallop(postings, doc_id, index)
+            if index == len(postings):
+                break
+            if postings[index] == doc_id:
+                matched.append(doc_id)
+        result = matched
+    return list(result)
+
+
+def union_postings(posting_lists: list) -> list:
+    result = []
+    for doc_id in heapq.merge(*posting_lists):
+        if not result or result[-1] != doc_id:
+            result.append(doc_id)
+    return result
+
+
+def difference_postings(postings: list, excluded: list) -> list:
+    """Entries of postings that are not in excluded, galloping through excluded."""
+    result = []
+    index = 0
+    for doc_id in postings:
+        index = _gallop(excluded, doc_id, index)
+        if index == len(excluded) or excluded[index] != doc_id:
+            result.append(doc_id)
+    return result
+
+
+def phrase_matches(position_lists: list) -> list:
+    """
+    Start positions where the terms of position_lists occur consecutively, in
+    order. Each sorted position list is shifted back by its offset in the phrase
+    so that a match is a position common to all of them.
+    """
+    return intersect_postings(
+        [
+            [position - offset for position in positions]
+            for offset, positions in enumerate(position_lists)
+        ]
+    )
+
+
+def proximity_matches(position_lists: list, distance: int) -> list:
+    """
+    Start positions of windows of at most distance words after the first word
+    that contain one occurrence of every list, found with a single merge over
+    the sorted position lists.
+    """
+    if not position_lists or any(not positions for positions in position_lists):
+        return []
+    heap = [(positions[0], index, 0) for index, positions in enumerate(position_lists)]
+    heapq.heapify(heap)
+    window_end = max(position for position, _, _ in heap)
+    matches = []
+    while True:
+        window_start, index, offset = heap[0]
+        if window_end - window_start <= distance and (
+            not matches or matches[-1] != window_start
+        ):
+            matches.append(window_start)
+        offset += 1
+        if offset == len(position_lists[index]):
+            return matches
+        next_position = position_lists[index][offset]
+        window_end = max(window_end, next_position)
+        heapq.heapreplace(heap, (next_position, index, offset))
+
+
+def evaluate_query(node, postings_for, phrase_for=None) -> list:
+    """
+    Evaluate a query tree to a sorted list of doc ids. postings_for(term) must
+    return the sorted doc ids of a term and phrase_for(terms) those containing
+    the exact phrase. A NOT is only allowed as part of an AND that also has a
+    positive operand.
+    """
+    kind = node[0]
+    if kind == "term":
+        return postings_for(node[1])
+    if kind == "phrase":
+        if phrase_for is None:
+            raise ValueError("Phrases are not supported here")
+        return phrase_for(node[1])
+    if kind == "or":
+        return union_postings(
+            [evaluate_query(child, postings_for, phrase_for) for child in node[1]]
+        )
+    if kind == "and":
+        positives = [child for child in node[1] if child[0] != "not"]
+        negatives = [child[1] for child in node[1] if child[0] == "not"]
+        if not positives:
+            raise ValueError("NOT needs at least one positive term to exclude from")
+        result = intersect_postings(
+            [evaluate_query(child, postings_for, phrase_for) for child in positives]
+        )
+        for child in negatives:
+            if not result:
+                break
+            result = difference_postings(
+                result, evaluate_query(child, postings_for, phrase_for)
+            )
+        return result
+    raise ValueError("NOT needs at least one positive term to exclude from")
+
+
+def bm25_idf(doc_count: int, doc_frequency: int) -> float:
+    return math.log(1 + (doc_count - doc_frequency + 0.5) / (doc_frequency + 0.5))
+
+
+def bm25_term_score(
+    frequency: int,
+    doc_length: float,
+    idf: float,
+    avg_doc_length: float,
+    k1: float = BM25_K1,
+    b: float = BM25_B,
+) -> float:
+    length_norm = 1 - b + b * doc_length / avg_doc_length if avg_doc_length else 1
+    return idf * frequency * (k1 + 1) / (frequency + k1 * length_norm)
+
+
+class _Descending:
+    """A doc id that sorts before the ids smaller than it."""
+
+    __slots__ = ("doc_id",)
+
+    def __init__(self, doc_id):
+        self.doc_id = doc_id
+
+    def __lt__(self, other) -> bool:
+        return other.doc_id < self.doc_id
+
+    def __eq__(self, other) -> bool:
+        return self.doc_id == other.doc_id
+
+
+def top_k_maxscore(term_lists: list, k: int, doc_lengths, score, batch_size=1000):
+    """
+    Return the k best (score, doc_id) pairs, best first, using MaxScore pruning.
+
+    Each entry of term_lists is a dict with sorted "doc_ids", matching "tfs", the
+    term's "idf" and an "upper_bound" on its score in any document.
+    doc_lengths(doc_ids) returns the length of every existing document among
+    doc_ids, and score(tf, doc_length, idf) scores a single posting.
+
+    Lists are ordered by upper bound. Once k results are held, the lists whose
+    bounds together cannot beat the k-th score become non-essential: they no
+    longer produce candidates and are only probed, by galloping, while a
+    candidate can still reach the threshold. Candidates are scored in batches
+    so document lengths can be fetched batch_size at a time.
+
+    Equal scores rank by doc id. The heap root is the worst result held, the
+    largest doc id among the lowest scores, so every k keeps a prefix of the
+    same ranking and pages of it neither repeat nor skip documents.
+    """
+    lists = sorted(
+        (term_list for term_list in term_lists if term_list["doc_ids"]),
+        key=lambda term_list: term_list["upper_bound"],
+    )
+    if k <= 0 or not lists:
+        return []
+    bounds = list(accumulate(term_list["upper_bound"] for term_list in lists))
+    pointers = [0] * len(lists)
+    heap = []
+
+    while True:
+        essential = 0
+        if len(heap) == k:
+            while essential < len(lists) and bounds[essential] <= heap[0][0]:
+                essential += 1
+        if essential == len(lists):
+            break
+
+        # Next candidates in doc-id order from the essential lists
+        batch = []
+        while len(batch) < batch_size:
+            current = min(
+                (
+                    lists[i]["doc_ids"][pointers[i]]
+                    for i in range(essential, len(lists))
+                    if pointers[i] < len(lists[i]["doc_ids"])
+                ),
+                default=None,
+            )
+            if current is None:
+                break
+            matched = []
+            for i in range(essential, len(lists)):
+                doc_ids = lists[i]["doc_ids"]
+                if pointers[i] < len(doc_ids) and doc_ids[pointers[i]] == current:
+                    matched.append((i, lists[i]["tfs"][pointers[i]]))
+                    pointers[i] += 1
+            batch.append((current, matched))
+        if not batch:
+            break
+
+        lengths = doc_lengths([doc_id for doc_id, _ in batch])
+        for doc_id, matched in batch:
+            if doc_id not in lengths:
+                continue
+            doc_length = lengths[doc_id]
+            total = sum(score(tf, doc_length, lists[i]["idf"]) for i, tf in matched)
+            for j in range(essential - 1, -1, -1):
+                if len(heap) == k and total + bounds[j] <= heap[0][0]:
+                    break
+                doc_ids = lists[j]["doc_ids"]
+                index = _gallop(doc_ids, doc_id, pointers[j])
+                pointers[j] = index
+                if index < len(doc_ids) and doc_ids[index] == doc_id:
+                    total += score(lists[j]["tfs"][index], doc_length, lists[j]["idf"])
+                    pointers[j] = index + 1
+            entry = (total, _Descending(doc_id))
+            if len(heap) < k:
+                heapq.heappush(heap, entry)
+            elif heap[0] < entry:
+                heapq.heapreplace(heap, entry)
+
+    return sorted(
+        ((total, key.doc_id) for total, key in heap),
+        key=lambda item: (-item[0], item[1]),
+    )
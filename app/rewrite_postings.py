@@ -0,0 +1,116 @@
+# app/rewrite_postings.py
+"""
+Rewrite posting blocks and forward index positions into another encoding, or
+report how large the index is in each encoding.
+
+    python -m app.rewrite_postings --encoding compact --report-only
+    python -m app.rewrite_postings --encoding compact
+
+Set INDEX_POSTINGS_ENCODING to the same encoding before serving writes again.
+"""
+
+import argparse
+import logging
+
+from bson import encode as bson_encode
+
+from app.db import Database
+from app.postings import (
+    block_documents,
+    block_fields,
+    rewrite_block,
+    forward_terms_for_storage,
+    decode_forward_terms,
+)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def rewrite_posting_blocks(db, encoding: str, write: bool) -> dict:
+    report = {"documents": 0, "bytes_before": 0, "bytes_after": 0, "rewritten": 0}
+    for block in db.posting_blocks_col.find({}, batch_size=100):
+        documents = block_documents(block)
+        rewritten = {
+            "_id": block["_id"],
+            "term": block["term"],
+            "first": block["first"],
+            "count": len(documents),
+            "version": block.get("version", 0) + 1,
+            **block_fields(documents, encoding),
+        }
+        report["documents"] += 1
+        report["bytes_before"] += len(bson_encode(block))
+        report["bytes_after"] += len(bson_encode(rewritten))
+        if write:
+            report["rewritten"] += rewrite_block(
+                db, block["term"], block["first"], encoding
+            )
+    return report
+
+
+def rewrite_forward_index(db, encoding: str, write: bool) -> dict:
+    report = {"documents": 0, "bytes_before": 0, "bytes_after": 0, "rewritten": 0}
+    for entry in db.forward_index_col.find({}, batch_size=100):
+        terms = forward_terms_for_storage(
+            decode_forward_terms(entry.get("terms", {})), encoding
+        )
+        report["documents"] += 1
+        report["bytes_before"] += len(bson_encode(entry))
+        report["bytes_after"] += len(bson_encode({**entry, "terms": terms}))
+        if write:
+            db.forward_index_col.update_one(
+                {"_id": entry["_id"]}, {"$set": {"terms": terms}}
+            )
+            report["rewritten"] += 1
+    return report
+
+
+def print_report(encoding: str, reports: dict):
+    print(
+        f"{'collection':<16} {'documents':>10} {'current bytes':>14} "
+        f"{encoding + ' bytes':>14} {'ratio':>7}"
+    )
+    for name, report in reports.items():
+        ratio = (
+            report["bytes_after"] / report["bytes_before"]
+            if report["bytes_before"]
+            else 1.0
+        )
+        print(
+            f"{name:<16} {report['documents']:>10} {report['bytes_before']:>14} "
+            f"{report['bytes_after']:>14} {ratio:>7.2f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--encoding", choices=["bson", "compact"], required=True)
+    parser.add_argument(
+        "--report-only",
+        action="store_true",
+        help="Only compare sizes, do not rewrite anything",
+    )
+    args = parser.parse_args()
+
+    db = Database()
+    db.connect_to_databases()
+    try:
+        write = not args.report_only
+        reports = {
+            "posting_blocks": rewrite_posting_blocks(db, args.encoding, write),
+            "forward_index": rewrite_forward_index(db, args.encoding, write),
+        }
+        print_report(args.encoding, reports)
+        if write:
+            logger.info(
+                f"Rewrote {reports['posting_blocks']['rewritten']} posting blocks and "
+                f"{reports['forward_index']['rewritten']} forward entries "
+                f"as {args.encoding}."
+            )
+    finally:
+        db.close_database_connections()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+# app/schema.py
+"""
+Declared Mongo indexes and versioned data migrations of the index database.
+
+apply_schema runs at startup: it brings the data up to SCHEMA_VERSION by
+running the pending MIGRATIONS in order, recording each one in the
+schema_version collection, then builds the declared INDEXES and warns about
+any that are still missing. Migrations and index builds are idempotent, so a
+step interrupted halfway is simply run again.
+"""
+
+from datetime import datetime, timedelta, timezone
+from pymongo import ASCENDING, DeleteMany, IndexModel, ReturnDocument
+from pymongo.errors import DuplicateKeyError, PyMongoError
+from app.postings import migrate_legacy_postings
+from app.stats import initialize_doc_stats
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# "startup" builds missing indexes before serving, "background" builds them in
+# a separate thread and "off" only reports the missing ones
+INDEX_BUILD_MODE = os.getenv("INDEX_BUILD_INDEXES", "startup")
+if INDEX_BUILD_MODE not in ("startup", "background", "off"):
+    raise ValueError(f"Unknown INDEX_BUILD_INDEXES '{INDEX_BUILD_MODE}'")
+
+# How long one worker may hold the migration lock before another takes over
+MIGRATION_LOCK_SECONDS = 600
+
+INDEXES = {
+    "forward_index": [
+        IndexModel([("document_id", ASCENDING)], unique=True, name="document_id"),
+        IndexModel([("simhash_bands", ASCENDING)], name="simhash_bands"),
+    ],
+    "doc_metadata": [
+        IndexModel([("document_id", ASCENDING)], unique=True, name="document_id"),
+    ],
+    "inverted_index": [
+        IndexModel([("term", ASCENDING)], unique=True, name="term"),
+        IndexModel(
+            [("df", ASCENDING)],
+            name="empty_terms",
+            partialFilterExpression={"df": {"$lte": 0}},
+        ),
+    ],
+    "posting_blocks": [
+        IndexModel(
+            [("term", ASCENDING), ("first", ASCENDING)], unique=True, name="term_first"
+        ),
+        IndexModel(
+            [("count", ASCENDING)],
+            name="empty_blocks",
+            partialFilterExpression={"count": {"$lte": 0}},
+        ),
+    ],
+    "doc_stats": [
+        IndexModel([("shard", ASCENDING)], unique=True, name="shard"),
+    ],
+    "cache_invalidations": [
+        IndexModel([("created", ASCENDING)], expireAfterSeconds=3600, name="created"),
+    ],
+}
+
+
+def _migrate_legacy_postings(db):
+    if db.inverted_index_col.find_one({"documents": {"$exists": True}}, {"_id": 1}):
+        migrate_legacy_postings(db)
+
+
+def _backfill_document_metadata(db):
+    if (
+        db.doc_metadata_col.estimated_document_count() == 0
+        and db.forward_index_col.estimated_document_count() > 0
+    ):
+        db.backfill_document_metadata()
+
+
+def _dedupe_by_document_id(db):
+    """Keep the newest entry of documents indexed twice before document_id was unique."""
+    for collection in (db.forward_index_col, db.doc_metadata_col):
+        duplicates = collection.aggregate(
+            [
+                {"$group": {"_id": "$document_id", "ids": {"$push": "$_id"}}},
+                {"$match": {"ids.1": {"$exists": True}}},
+            ],
+            allowDiskUse=True,
+        )
+        operations = [
+            DeleteMany({"_id": {"$in": sorted(group["ids"])[:-1]}})
+            for group in duplicates
+        ]
+        if operations:
+            collection.bulk_write(operations, ordered=False)
+            logger.warning(
+                f"Removed duplicate entries of {len(operations)} documents "
+                f"from {collection.name}."
+            )
+
+
+# (version, name, step); append new steps, never reorder or renumber them
+MIGRATIONS = [
+    (1, "blocked_postings", _migrate_legacy_postings),
+    (2, "doc_metadata_backfill", _backfill_document_metadata),
+    (3, "doc_stats_counters", initialize_doc_stats),
+    (4, "unique_document_ids", _dedupe_by_document_id),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def schema_version(db) -> int:
+    state = db.index_db["schema_version"].find_one({"_id": "schema"})
+    return state.get("version", 0) if state else 0
+
+
+def _acquire_migration_lock(db, owner: str):
+    now = datetime.now(timezone.utc)
+    try:
+        return db.index_db["schema_version"].find_one_and_update(
+            {
+                "_id": "schema",
+                "$or": [
+                    {"locked_until": {"$exists": False}},
+                    {"locked_until": {"$lt": now}},
+                ],
+            },
+            {
+                "$set": {
+                    "locked_by": owner,
+                    "locked_until": now + timedelta(seconds=MIGRATION_LOCK_SECONDS),
+                }
+            },
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+    except DuplicateKeyError:
+        # Another worker holds the lock
+        return None
+
+
+def run_migrations(db) -> list:
+    """
+    Run the migrations newer than the recorded schema version, in order. Only
+    one worker migrates at a time; the others wait for it to finish.
+    """
+    collection = db.index_db["schema_version"]
+    owner = f"{os.getpid()}:{threading.get_ident()}"
+    deadline = time.monotonic() + MIGRATION_LOCK_SECONDS
+    while _acquire_migration_lock(db, owner) is None:
+        if schema_version(db) >= SCHEMA_VERSION:
+            return []
+        if time.monotonic() > deadline:
+            raise RuntimeError("Timed out waiting for another worker's migrations")
+        logger.info("Waiting for another worker to finish schema migrations...")
+        time.sleep(1)
+
+    applied = []
+    try:
+        current = schema_version(db)
+        for version, name, step in MIGRATIONS:
+            if version <= current:
+                continue
+            logger.info(f"Running schema migration {version}: {name}")
+            step(db)
+            collection.update_one(
+                {"_id": "schema"},
+                {
+                    "$set": {"version": version},
+                    "$push": {
+                        "applied": {
+                            "version": version,
+                            "name": name,
+                            "at": datetime.now(timezone.utc),
+                        }
+                    },
+                },
+            )
+            applied.append(name)
+    finally:
+        collection.update_one(
+            {"_id": "schema", "locked_by": owner},
+            {"$unset": {"locked_by": "", "locked_until": ""}},
+        )
+    if applied:
+        logger.info(f"Schema is now at version {SCHEMA_VERSION}.")
+    return applied
+
+
+def ensure_indexes(db) -> list:
+    """Create every declared index; existing identical indexes are left alone."""
+    created = []
+    for collection_name, indexes in INDEXES.items():
+        try:
+            created.extend(db.index_db[collection_name].create_indexes(indexes))
+        except PyMongoError as e:
+            logger.error(f"Could not build indexes on {collection_name}: {e}")
+    return created
+
+
+def missing_indexes(db) -> dict:
+    """Names of the declared indexes each collection does not have yet."""
+    missing = {}
+    for collection_name, indexes in INDEXES.items():
+        existing = set(db.index_db[collection_name].index_information())
+        names = [
+            index.document["name"]
+            for index in indexes
+            if index.document["name"] not in existing
+        ]
+        if names:
+            missing[collection_name] = names
+    return missing
+
+
+def apply_schema(db, build_mode: str = INDEX_BUILD_MODE):
+    run_migrations(db)
+
+    if build_mode == "startup":
+        ensure_indexes(db)
+    elif build_mode == "background":
+        threading.Thread(
+            target=ensure_indexes, args=(db,), name="index-build", daemon=True
+        ).start()
+
+    missing = missing_indexes(db)
+    for collection_name, names in missing.items():
+        if build_mode == "background":
+            logger.info(f"Building indexes on {collection_name}: {', '.join(names)}")
+        else:
+            logger.warning(
+                f"{collection_name} is missing required indexes: {', '.join(names)}"
+            )
@@ -0,0 +1,478 @@
+# app/segments.py
+"""
+Immutable segment files of the embedded storage backend.
+
+A segment holds a set of documents: their forward entries and the postings of
+every term they contain. It is written once, front to back, and read through a
+memory map. Integers are little endian.
+
+    header               SEGMENT_HEADER: magic, document count, total length,
+                         term count and the offsets of both dictionaries
+    postings             per term, a compact posting block (app.codec): the
+                         byte lengths of its doc ids, frequencies and position
+                         lengths, then those fields and the positions
+    documents            per document, the BSON of its metadata and of its
+                         compact forward terms
+    strings              the UTF-8 terms and doc ids the dictionaries point to
+    term dictionary      a TERM_ENTRY per term, sorted by term
+    document dictionary  a DOCUMENT_ENTRY per document, sorted by doc id
+
+Both dictionaries are fixed-width arrays searched in place, so opening a
+segment only reads its header, however large the segment is.
+
+A segment never changes once written. Documents deleted or replaced later are
+tombstoned on its LiveSegment, and merges (pick_merge, write_merged) rewrite
+several segments into one without them.
+"""
+
+from collections import Counter
+import heapq
+import itertools
+import math
+import mmap
+import os
+import struct
+
+import bson
+
+from app.codec import encode_posting_block
+from app.postings import LazyPostings, forward_terms_for_storage, decode_forward_terms
+
+SEGMENT_MAGIC = b"LSPTSEG1"
+
+# magic, documents, total length, terms, term dictionary, document dictionary
+SEGMENT_HEADER = struct.Struct("<8sQQQQQ")
+
+# term offset, term length, postings offset, postings length, df, max_tf,
+# min_doc_length
+TERM_ENTRY = struct.Struct("<QIQQIIQ")
+
+# doc id offset, doc id length, record offset, metadata length, terms length,
+# total_terms, simhash
+DOCUMENT_ENTRY = struct.Struct("<QIQIIQQ")
+
+# Byte lengths of the doc ids, frequencies and position lengths of a block
+POSTINGS_HEADER = struct.Struct("<III")
+
+# Every dictionary entry starts with the offset and length of its key
+KEY = struct.Struct("<QI")
+
+
+def encode_postings(postings: dict) -> bytes:
+    """The postings record of {doc_id: {"frequency", "positions"}}."""
+    fields = encode_posting_block(postings)
+    return b"".join(
+        (
+            POSTINGS_HEADER.pack(
+                len(fields["doc_ids"]),
+                len(fields["frequencies"]),
+                len(fields["position_lengths"]),
+            ),
+            fields["doc_ids"],
+            fields["frequencies"],
+            fields["position_lengths"],
+            fields["positions"],
+        )
+    )
+
+
+def decode_postings(record: bytes) -> dict:
+    """The compact block fields of a postings record, as read by LazyPostings."""
+    doc_ids, frequencies, position_lengths = POSTINGS_HEADER.unpack_from(record)
+    offset = POSTINGS_HEADER.size
+    fields = {}
+    for name, length in (
+        ("doc_ids", doc_ids),
+        ("frequencies", frequencies),
+        ("position_lengths", position_lengths),
+    ):
+        fields[name] = record[offset : offset + length]
+        offset += length
+    fields["positions"] = record[offset:]
+    return fields
+
+
+def document_metadata_record(entry: dict) -> bytes:
+    """The BSON metadata record of a forward entry: everything but its terms."""
+    return bson.encode(
+        {
+            name: value
+            for name, value in entry.items()
+            if name not in ("_id", "document_id", "terms")
+        }
+    )
+
+
+class SegmentWriter:
+    """
+    Write a segment to path. Terms must be added in sorted order, then
+    documents in doc-id order, and finish() completes the file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "wb")
+        self._file.write(bytes(SEGMENT_HEADER.size))
+        self._offset = SEGMENT_HEADER.size
+        self._terms = []
+        self._documents = []
+        self.total_length = 0
+
+    def _write(self, data: bytes) -> int:
+        offset = self._offset
+        self._file.write(data)
+        self._offset += len(data)
+        return offset
+
+    def add_term(self, term: str, postings: dict, min_doc_length: int):
+        if not postings:
+            return
+        self.add_raw_term(
+            term,
+            encode_postings(postings),
+            len(postings),
+            max(posting["frequency"] for posting in postings.values()),
+            min_doc_length,
+        )
+
+    def add_raw_term(
+        self, term: str, record: bytes, df: int, max_tf: int, min_doc_length: int
+    ):
+        key = term.encode("utf-8")
+        if self._terms and key <= self._terms[-1][0]:
+            raise ValueError(f"Term '{term}' added out of order")
+        offset = self._write(record)
+        self._terms.append((key, offset, len(record), df, max_tf, min_doc_length))
+
+    def add_document(self, entry: dict):
+        """Add a forward entry with plain term positions."""
+        self.add_raw_document(
+            entry["document_id"],
+            document_metadata_record(entry),
+            bson.encode(forward_terms_for_storage(entry["terms"], "compact")),
+            entry.get("total_terms", 0),
+            int(entry["simhash"], 16) if "simhash" in entry else 0,
+        )
+
+    def add_raw_document(
+        self,
+        document_id: str,
+        metadata: bytes,
+        terms: bytes,
+        total_terms: int,
+        simhash: int,
+    ):
+        key = document_id.encode("utf-8")
+        if self._documents and key <= self._documents[-1][0]:
+            raise ValueError(f"Document '{document_id}' added out of order")
+        offset = self._write(metadata)
+        self._write(terms)
+        self._documents.append(
+            (key, offset, len(metadata), len(terms), total_terms, simhash)
+        )
+        self.total_length += total_terms
+
+    def finish(self):
+        """Write the dictionaries and header, and flush the file to disk."""
+        term_keys = [self._write(term[0]) for term in self._terms]
+        document_keys = [self._write(document[0]) for document in self._documents]
+
+        term_dictionary = self._offset
+        for (key, *fields), key_offset in zip(self._terms, term_keys):
+            self._write(TERM_ENTRY.pack(key_offset, len(key), *fields))
+        document_dictionary = self._offset
+        for (key, *fields), key_offset in zip(self._documents, document_keys):
+            self._write(DOCUMENT_ENTRY.pack(key_offset, len(key), *fields))
+
+        self._file.seek(0)
+        self._file.write(
+            SEGMENT_HEADER.pack(
+                SEGMENT_MAGIC,
+                len(self._documents),
+                self.total_length,
+                len(self._terms),
+                term_dictionary,
+                document_dictionary,
+            )
+        )
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+
+    def abort(self):
+        self._file.close()
+        os.remove(self.path)
+
+
+class Segment:
+    """A segment file opened read-only through a memory map."""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as segment_file:
+            self._map = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+        (
+            magic,
+            self.document_count,
+            self.total_length,
+            self.term_count,
+            self._term_dictionary,
+            self._document_dictionary,
+        ) = SEGMENT_HEADER.unpack_from(self._map)
+        if magic != SEGMENT_MAGIC:
+            self._map.close()
+            raise ValueError(f"{path} is not a segment file")
+
+    def _key(self, dictionary: int, entry: struct.Struct, index: int) -> bytes:
+        offset, length = KEY.unpack_from(self._map, dictionary + index * entry.size)
+        return self._map[offset : offset + length]
+
+    def _lower_bound(
+        self, dictionary: int, entry: struct.Struct, count: int, key: bytes
+    ) -> int:
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if self._key(dictionary, entry, middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _find(self, dictionary: int, entry: struct.Struct, count: int, key: str):
+        key = key.encode("utf-8")
+        index = self._lower_bound(dictionary, entry, count, key)
+        if index < count and self._key(dictionary, entry, index) == key:
+            return entry.unpack_from(self._map, dictionary + index * entry.size)
+        return None
+
+    # Terms
+
+    def _term_entry(self, term: str):
+        return self._find(self._term_dictionary, TERM_ENTRY, self.term_count, term)
+
+    @staticmethod
+    def _header(term: str, entry: tuple) -> dict:
+        return {
+            "term": term,
+            "df": entry[4],
+            "max_tf": entry[5],
+            "min_doc_length": entry[6],
+        }
+
+    def term_header(self, term: str):
+        """{"term", "df", "max_tf", "min_doc_length"} of term, or None."""
+        entry = self._term_entry(term)
+        return self._header(term, entry) if entry else None
+
+    def postings_record(self, term: str):
+        entry = self._term_entry(term)
+        if entry is None:
+            return None
+        return self._map[entry[2] : entry[2] + entry[3]]
+
+    def postings_block(self, term: str):
+        """The compact block fields of term's postings, or None."""
+        record = self.postings_record(term)
+        return decode_postings(record) if record is not None else None
+
+    def iter_terms(self):
+        """Yield (header, postings record) of every term, in term order."""
+        for index in range(self.term_count):
+            entry = TERM_ENTRY.unpack_from(
+                self._map, self._term_dictionary + index * TERM_ENTRY.size
+            )
+            term = self._map[entry[0] : entry[0] + entry[1]].decode("utf-8")
+            yield self._header(term, entry), self._map[entry[2] : entry[2] + entry[3]]
+
+    # Documents
+
+    def _document_entry(self, document_id: str):
+        return self._find(
+            self._document_dictionary,
+            DOCUMENT_ENTRY,
+            self.document_count,
+            document_id,
+        )
+
+    def __contains__(self, document_id: str) -> bool:
+        return self._document_entry(document_id) is not None
+
+    def document_length(self, document_id: str):
+        entry = self._document_entry(document_id)
+        return entry[5] if entry else None
+
+    def metadata(self, document_id: str):
+        """The forward entry of document_id without its terms, or None."""
+        entry = self._document_entry(document_id)
+        if entry is None:
+            return None
+        record = bson.decode(self._map[entry[2] : entry[2] + entry[3]])
+        return {"document_id": document_id, **record}
+
+    def forward_terms(self, document_id: str):
+        """The plain forward terms of document_id, or None."""
+        entry = self._document_entry(document_id)
+        if entry is None:
+            return None
+        start = entry[2] + entry[3]
+        return decode_forward_terms(bson.decode(self._map[start : start + entry[4]]))
+
+    def _document_entries(self):
+        for index in range(self.document_count):
+            yield DOCUMENT_ENTRY.unpack_from(
+                self._map, self._document_dictionary + index * DOCUMENT_ENTRY.size
+            )
+
+    def iter_documents(self):
+        """Yield (doc_id, total_terms, simhash) of every document, in doc-id order."""
+        for entry in self._document_entries():
+            yield (
+                self._map[entry[0] : entry[0] + entry[1]].decode("utf-8"),
+                entry[5],
+                entry[6],
+            )
+
+    def iter_document_records(self):
+        """
+        Yield (doc_id, total_terms, simhash, metadata record, terms record) of
+        every document, in doc-id order.
+        """
+        for entry in self._document_entries():
+            terms_start = entry[2] + entry[3]
+            yield (
+                self._map[entry[0] : entry[0] + entry[1]].decode("utf-8"),
+                entry[5],
+                entry[6],
+                self._map[entry[2] : terms_start],
+                self._map[terms_start : terms_start + entry[4]],
+            )
+
+    def close(self):
+        self._map.close()
+
+
+class DeletedAsOf:
+    """The tombstones of a LiveSegment as they were at a write generation."""
+
+    def __init__(self, deleted: dict, generation: int):
+        self._deleted = deleted
+        self._generation = generation
+
+    def __contains__(self, document_id) -> bool:
+        deleted_at = self._deleted.get(document_id)
+        return deleted_at is not None and deleted_at <= self._generation
+
+
+class LiveSegment:
+    """
+    A segment in the index and the documents deleted from it since it was
+    written. Each tombstone records the write generation that deleted it, so
+    a reader holding an older generation still sees the document.
+    """
+
+    def __init__(self, name: str, segment: Segment):
+        self.name = name
+        self.segment = segment
+        self.deleted = {}  # doc_id -> generation
+        self.df_deleted = Counter()  # term -> deleted documents containing it
+        self.deleted_length = 0
+        self.deletes_file = None
+        self.dirty = False
+        self.merging = False
+
+    def delete(self, document_id: str, generation: int):
+        self.deleted[document_id] = generation
+        self.df_deleted.update(self.segment.forward_terms(document_id).keys())
+        self.deleted_length += self.segment.document_length(document_id)
+        self.dirty = True
+
+    def is_live(self, document_id: str) -> bool:
+        return document_id not in self.deleted and document_id in self.segment
+
+    def deleted_as_of(self, generation: int) -> DeletedAsOf:
+        return DeletedAsOf(self.deleted, generation)
+
+    @property
+    def live_documents(self) -> int:
+        return self.segment.document_count - len(self.deleted)
+
+    @property
+    def live_length(self) -> int:
+        return self.segment.total_length - self.deleted_length
+
+
+def _merge_tier(documents: int, factor: int) -> int:
+    return int(math.log(max(documents, 1), factor))
+
+
+def pick_merge(segments: list, factor: int, expunge_ratio: float) -> list:
+    """
+    Choose the next merge of a tiered policy: a segment that has lost at
+    least expunge_ratio of its documents is rewritten on its own, otherwise
+    the factor smallest segments of the lowest tier holding factor segments
+    are merged. A segment's tier is the log of its live documents to base
+    factor, so each merge moves about one tier up and every document is
+    rewritten about once per tier.
+    """
+    candidates = [state for state in segments if not state.merging]
+    for state in candidates:
+        if state.deleted and (
+            len(state.deleted) >= state.segment.document_count * expunge_ratio
+        ):
+            return [state]
+    tiers = {}
+    for state in candidates:
+        tiers.setdefault(_merge_tier(state.live_documents, factor), []).append(state)
+    for tier in sorted(tiers):
+        if len(tiers[tier]) >= factor:
+            return sorted(tiers[tier], key=lambda state: state.live_documents)[:factor]
+    return []
+
+
+def _source_terms(source: tuple):
+    for header, record in source[0].iter_terms():
+        yield header["term"], header, record, source
+
+
+def _live_document_records(segment: Segment, deleted):
+    for record in segment.iter_document_records():
+        if record[0] not in deleted:
+            yield record
+
+
+def write_merged(writer: SegmentWriter, sources: list):
+    """
+    Write the live documents of several segments into one. sources holds
+    (segment, deleted, df_deleted) per segment, where deleted tests doc ids and
+    df_deleted counts the deleted documents of each term. A term found in one
+    segment and none of its deleted documents is copied without decoding.
+    """
+    terms = heapq.merge(
+        *(_source_terms(source) for source in sources), key=lambda item: item[0]
+    )
+    for term, group in itertools.groupby(terms, key=lambda item: item[0]):
+        group = list(group)
+        if len(group) == 1 and not group[0][3][2].get(term):
+            _, header, record, _ = group[0]
+            writer.add_raw_term(
+                term, record, header["df"], header["max_tf"], header["min_doc_length"]
+            )
+            continue
+        postings = LazyPostings()
+        for _, _, record, (_, deleted, _) in group:
+            postings.add_block({**decode_postings(record), "deleted": deleted})
+        writer.add_term(
+            term,
+            {document_id: postings[document_id] for document_id in postings},
+            min(header["min_doc_length"] for _, header, _, _ in group),
+        )
+
+    documents = heapq.merge(
+        *(_live_document_records(segment, deleted) for segment, deleted, _ in sources),
+        key=lambda record: record[0],
+    )
+    for document_id, total_terms, simhash, metadata, terms_record in documents:
+        writer.add_raw_document(
+            document_id, metadata, terms_record, total_terms, simhash
+        )
@@ -1,289 +1,1043 @@
 # app/services.py
 from fastapi import Request
-from app.utils import extract_terms
-from app.mocks import fetch_document_content_mock, fetch_document_metadata_mock
-from pymongo import UpdateOne
-from datetime import datetime, timezone
+from app.analysis import ANALYZER
+from app.utils import extract_terms, analyze_document
+from app.query import (
+    parse_query,
+    expand_wildcards,
+    has_wildcards,
+    query_terms,
+    all_query_terms,
+    evaluate_query,
+    intersect_postings,
+    phrase_matches,
+    proximity_matches,
+    bm25_idf,
+    bm25_term_score,
+    top_k_maxscore,
+)
+from app.postings import (
+    stage_posting,
+    stage_removal,
+    stage_doc_length,
+    LazyPostings,
+)
+from app.db import STATS_TAG
+from app.ingest_queue import coalesce
+from app.fuzzy import FUZZY_EXPANSIONS
+from app.fingerprint import (
+    SIMHASH_BANDS,
+    content_fingerprint,
+    simhash_fields,
+    hamming_distance,
+)
+from bson import encode as bson_encode
+import base64
+import heapq
+import itertools
 import logging
+import os
 
 logger = logging.getLogger(__name__)
 
+# Maximum number of document ids per $in query when fetching search metadata
+SEARCH_METADATA_BATCH_SIZE = int(os.getenv("INDEX_SEARCH_METADATA_BATCH_SIZE", "1000"))
+
+# Documents per page of /search results unless a limit is given, and the
+# largest limit accepted
+SEARCH_PAGE_SIZE = int(os.getenv("INDEX_SEARCH_PAGE_SIZE", "1000"))
+MAX_SEARCH_PAGE_SIZE = int(os.getenv("INDEX_MAX_SEARCH_PAGE_SIZE", "10000"))
+
+# What a search result can hold, selected with fields=
+SEARCH_FIELDS = ("metadata", "frequency", "positions")
+
+# Deepest result a ranked search can page to
+MAX_RANKED_RESULTS = int(os.getenv("INDEX_MAX_RANKED_RESULTS", "1000"))
+
+# Most terms accepted by one document frequency lookup
+MAX_STATS_TERMS = int(os.getenv("INDEX_MAX_STATS_TERMS", "10000"))
+
+# Terms with more postings than this are not kept in the postings cache
+POSTINGS_CACHE_MAX_DOCS = int(os.getenv("INDEX_POSTINGS_CACHE_MAX_DOCS", "100000"))
+
 
 def get_db(request: Request):
     return request.app.state.db
 
 
+def write_documents(db, changes: dict, entries=(), deleted=()) -> dict:
+    """Write through the storage backend and keep the term dictionary in step."""
+    write_stats = db.storage.write_documents(changes, entries, deleted)
+    db.term_dictionary.apply_changes(changes)
+    return write_stats
+
+
+def write_term_postings(db, forward_entry: dict) -> dict:
+    """
+    Write one new document: its postings for every distinct term and its
+    forward entry, and report the savings against one update per token
+    occurrence.
+    """
+    document_id = forward_entry["document_id"]
+    changes = {}
+    occurrences = 0
+    legacy_bytes = 0
+    for term, info in forward_entry["terms"].items():
+        stage_posting(changes, term, document_id, info, forward_entry["total_terms"])
+
+        # The per-occurrence path re-sent the growing entry once per position,
+        # so the final entry size times the frequency is an upper bound for it.
+        legacy_update = {"$set": {f"documents.{document_id}": info}}
+        occurrences += info["frequency"]
+        legacy_bytes += info["frequency"] * len(
+            bson_encode({"q": {"term": term}, "u": legacy_update})
+        )
+
+    write_stats = write_documents(db, changes, [forward_entry])
+    return {
+        "terms": len(forward_entry["terms"]),
+        "occurrences": occurrences,
+        "round_trips": write_stats["round_trips"],
+        "round_trips_saved": occurrences - write_stats["round_trips"],
+        "bytes_sent": write_stats["bytes_sent"],
+        "bytes_saved": legacy_bytes - write_stats["bytes_sent"],
+    }
+
+
+def fetch_documents_for_indexing(db, document_ids: list) -> dict:
+    """
+    Fetch content and metadata for many documents from the document source.
+    Documents that cannot be found are left out of the returned mapping.
+    """
+    return db.storage.fetch_documents(document_ids)
+
+
+def adjust_doc_stats(db, doc_count_delta: int, length_delta: int):
+    """Apply a change in document count and total length to the stats counters."""
+    db.storage.increment_doc_stats(doc_count_delta, length_delta)
+    db.doc_stats.apply(doc_count_delta, length_delta)
+    logger.info(
+        f"Adjusted doc_stats_col: docCount {doc_count_delta:+d}, "
+        f"totalLength {length_delta:+d}"
+    )
+
+
 def add_document_to_index(request: Request, document_id: str):
     db = get_db(request)
 
     # Fetch document content and metadata
-    if db.transformed_docs_col is not None:
-        try:
-            document = db.transformed_docs_col.find_one({"_id": document_id})
-            if not document:
-                raise ValueError("Document not found.")
-            document_content = document.get("text", "")
-            document_metadata = {
-                "url": document.get("url", ""),
-                "type": document.get("type", ""),
-                "text_length": document.get(
-                    "text_length", len(document_content.split())
-                ),
-            }
-        except Exception as e:
-            logger.error(f"Error fetching document: {e}")
-            raise ValueError("Failed to fetch document.")
-    else:
-        # Handle mock data
-        document_content = fetch_document_content_mock(document_id)
-        document_metadata = fetch_document_metadata_mock(document_id)
-        if not document_content or not document_metadata:
-            raise ValueError("Document not found in mock data.")
+    try:
+        fetched = fetch_documents_for_indexing(db, [document_id])
+    except Exception as e:
+        logger.error(f"Error fetching document: {e}")
+        raise ValueError("Failed to fetch document.")
+    if document_id not in fetched:
+        raise ValueError("Document not found.")
+    document_content, document_metadata = fetched[document_id]
 
-    if db.forward_index_col.find_one({"document_id": document_id}):
+    if db.storage.load_forward_entries([document_id], ()):
         raise ValueError("Document already exists.")
 
-    terms = extract_terms(document_content)
-    logger.info(f"Extracted terms for document {document_id}: {terms}")
-
-    term_info = {}
-    for position, term in enumerate(terms):
-        term_info.setdefault(term, {"frequency": 0, "positions": []})
-        term_info[term]["frequency"] += 1
-        term_info[term]["positions"].append(position)
-
-        # Update inverted index
-        db.inverted_index_col.update_one(
-            {"term": term},
-            {"$set": {f"documents.{document_id}": term_info[term]}},
-            upsert=True,
-        )
-        logger.debug(f"Indexed term '{term}' for document '{document_id}'.")
+    term_info, term_count = analyze_document(document_content)
+    logger.info(f"Extracted {term_count} terms for document {document_id}.")
 
-    # Update forward index
-    db.forward_index_col.insert_one(
-        {
-            "document_id": document_id,
-            "terms": term_info,
-            "metadata": document_metadata,
-            "total_terms": document_metadata.get("text_length", len(terms)),
-        }
+    forward_entry = {
+        "document_id": document_id,
+        "terms": term_info,
+        "metadata": document_metadata,
+        "total_terms": document_metadata.get("text_length", term_count),
+        "fingerprint": content_fingerprint(document_content, document_metadata),
+        **simhash_fields(term_info),
+    }
+    # Postings, forward index and metadata store
+    write_stats = write_term_postings(db, forward_entry)
+    logger.info(
+        f"Indexed {write_stats['terms']} distinct terms for document {document_id} "
+        f"in {write_stats['round_trips']} bulk writes "
+        f"(saved {write_stats['round_trips_saved']} round trips, "
+        f"~{write_stats['bytes_saved']} bytes)."
     )
+
     logger.info(f"Added document {document_id} to forward index.")
 
     # Update statistics using text_length
-    doc_stats = db.doc_stats_col.find_one({})
-    text_length = document_metadata.get("text_length", len(terms))
-    if doc_stats:
-        new_doc_count = doc_stats.get("docCount", 0) + 1
-        new_total_length = (
-            doc_stats.get("avgDocLength", 0.0) * doc_stats.get("docCount", 0)
-            + text_length
-        )
-        new_avg_length = new_total_length / new_doc_count if new_doc_count > 0 else 0.0
-
-        db.doc_stats_col.update_one(
-            {},
-            {
-                "$set": {
-                    "docCount": new_doc_count,
-                    "avgDocLength": new_avg_length,
-                    "last_updated": datetime.now(timezone.utc),
-                }
-            },
-        )
-        logger.info(
-            f"Updated doc_stats_col: docCount={new_doc_count}, avgDocLength={new_avg_length}"
-        )
-    else:
-        # Initialize statistics
-        db.doc_stats_col.insert_one(
-            {
-                "docCount": 1,
-                "avgDocLength": text_length,
-                "last_updated": datetime.now(timezone.utc),
-            }
-        )
-        logger.info("Initialized doc_stats_col with first document.")
+    adjust_doc_stats(db, 1, document_metadata.get("text_length", term_count))
+    db.invalidate_cached_terms(term_info, [document_id])
 
     logger.info(f"Added document {document_id} successfully.")
+    return write_stats
 
 
-def update_document_in_index(request: Request, document_id: str):
+def update_document_in_index(request: Request, document_id: str) -> dict:
+    """
+    Re-index a document by comparing its new tokenization with the terms stored
+    in the forward index. Only postings whose frequency or positions changed
+    are rewritten, terms that disappeared are removed and the statistics move
+    by the change in length.
+    """
     db = get_db(request)
-    if not db.forward_index_col.find_one({"document_id": document_id}):
+    existing = db.storage.load_forward_entries(
+        [document_id], ("terms", "total_terms", "metadata", "fingerprint")
+    ).get(document_id)
+    if not existing:
         raise ValueError("Document does not exist.")
 
-    # Fetch existing document's term count for recalculating average
-    existing_doc = db.forward_index_col.find_one({"document_id": document_id})
-    existing_total_terms = existing_doc.get("total_terms", 0)
+    try:
+        fetched = fetch_documents_for_indexing(db, [document_id])
+    except Exception as e:
+        logger.error(f"Error fetching document: {e}")
+        raise ValueError("Failed to fetch document.")
+    if document_id not in fetched:
+        raise ValueError("Document not found.")
+    document_content, document_metadata = fetched[document_id]
 
-    # Delete existing document from indexes without adjusting stats
-    delete_document_from_index(request, document_id, adjust_stats=False)
+    # Re-crawls of unchanged pages end here
+    fingerprint = content_fingerprint(document_content, document_metadata)
+    if existing.get("fingerprint") == fingerprint:
+        db.count("updates_skipped")
+        logger.info(f"Document {document_id} is unchanged; skipped update.")
+        return {"changed": 0, "removed": 0, "unchanged": None, "skipped": True}
 
-    # Add updated document
-    add_document_to_index(request, document_id)
+    term_info, term_count = analyze_document(document_content)
+    new_total_terms = document_metadata.get("text_length", term_count)
+    old_total_terms = existing.get("total_terms", 0)
+    previous = existing.get("terms", {})
 
-    # Adjust doc_stats_col based on the change in document length
-    new_doc = db.forward_index_col.find_one({"document_id": document_id})
-    new_total_terms = new_doc.get("total_terms", 0)
+    changes = {}
+    unchanged = 0
+    for term, info in term_info.items():
+        if previous.get(term) != info:
+            stage_posting(
+                changes,
+                term,
+                document_id,
+                info,
+                new_total_terms,
+                is_new=term not in previous,
+            )
+        else:
+            unchanged += 1
+            if new_total_terms < old_total_terms:
+                stage_doc_length(changes, term, new_total_terms)
+    removed = [term for term in previous if term not in term_info]
+    for term in removed:
+        stage_removal(changes, term, document_id)
 
-    doc_stats = db.doc_stats_col.find_one({})
-    if doc_stats:
-        total_length = (
-            doc_stats.get("avgDocLength", 0.0) * doc_stats.get("docCount", 0)
-            - existing_total_terms
-            + new_total_terms
-        )
-        new_avg_length = (
-            total_length / doc_stats.get("docCount", 1)
-            if doc_stats.get("docCount", 1) > 0
-            else 0.0
-        )
+    forward_entry = {
+        "document_id": document_id,
+        "terms": term_info,
+        "metadata": document_metadata,
+        "total_terms": new_total_terms,
+        "fingerprint": fingerprint,
+        **simhash_fields(term_info),
+    }
+    write_documents(db, changes, [forward_entry])
 
-        db.doc_stats_col.update_one(
-            {},
-            {
-                "$set": {
-                    "avgDocLength": new_avg_length,
-                    "last_updated": datetime.now(timezone.utc),
-                }
-            },
-        )
-        logger.info(f"Adjusted doc_stats_col: avgDocLength={new_avg_length}")
-    logger.info(f"Updated document {document_id} successfully.")
+    adjust_doc_stats(db, 0, new_total_terms - old_total_terms)
+    # Cached responses embed metadata, so a metadata change affects every term
+    if existing.get("metadata") != document_metadata:
+        db.invalidate_cached_terms(set(term_info) | set(previous), [document_id])
+    else:
+        db.invalidate_cached_terms(changes, [document_id])
+
+    db.count("updates_applied")
+    summary = {
+        "changed": len(term_info) - unchanged,
+        "removed": len(removed),
+        "unchanged": unchanged,
+        "skipped": False,
+    }
+    logger.info(
+        f"Updated document {document_id}: {summary['changed']} postings rewritten, "
+        f"{summary['removed']} removed, {summary['unchanged']} unchanged."
+    )
+    return summary
 
 
 def delete_document_from_index(
     request: Request, document_id: str, adjust_stats: bool = True
 ):
     db = get_db(request)
-    if not db.forward_index_col.find_one({"document_id": document_id}):
+    existing = db.storage.load_forward_entries(
+        [document_id], ("terms", "total_terms")
+    ).get(document_id)
+    if not existing:
         raise ValueError("Document does not exist.")
 
-    # Remove from inverted index
-    document_terms = db.forward_index_col.find_one({"document_id": document_id})[
-        "terms"
-    ]
-    bulk_operations = []
+    # Remove from inverted index, forward index and metadata store
+    document_terms = existing.get("terms", {})
+    total_terms = existing.get("total_terms", 0)
+    changes = {}
     for term in document_terms:
-        bulk_operations.append(
-            UpdateOne({"term": term}, {"$unset": {f"documents.{document_id}": ""}})
-        )
-    if bulk_operations:
-        db.inverted_index_col.bulk_write(bulk_operations)
-        logger.info(f"Removed document {document_id} from inverted index.")
+        stage_removal(changes, term, document_id)
+    write_documents(db, changes, deleted=[document_id])
+    logger.info(f"Removed document {document_id} from the index.")
+
+    # Update statistics using text_length
+    if adjust_stats:
+        adjust_doc_stats(db, -1, -total_terms)
+    db.invalidate_cached_terms(document_terms, [document_id])
+
+    logger.info(f"Deleted document {document_id} successfully.")
 
-    # Remove term entries with no documents
-    db.inverted_index_col.delete_many({"documents": {"$size": 0}})
-    logger.debug("Cleaned up inverted index.")
 
-    # Fetch total_terms before deletion for recalculating average
-    total_terms = db.forward_index_col.find_one({"document_id": document_id}).get(
-        "total_terms", 0
+def apply_batch_operations(request: Request, operations: list) -> list:
+    """
+    Apply many add/update/delete operations with one fetch per collection and
+    shared bulk writes. Operations are validated in order against the state left
+    by earlier operations in the same batch; only the net change per document is
+    written. Returns one result per operation.
+    """
+    db = get_db(request)
+    document_ids = list(dict.fromkeys(document_id for document_id, _ in operations))
+
+    # Current forward entries for every document mentioned in the batch
+    original = db.storage.load_forward_entries(
+        document_ids, ("terms", "total_terms", "fingerprint")
     )
+    fetch_ids = list(
+        dict.fromkeys(
+            document_id
+            for document_id, operation in operations
+            if operation in ("add", "update")
+        )
+    )
+    fetched = fetch_documents_for_indexing(db, fetch_ids)
 
-    # Remove from forward index
-    db.forward_index_col.delete_one({"document_id": document_id})
-    logger.info(f"Removed document {document_id} from forward index.")
+    current = dict(original)
+    results = []
+    for document_id, operation in operations:
+        try:
+            exists = current.get(document_id) is not None
+            if operation not in ("add", "update", "delete"):
+                raise ValueError("Invalid operation type")
+            if operation == "add" and exists:
+                raise ValueError("Document already exists.")
+            if operation in ("update", "delete") and not exists:
+                raise ValueError("Document does not exist.")
 
-    # Update statistics using text_length
-    if adjust_stats:
-        doc_stats = db.doc_stats_col.find_one({})
-        if doc_stats:
-            new_doc_count = doc_stats.get("docCount", 1) - 1
-            new_doc_count = max(new_doc_count, 0)
-            if new_doc_count > 0:
-                new_total_length = (
-                    doc_stats.get("avgDocLength", 0.0) * doc_stats.get("docCount", 0)
-                    - total_terms
-                )
-                new_avg_length = new_total_length / new_doc_count
+            if operation == "delete":
+                current[document_id] = None
             else:
-                new_avg_length = 0.0
-
-            db.doc_stats_col.update_one(
-                {},
+                if document_id not in fetched:
+                    raise ValueError("Document not found.")
+                document_content, document_metadata = fetched[document_id]
+                fingerprint = content_fingerprint(document_content, document_metadata)
+                if (
+                    operation == "update"
+                    and current[document_id].get("fingerprint") == fingerprint
+                ):
+                    db.count("updates_skipped")
+                    results.append(
+                        {
+                            "document_id": document_id,
+                            "operation": operation,
+                            "status": "success",
+                            "detail": "Document unchanged",
+                        }
+                    )
+                    continue
+                term_info, term_count = analyze_document(document_content)
+                current[document_id] = {
+                    "document_id": document_id,
+                    "terms": term_info,
+                    "metadata": document_metadata,
+                    "total_terms": document_metadata.get("text_length", term_count),
+                    "fingerprint": fingerprint,
+                    **simhash_fields(term_info),
+                }
+                if operation == "update":
+                    db.count("updates_applied")
+            results.append(
                 {
-                    "$set": {
-                        "docCount": new_doc_count,
-                        "avgDocLength": new_avg_length,
-                        "last_updated": datetime.now(timezone.utc),
-                    }
-                },
-            )
-            logger.info(
-                f"Updated doc_stats_col: docCount={new_doc_count}, avgDocLength={new_avg_length}"
+                    "document_id": document_id,
+                    "operation": operation,
+                    "status": "success",
+                }
             )
-        else:
-            # Initialize statistics if not present
-            db.doc_stats_col.insert_one(
+        except ValueError as ve:
+            results.append(
                 {
-                    "docCount": 0,
-                    "avgDocLength": 0.0,
-                    "last_updated": datetime.now(timezone.utc),
+                    "document_id": document_id,
+                    "operation": operation,
+                    "status": "error",
+                    "detail": str(ve),
                 }
             )
-            logger.info("Initialized doc_stats_col with zero documents.")
 
-    logger.info(f"Deleted document {document_id} successfully.")
+    # Merge the net postings changes of every document into one update per term
+    changes = {}
+    entries = []
+    deleted = []
+    doc_count_delta = 0
+    length_delta = 0
+    for document_id, final in current.items():
+        before = original.get(document_id)
+        if final is before:
+            continue
+        if final is not None:
+            previous_terms = before.get("terms", {}) if before is not None else {}
+            for term, info in final["terms"].items():
+                stage_posting(
+                    changes,
+                    term,
+                    document_id,
+                    info,
+                    final["total_terms"],
+                    is_new=term not in previous_terms,
+                )
+            entries.append(final)
+            doc_count_delta += 1
+            length_delta += final["total_terms"]
+        else:
+            deleted.append(document_id)
+        if before is not None:
+            for term in before.get("terms", {}):
+                if final is None or term not in final["terms"]:
+                    stage_removal(changes, term, document_id)
+            doc_count_delta -= 1
+            length_delta -= before.get("total_terms", 0)
 
+    if entries or deleted:
+        write_documents(db, changes, entries, deleted)
+        adjust_doc_stats(db, doc_count_delta, length_delta)
+        db.invalidate_cached_terms(changes, current)
 
-def search_documents(request: Request, term: str):
+    logger.info(
+        f"Applied batch of {len(operations)} operations: "
+        f"{len(changes)} term updates, "
+        f"{len(entries) + len(deleted)} forward index writes."
+    )
+    return results
+
+
+def fetch_metadata_entries(db, document_ids: list) -> dict:
     """
-    Search for documents containing the specified term.
+    Return doc_metadata entries for many documents, serving what it can from the
+    in-process cache and loading the rest from storage in batches.
+    """
+    entries = {}
+    missing = []
+    for document_id in document_ids:
+        entry = db.metadata_cache.get(document_id)
+        if entry is None:
+            missing.append(document_id)
+        else:
+            entries[document_id] = entry
+
+    for start in range(0, len(missing), SEARCH_METADATA_BATCH_SIZE):
+        batch = missing[start : start + SEARCH_METADATA_BATCH_SIZE]
+        for entry in db.storage.load_metadata_entries(batch).values():
+            entries[entry["document_id"]] = entry
+            db.metadata_cache.set(entry["document_id"], entry)
+    return entries
+
+
+def load_cached_postings(db, terms) -> dict:
+    """load_postings served from the postings cache where possible."""
+    postings = {}
+    missing = []
+    for term in terms:
+        cached = db.postings_cache.get(term)
+        if cached is None:
+            missing.append(term)
+        elif cached:
+            postings[term] = cached
+    if missing:
+        generation = db.postings_cache.generation()
+        loaded = db.storage.load_postings(missing)
+        for term in missing:
+            documents = loaded.get(term, LazyPostings())
+            if len(documents) <= POSTINGS_CACHE_MAX_DOCS:
+                db.postings_cache.set(term, documents, (term,), generation)
+            if term in loaded:
+                postings[term] = documents
+    return postings
+
+
+def cached_search(db, key: tuple, tags, compute):
+    """
+    Return the cached response for key, or compute and cache it tagged with the
+    terms it depends on. Responses are shared, so callers must not modify them.
+    """
+    response = db.search_cache.get(key)
+    if response is None:
+        generation = db.search_cache.generation()
+        response = compute()
+        db.search_cache.set(key, response, tags, generation)
+    return response
+
+
+def resolve_search_terms(
+    request: Request, term: str, fuzzy: bool = False, corrections: list = None
+) -> list:
+    """
+    The terms a search for term reads: term analyzed like the documents
+    were. With fuzzy, each analyzed term missing from the index is replaced
+    by its closest indexed terms, which are appended to corrections.
     """
     db = get_db(request)
-    if not term:
-        return {}
+    terms = list(dict.fromkeys(extract_terms(term)))
+    if not terms:
+        raise ValueError(f"'{term}' contains no searchable terms")
+    if not fuzzy or not db.term_dictionary.loaded:
+        return terms
+    resolved = []
+    for analyzed in terms:
+        if db.term_dictionary.df(analyzed):
+            resolved.append(analyzed)
+            continue
+        candidates, _ = db.term_dictionary.fuzzy(analyzed, limit=FUZZY_EXPANSIONS)
+        if corrections is not None:
+            corrections.extend(candidates)
+        resolved.extend(candidate["term"] for candidate in candidates)
+    return list(dict.fromkeys(resolved))
+
+
+def parse_search_fields(fields: str = None) -> tuple:
+    """The SEARCH_FIELDS named in a comma-separated fields list, all by default."""
+    if fields is None:
+        return SEARCH_FIELDS
+    selected = {field.strip() for field in fields.split(",") if field.strip()}
+    unknown = selected.difference(SEARCH_FIELDS)
+    if unknown:
+        raise ValueError(
+            f"Unknown fields {sorted(unknown)}; choose from {list(SEARCH_FIELDS)}"
+        )
+    return tuple(field for field in SEARCH_FIELDS if field in selected)
+
+
+def encode_cursor(document_id: str) -> str:
+    return base64.urlsafe_b64encode(document_id.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str = None):
+    """The doc id a cursor continues after, or None to start at the beginning."""
+    if not cursor:
+        return None
+    try:
+        return base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8")
+    except (ValueError, UnicodeError):
+        raise ValueError(f"Invalid cursor '{cursor}'")
+
+
+def _term_postings(db, term: str, after, positions: bool):
+    for document_id, posting in db.storage.iter_postings(term, after, positions):
+        yield document_id, term, posting
+
+
+def iter_search_results(
+    db,
+    terms: list,
+    after: str = None,
+    fields: tuple = SEARCH_FIELDS,
+    batch_size: int = SEARCH_METADATA_BATCH_SIZE,
+):
+    """
+    Yield (doc_id, result) for the documents containing any of terms in
+    doc-id order, starting after the doc id after. Postings are read as they
+    are needed and metadata is resolved batch_size documents at a time, so
+    memory does not grow with the number of matches.
+    """
+    posting_fields = [field for field in fields if field in ("frequency", "positions")]
+    streams = [_term_postings(db, term, after, "positions" in fields) for term in terms]
+    merged = heapq.merge(*streams, key=lambda item: item[0])
+    batch = []
+    for document_id, postings in itertools.groupby(merged, key=lambda item: item[0]):
+        matched = {term: posting for _, term, posting in postings if posting}
+        if matched:
+            batch.append((document_id, matched))
+        if len(batch) >= batch_size:
+            yield from _search_results(db, batch, fields, posting_fields)
+            batch = []
+    yield from _search_results(db, batch, fields, posting_fields)
+
+
+def _search_results(db, batch: list, fields: tuple, posting_fields: list):
+    metadata_entries = fetch_metadata_entries(db, [doc for doc, _ in batch])
+    for document_id, matched in batch:
+        if document_id not in metadata_entries:
+            continue
+        result = {}
+        if "metadata" in fields:
+            result["metadata"] = metadata_entries[document_id]["metadata"]
+        if posting_fields:
+            result["terms"] = {
+                term: {field: posting[field] for field in posting_fields}
+                for term, posting in matched.items()
+            }
+        yield document_id, result
+
+
+def search_page(
+    db, terms: list, after: str = None, limit: int = None, fields=SEARCH_FIELDS
+) -> dict:
+    """
+    Up to limit results following the doc id after, with the cursor of the
+    next page, or None when they were the last.
+    """
+    documents = {}
+    last = None
+    batch_size = SEARCH_METADATA_BATCH_SIZE
+    if limit is not None:
+        batch_size = min(limit + 1, batch_size)
+    for document_id, result in iter_search_results(
+        db, terms, after, fields, batch_size
+    ):
+        if limit is not None and len(documents) == limit:
+            return {"documents": documents, "next_cursor": encode_cursor(last)}
+        documents[document_id] = result
+        last = document_id
+    return {"documents": documents, "next_cursor": None}
+
+
+def search_documents(
+    request: Request,
+    term: str,
+    fuzzy: bool = False,
+    corrections: list = None,
+    cursor: str = None,
+    limit: int = None,
+    fields: str = None,
+) -> dict:
+    """
+    Search for documents containing the specified term, one page of limit
+    documents at a time; see resolve_search_terms for fuzzy. Without a cursor
+    or a limit every match is returned, and a cursor alone pages by
+    SEARCH_PAGE_SIZE.
+    """
+    db = get_db(request)
+    if limit is None and cursor is not None:
+        limit = SEARCH_PAGE_SIZE
+    after = decode_cursor(cursor)
+    selected = parse_search_fields(fields)
+    terms = resolve_search_terms(request, term, fuzzy, corrections)
+    if not terms:
+        return {"documents": {}, "next_cursor": None}
+    return cached_search(
+        db,
+        ("search", tuple(terms), after, limit, selected),
+        terms,
+        lambda: search_page(db, terms, after, limit, selected),
+    )
+
+
+def stream_search(
+    request: Request,
+    terms: list,
+    after: str = None,
+    limit: int = None,
+    fields=SEARCH_FIELDS,
+    batch_size: int = SEARCH_METADATA_BATCH_SIZE,
+):
+    """
+    Yield the results of a search in lists of up to batch_size
+    {"document_id", ...result}, the last one followed by {"next_cursor"}
+    when limit documents were yielded and more remain. Nothing is read
+    before a list is asked for, so each one can be read on the read executor.
+    """
+    db = get_db(request)
+    batch = []
+    count = 0
+    last = None
+    for document_id, result in iter_search_results(
+        db, terms, after, fields, batch_size
+    ):
+        if limit is not None and count == limit:
+            batch.append({"next_cursor": encode_cursor(last)})
+            break
+        batch.append({"document_id": document_id, **result})
+        count += 1
+        last = document_id
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def boolean_search(request: Request, query: str, expansions: list = None):
+    """
+    Search for documents matching a boolean query over several terms, such as
+    "python AND (fastapi OR flask) NOT django". Wildcards such as "index*" are
+    expanded with the term dictionary, and the cost report of each expansion
+    is appended to expansions.
+    """
+    db = get_db(request)
+    tree = parse_query(query)
+    tags = []
+    if has_wildcards(tree):
+        tree = expand_wildcards(
+            tree, lambda pattern: expand_wildcard(db, pattern, expansions)
+        )
+        # New terms matching a pattern change the expansion; writes drop STATS_TAG
+        tags.append(STATS_TAG)
+    terms = sorted(all_query_terms(tree))
+    return cached_search(
+        db,
+        ("boolean", query),
+        terms + tags,
+        lambda: _boolean_matches(db, query, tree, terms),
+    )
+
+
+def expand_wildcard(db, pattern: str, expansions: list = None) -> list:
+    if not db.term_dictionary.loaded:
+        raise ValueError("Wildcards need the term dictionary (INDEX_TERM_DICTIONARY)")
+    terms, cost = db.term_dictionary.expand(pattern)
+    logger.debug(f"Expanded '{pattern}': {cost}")
+    if expansions is not None:
+        expansions.append(cost)
+    return terms
 
-    # Retrieve documents for the term
-    entry = db.inverted_index_col.find_one({"term": term})
-    if entry and "documents" in entry:
-        matching_docs = set(entry["documents"].keys())
-    else:
-        matching_docs = set()
 
-    logger.debug(f"Matching documents for term '{term}': {matching_docs}")
+def _boolean_matches(db, query: str, tree, terms: list) -> dict:
+    postings = load_cached_postings(db, terms)
 
-    # Compile results
+    def postings_for(term):
+        return _sorted_doc_ids(postings, term)
+
+    def phrase_for(terms):
+        return list(match_phrase(postings, terms))
+
+    matching_docs = evaluate_query(tree, postings_for, phrase_for)
+    logger.debug(f"Boolean query '{query}' matched {len(matching_docs)} documents")
+
+    positive_terms = query_terms(tree)
+    metadata_entries = fetch_metadata_entries(db, matching_docs)
     result = {}
     for doc in matching_docs:
-        forward_entry = db.forward_index_col.find_one({"document_id": doc})
-        if forward_entry:
-            term_data = entry["documents"].get(doc)
-            if term_data:
-                result[doc] = {
-                    "metadata": forward_entry.get("metadata", {}),
-                    "terms": {term: term_data},
-                }
-    logger.debug(f"Search results: {result}")
+        if doc not in metadata_entries:
+            continue
+        result[doc] = {
+            "metadata": metadata_entries[doc]["metadata"],
+            "terms": {
+                term: postings[term][doc]
+                for term in positive_terms
+                if doc in postings.get(term, {})
+            },
+        }
     return result
 
 
-def get_document_metadata(request: Request, document_id: str):
+def _sorted_doc_ids(postings: dict, term: str) -> list:
+    documents = postings.get(term)
+    return documents.doc_ids() if documents is not None else []
+
+
+def match_phrase(postings: dict, terms: list, distance: int = None) -> dict:
+    """
+    Map each document containing terms as an exact phrase, or all of them within
+    distance words when distance is given, to the start positions of its
+    matches. Candidates are intersected first so positions are only merged for
+    documents that contain every term.
+    """
+    unique_terms = list(dict.fromkeys(terms))
+    candidates = intersect_postings(
+        [_sorted_doc_ids(postings, term) for term in unique_terms]
+    )
+    matches = {}
+    for doc in candidates:
+        if distance is None:
+            starts = phrase_matches(
+                [postings[term][doc]["positions"] for term in terms]
+            )
+        else:
+            starts = proximity_matches(
+                [postings[term][doc]["positions"] for term in unique_terms], distance
+            )
+        if starts:
+            matches[doc] = starts
+    return matches
+
+
+def phrase_search(request: Request, phrase: str, distance: int = None):
+    """
+    Search for documents containing an exact phrase, or all of its terms within
+    distance words of each other.
+    """
     db = get_db(request)
-    forward_entry = db.forward_index_col.find_one({"document_id": document_id})
-    if not forward_entry:
-        return None
+    terms = extract_terms(phrase)
+    if not terms:
+        raise ValueError("Phrase contains no searchable terms")
+    if distance is not None and distance < 0:
+        raise ValueError("Distance must not be negative")
+
+    return cached_search(
+        db,
+        ("phrase", tuple(terms), distance),
+        terms,
+        lambda: _phrase_matches(db, phrase, terms, distance),
+    )
+
+
+def _phrase_matches(db, phrase: str, terms: list, distance: int = None) -> dict:
+    postings = load_cached_postings(db, list(dict.fromkeys(terms)))
+    matches = match_phrase(postings, terms, distance)
+    logger.debug(f"Phrase '{phrase}' matched {len(matches)} documents")
+
+    # Only documents with a match reach the metadata lookup
+    metadata_entries = fetch_metadata_entries(db, list(matches))
     return {
-        "document_id": forward_entry["document_id"],
-        "total_terms": forward_entry["total_terms"],
-        "metadata": forward_entry.get("metadata", {}),
+        doc: {"metadata": metadata_entries[doc]["metadata"], "matches": starts}
+        for doc, starts in matches.items()
+        if doc in metadata_entries
     }
 
 
-def get_total_doc_statistics(request: Request):
+def ranked_search(request: Request, query: str, limit: int = 10, offset: int = 0):
+    """
+    Rank documents for a free-text query with BM25 and return one page of the
+    top offset + limit results with their scores.
+    """
+    db = get_db(request)
+    if limit < 1 or offset < 0:
+        raise ValueError("limit must be positive and offset not negative")
+    if offset + limit > MAX_RANKED_RESULTS:
+        raise ValueError(f"Cannot page past the top {MAX_RANKED_RESULTS} results")
+
+    terms = list(dict.fromkeys(extract_terms(query)))
+    if not terms:
+        raise ValueError("Query contains no searchable terms")
+
+    return cached_search(
+        db,
+        ("ranked", tuple(terms), limit, offset),
+        terms + [STATS_TAG],
+        lambda: _rank_documents(db, terms, limit, offset),
+    )
+
+
+def _rank_documents(db, terms: list, limit: int, offset: int) -> list:
+    stats = db.doc_stats.get(db)
+    doc_count = stats["docCount"]
+    avg_doc_length = stats["avgDocLength"]
+
+    headers = db.storage.load_term_headers(terms)
+    term_lists = []
+    for term, documents in load_cached_postings(db, list(headers)).items():
+        if not documents:
+            continue
+        header = headers[term]
+        doc_ids = documents.doc_ids()
+        tfs = [documents.frequency(doc) for doc in doc_ids]
+        idf = bm25_idf(max(doc_count, len(doc_ids)), len(doc_ids))
+        # Terms indexed before the bounds were stored fall back to the postings
+        upper_bound = bm25_term_score(
+            header.get("max_tf", max(tfs)),
+            header.get("min_doc_length", 0),
+            idf,
+            avg_doc_length,
+        )
+        term_lists.append(
+            {"doc_ids": doc_ids, "tfs": tfs, "idf": idf, "upper_bound": upper_bound}
+        )
+
+    metadata_entries = {}
+
+    def doc_lengths(doc_ids):
+        entries = fetch_metadata_entries(db, doc_ids)
+        metadata_entries.update(entries)
+        return {doc: entry.get("total_terms", 0) for doc, entry in entries.items()}
+
+    def score(tf, doc_length, idf):
+        return bm25_term_score(tf, doc_length, idf, avg_doc_length)
+
+    top = top_k_maxscore(
+        term_lists,
+        offset + limit,
+        doc_lengths,
+        score,
+        batch_size=SEARCH_METADATA_BATCH_SIZE,
+    )
+    return [
+        {
+            "document_id": doc,
+            "score": doc_score,
+            "metadata": metadata_entries[doc]["metadata"],
+        }
+        for doc_score, doc in top[offset : offset + limit]
+    ]
+
+
+def find_near_duplicates(
+    request: Request, document_id: str, max_distance: int = 3
+) -> list:
+    """
+    Documents whose SimHash is within max_distance bits of document_id's,
+    closest first. Candidates share at least one SimHash band, which holds for
+    every document within SIMHASH_BANDS - 1 bits.
+    """
+    db = get_db(request)
+    if not 0 <= max_distance < SIMHASH_BANDS:
+        raise ValueError(f"max_distance must be between 0 and {SIMHASH_BANDS - 1}")
+    entry = db.storage.load_forward_entries(
+        [document_id], ("simhash", "simhash_bands")
+    ).get(document_id)
+    if entry is None:
+        raise ValueError("Document does not exist.")
+    if "simhash" not in entry:
+        raise ValueError("Document has no SimHash; update it to compute one.")
+
+    signature = int(entry["simhash"], 16)
+    duplicates = []
+    for candidate in db.storage.near_duplicate_candidates(
+        document_id, entry["simhash_bands"]
+    ):
+        distance = hamming_distance(signature, int(candidate["simhash"], 16))
+        if distance <= max_distance:
+            duplicates.append(
+                {"document_id": candidate["document_id"], "distance": distance}
+            )
+    duplicates.sort(
+        key=lambda duplicate: (duplicate["distance"], duplicate["document_id"])
+    )
+    return duplicates
+
+
+def apply_queued_operations(
+    request: Request, document_id: str, operations: list
+) -> dict:
+    """
+    Apply the queued operations of one document as the single operation they
+    coalesce to, and count what became of them.
+    """
     db = get_db(request)
-    doc_stats = db.doc_stats_col.find_one({})
-    if not doc_stats:
-        return {"avgDocLength": 0.0, "docCount": 0}
+    exists = bool(db.storage.load_forward_entries([document_id], ()))
+    operation, rejected = coalesce(operations, exists)
+    counts = {
+        "coalesced": len(operations) - rejected - (operation is not None),
+        "rejected": rejected,
+    }
+    if operation is None:
+        return counts
+    try:
+        if operation == "add":
+            add_document_to_index(request, document_id)
+        elif operation == "update":
+            update_document_in_index(request, document_id)
+        else:
+            delete_document_from_index(request, document_id)
+    except ValueError as ve:
+        logger.warning(f"Queued {operation} of document {document_id} failed: {ve}")
+        counts["rejected"] += 1
+        return counts
+    counts["applied"] = 1
+    return counts
+
+
+def expand_term_pattern(request: Request, pattern: str) -> dict:
+    """The terms a wildcard pattern expands to, with the expansion's cost."""
+    db = get_db(request)
+    expansions = []
+    terms = expand_wildcard(db, ANALYZER.normalize(pattern), expansions)
     return {
-        "avgDocLength": doc_stats.get("avgDocLength", 0.0),
-        "docCount": doc_stats.get("docCount", 0),
+        "terms": {term: db.term_dictionary.df(term) for term in terms},
+        "cost": expansions[0],
     }
 
 
+def autocomplete(request: Request, prefix: str, limit: int = 10) -> dict:
+    """The limit indexed terms starting with prefix that most documents contain."""
+    db = get_db(request)
+    if not db.term_dictionary.loaded:
+        raise ValueError(
+            "Autocomplete needs the term dictionary (INDEX_TERM_DICTIONARY)"
+        )
+    prefix = ANALYZER.normalize(prefix).strip()
+    if not prefix:
+        raise ValueError("Prefix must not be empty")
+    if limit < 1:
+        raise ValueError("limit must be positive")
+    completions, cost = db.term_dictionary.complete(prefix, limit)
+    return {"prefix": prefix, "completions": completions, "cost": cost}
+
+
+def fuzzy_terms(
+    request: Request, term: str, max_distance: int = 2, limit: int = 10
+) -> dict:
+    """The indexed terms closest to a possibly misspelled term."""
+    db = get_db(request)
+    if not db.term_dictionary.loaded:
+        raise ValueError(
+            "Fuzzy lookups need the term dictionary (INDEX_TERM_DICTIONARY)"
+        )
+    term = ANALYZER.normalize(term).strip()
+    if not term:
+        raise ValueError("Term must not be empty")
+    candidates, cost = db.term_dictionary.fuzzy(term, max_distance, limit)
+    return {"term": term, "candidates": candidates, "cost": cost}
+
+
+def get_ingest_statistics(request: Request) -> dict:
+    db = get_db(request)
+    stats = dict(db.ingest_counters)
+    if db.ingest_queue is not None:
+        stats["queue"] = db.ingest_queue.stats()
+    return stats
+
+
+def compact_index(db) -> dict:
+    """
+    Run a compaction sweep, removing postings of documents that were already
+    missing from the forward index on the previous sweep.
+    """
+    report = db.storage.compact(db.compaction_suspects)
+    db.compaction_suspects = report.pop("suspects")
+    if any(report.values()):
+        # Compaction can touch any term, so drop this worker's cached results
+        db.postings_cache.clear()
+        db.search_cache.clear()
+        if db.term_dictionary.loaded:
+            db.load_term_dictionary()
+    report["suspects"] = len(db.compaction_suspects)
+    return report
+
+
+def get_document_metadata(request: Request, document_id: str):
+    db = get_db(request)
+    return fetch_metadata_entries(db, [document_id]).get(document_id)
+
+
+def get_total_doc_statistics(request: Request):
+    db = get_db(request)
+    return db.doc_stats.get(db)
+
+
+def get_term_statistics(request: Request, terms: list) -> dict:
+    """
+    Return the collection statistics together with the document frequency of
+    every term in terms, keyed as given. Each term is analyzed like a query
+    term; terms that are not indexed, or that do not analyze to exactly one
+    term, report 0.
+    """
+    db = get_db(request)
+    if len(terms) > MAX_STATS_TERMS:
+        raise ValueError(f"At most {MAX_STATS_TERMS} terms can be looked up at once")
+    analyzed = {}
+    for term in terms:
+        extracted = extract_terms(term)
+        if len(extracted) == 1:
+            analyzed[term] = extracted[0]
+    headers = db.storage.load_term_headers(set(analyzed.values()), ("df",))
+    stats = dict(db.doc_stats.get(db))
+    stats["terms"] = {}
+    for term in terms:
+        header = headers.get(analyzed.get(term))
+        stats["terms"][term] = max(header.get("df", 0), 0) if header else 0
+    return stats
+
+
+def reconcile_statistics(request: Request, apply: bool = True) -> dict:
+    db = get_db(request)
+    report = db.storage.reconcile_doc_stats(apply=apply)
+    if report["applied"]:
+        db.doc_stats.refresh(db)
+        # Ranked results depend on the corrected statistics
+        db.invalidate_cached_terms([])
+    return report
+
+
 # Helper functions remain the same
 def fetch_document_content(db, document_id: str) -> str:
     # Fetch from Document Data Store's transformed_documents collection
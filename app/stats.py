@@ -0,0 +1,188 @@
+# app/stats.py
+"""
+Collection statistics kept as atomically incremented counters.
+
+doc_stats holds DOC_STATS_SHARDS counter documents {shard, docCount,
+totalLength}. Writers $inc a randomly chosen shard, so concurrent ingestion
+never reads or overwrites another writer's totals; readers sum the shards and
+derive the average document length.
+
+Each worker also keeps a DocStatsSnapshot in memory. Its own writes are applied
+to it as they happen and it re-reads the counters at least every
+DOC_STATS_MAX_STALENESS seconds to pick up other workers' writes.
+"""
+
+from datetime import datetime, timezone
+import logging
+import os
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Number of counter documents that writes are spread across
+DOC_STATS_SHARDS = max(int(os.getenv("INDEX_DOC_STATS_SHARDS", "1")), 1)
+
+# Longest, in seconds, a worker serves in-memory stats without re-reading them
+DOC_STATS_MAX_STALENESS = float(os.getenv("INDEX_DOC_STATS_MAX_STALENESS", "1"))
+
+
+def increment_doc_stats(db, doc_count_delta: int, length_delta: int):
+    """Add to the document count and total length in a single atomic update."""
+    if not doc_count_delta and not length_delta:
+        return
+    db.doc_stats_col.update_one(
+        {"shard": random.randrange(DOC_STATS_SHARDS)},
+        {
+            "$inc": {"docCount": doc_count_delta, "totalLength": length_delta},
+            "$set": {"last_updated": datetime.now(timezone.utc)},
+        },
+        upsert=True,
+    )
+
+
+def _with_average(doc_count: int, total_length: int) -> dict:
+    return {
+        "docCount": doc_count,
+        "totalLength": total_length,
+        "avgDocLength": total_length / doc_count if doc_count > 0 else 0.0,
+    }
+
+
+def read_doc_stats(db) -> dict:
+    """Sum the counter shards into {docCount, totalLength, avgDocLength}."""
+    doc_count = 0
+    total_length = 0
+    for shard in db.doc_stats_col.find(
+        {"shard": {"$exists": True}}, {"_id": 0, "docCount": 1, "totalLength": 1}
+    ):
+        doc_count += shard.get("docCount", 0)
+        total_length += shard.get("totalLength", 0)
+    return _with_average(doc_count, total_length)
+
+
+class DocStatsSnapshot:
+    """In-memory copy of the stats counters with bounded staleness."""
+
+    def __init__(self, max_staleness: float = DOC_STATS_MAX_STALENESS):
+        self.max_staleness = max_staleness
+        self._doc_count = 0
+        self._total_length = 0
+        self._refreshed_at = None
+        self._lock = threading.Lock()
+
+    def refresh(self, db) -> dict:
+        totals = db.storage.read_doc_stats()
+        with self._lock:
+            self._doc_count = totals["docCount"]
+            self._total_length = totals["totalLength"]
+            self._refreshed_at = time.monotonic()
+        return totals
+
+    def apply(self, doc_count_delta: int, length_delta: int):
+        """Write through a change this worker has just made to the counters."""
+        with self._lock:
+            self._doc_count += doc_count_delta
+            self._total_length += length_delta
+
+    def current(self):
+        """The stats if they are fresh enough to serve, otherwise None."""
+        with self._lock:
+            if (
+                self._refreshed_at is None
+                or time.monotonic() - self._refreshed_at > self.max_staleness
+            ):
+                return None
+            return _with_average(self._doc_count, self._total_length)
+
+    def get(self, db) -> dict:
+        stats = self.current()
+        return stats if stats is not None else self.refresh(db)
+
+
+def initialize_doc_stats(db):
+    """
+    Make sure shard 0 exists and fold a legacy {docCount, avgDocLength}
+    document into the counters.
+    """
+    for legacy in list(db.doc_stats_col.find({"shard": {"$exists": False}})):
+        doc_count = legacy.get("docCount", 0)
+        total_length = round(legacy.get("avgDocLength", 0.0) * doc_count)
+        db.doc_stats_col.update_one(
+            {"shard": 0},
+            {
+                "$inc": {"docCount": doc_count, "totalLength": total_length},
+                "$set": {"last_updated": datetime.now(timezone.utc)},
+            },
+            upsert=True,
+        )
+        db.doc_stats_col.delete_one({"_id": legacy["_id"]})
+        logger.info(
+            f"Migrated legacy doc_stats: docCount={doc_count}, "
+            f"totalLength={total_length}"
+        )
+    db.doc_stats_col.update_one(
+        {"shard": 0},
+        {
+            "$setOnInsert": {
+                "docCount": 0,
+                "totalLength": 0,
+                "last_updated": datetime.now(timezone.utc),
+            }
+        },
+        upsert=True,
+    )
+
+
+def reconcile_doc_stats(db, apply: bool = True) -> dict:
+    """
+    Recompute the statistics from the forward index and report the drift of the
+    counters. With apply, the drift is added back with $inc rather than $set so
+    that concurrent updates are kept; if the counters moved while the forward
+    index was being scanned the result is not trusted and nothing is applied.
+    """
+    counted = read_doc_stats(db)
+    actual = next(
+        db.forward_index_col.aggregate(
+            [
+                {
+                    "$group": {
+                        "_id": None,
+                        "docCount": {"$sum": 1},
+                        "totalLength": {"$sum": "$total_terms"},
+                    }
+                }
+            ]
+        ),
+        {"docCount": 0, "totalLength": 0},
+    )
+    drift = {
+        "docCount": actual["docCount"] - counted["docCount"],
+        "totalLength": actual["totalLength"] - counted["totalLength"],
+    }
+    stable = read_doc_stats(db) == counted
+    applied = False
+    if apply and stable and (drift["docCount"] or drift["totalLength"]):
+        increment_doc_stats(db, drift["docCount"], drift["totalLength"])
+        applied = True
+
+    if drift["docCount"] or drift["totalLength"]:
+        logger.warning(
+            f"doc_stats drift: docCount {drift['docCount']:+d}, "
+            f"totalLength {drift['totalLength']:+d}"
+            + ("" if stable else " (counters changed during scan, not applied)")
+        )
+    return {
+        "counted": {
+            "docCount": counted["docCount"],
+            "totalLength": counted["totalLength"],
+        },
+        "actual": {
+            "docCount": actual["docCount"],
+            "totalLength": actual["totalLength"],
+        },
+        "drift": drift,
+        "stable": stable,
+        "applied": applied,
+    }
@@ -0,0 +1,1155 @@
+# app/storage.py
+"""
+Storage backends of the index.
+
+IndexStorage is everything the services need from storage: the document
+source, the forward index and its metadata, the inverted index and the
+collection statistics. INDEX_STORAGE_BACKEND selects the implementation:
+
+    mongo   MongoStorage, the blocked postings and counters in MongoDB
+    local   LocalStorage, an embedded log-structured index in
+            INDEX_LOCAL_STORAGE_PATH
+
+Forward entries cross the interface with plain term positions,
+{"document_id", "terms", "metadata", "total_terms", "fingerprint", "simhash",
+"simhash_bands"}, and postings as LazyPostings.
+"""
+
+from abc import ABC, abstractmethod
+from collections import Counter
+from datetime import datetime, timezone
+import json
+import logging
+import os
+import struct
+import threading
+import time
+
+import bson
+from pymongo import ReplaceOne, DeleteOne
+
+from app.fingerprint import simhash_bands
+from app.mocks import fetch_document_content_mock, fetch_document_metadata_mock
+from app.postings import (
+    BULK_WRITE_BATCH_SIZE,
+    TERM_BATCH_SIZE,
+    LazyPostings,
+    apply_posting_changes,
+    compact_postings,
+    decode_forward_terms,
+    forward_terms_for_storage,
+    iter_postings,
+    load_postings,
+    load_term_headers,
+    merge_block_entries,
+    posting_entry,
+)
+from app.segments import (
+    LiveSegment,
+    Segment,
+    SegmentWriter,
+    pick_merge,
+    write_merged,
+)
+from app.stats import increment_doc_stats, read_doc_stats, reconcile_doc_stats
+from app.utils import document_to_index_input
+
+logger = logging.getLogger(__name__)
+
+# "mongo" keeps the index in MongoDB, "local" in memory-mapped files on disk
+STORAGE_BACKEND = os.getenv("INDEX_STORAGE_BACKEND", "mongo")
+if STORAGE_BACKEND not in ("mongo", "local"):
+    raise ValueError(f"Unknown INDEX_STORAGE_BACKEND '{STORAGE_BACKEND}'")
+
+# Directory of the local backend's segments, write-ahead log and documents
+LOCAL_STORAGE_PATH = os.getenv("INDEX_LOCAL_STORAGE_PATH", "index_data")
+
+# Postings the local backend buffers in memory before flushing them as a
+# segment, and the longest it keeps a write buffered, in seconds
+LOCAL_FLUSH_POSTINGS = int(os.getenv("INDEX_LOCAL_FLUSH_POSTINGS", "100000"))
+LOCAL_FLUSH_INTERVAL = float(os.getenv("INDEX_LOCAL_FLUSH_INTERVAL", "60"))
+
+# Segments of one size tier that are merged together; "off" leaves merges to
+# compact()
+SEGMENT_MERGE_FACTOR = int(os.getenv("INDEX_SEGMENT_MERGE_FACTOR", "10"))
+SEGMENT_MERGES = os.getenv("INDEX_SEGMENT_MERGES", "background")
+if SEGMENT_MERGES not in ("background", "off"):
+    raise ValueError(f"Unknown INDEX_SEGMENT_MERGES '{SEGMENT_MERGES}'")
+
+# Share of deleted documents at which a segment is rewritten on its own
+SEGMENT_EXPUNGE_RATIO = 0.5
+
+# Whether every local write is fsynced before it is acknowledged
+LOCAL_SYNC_WRITES = os.getenv("INDEX_LOCAL_SYNC_WRITES", "true").lower() == "true"
+
+
+class IndexStorage(ABC):
+    """Storage of the index and of the documents it is built from."""
+
+    name = None
+
+    # Document source
+
+    @abstractmethod
+    def fetch_documents(self, document_ids: list) -> dict:
+        """{doc_id: (content, metadata)} of the documents that can be found."""
+
+    # Forward index
+
+    @abstractmethod
+    def load_forward_entries(self, document_ids: list, fields=None) -> dict:
+        """
+        {doc_id: forward entry} of the indexed documents among document_ids.
+        With fields, entries carry only those fields besides document_id.
+        """
+
+    @abstractmethod
+    def load_metadata_entries(self, document_ids: list) -> dict:
+        """{doc_id: {"document_id", "total_terms", "metadata"}}."""
+
+    @abstractmethod
+    def near_duplicate_candidates(self, document_id: str, bands: list) -> list:
+        """[{"document_id", "simhash"}] of other documents sharing a SimHash band."""
+
+    # Inverted index
+
+    @abstractmethod
+    def load_term_headers(self, terms, fields=None) -> dict:
+        """{term: {"term", "df", "max_tf", "min_doc_length", ...}}."""
+
+    @abstractmethod
+    def load_postings(self, terms) -> dict:
+        """{term: LazyPostings} of every indexed term among terms."""
+
+    @abstractmethod
+    def iter_postings(self, term: str, after: str = None, positions: bool = True):
+        """
+        Yield the (doc_id, posting) pairs of term in doc-id order, starting
+        after the doc id after. Without positions, postings only hold their
+        frequency.
+        """
+
+    @abstractmethod
+    def iter_term_frequencies(self):
+        """Yield (term, df) of every indexed term."""
+
+    # Writes
+
+    @abstractmethod
+    def write_documents(self, changes: dict, entries=(), deleted=()) -> dict:
+        """
+        Replace the forward entries of entries, delete those of deleted and
+        apply the matching posting changes staged with app.postings. Returns
+        the posting write statistics.
+        """
+
+    # Statistics
+
+    @abstractmethod
+    def increment_doc_stats(self, doc_count_delta: int, length_delta: int):
+        pass
+
+    @abstractmethod
+    def read_doc_stats(self) -> dict:
+        """{docCount, totalLength, avgDocLength}."""
+
+    @abstractmethod
+    def reconcile_doc_stats(self, apply: bool = True) -> dict:
+        """Compare the statistics with the documents; see app.stats."""
+
+    # Settings
+
+    @abstractmethod
+    def load_analyzer_config(self):
+        """The recorded configuration of the analyzer that built the index."""
+
+    @abstractmethod
+    def save_analyzer_config(self, config: dict):
+        pass
+
+    # Maintenance
+
+    @abstractmethod
+    def compact(self, suspects: set = None) -> dict:
+        """Reclaim space; the report's "suspects" feed the next call."""
+
+    def storage_stats(self) -> dict:
+        return {"backend": self.name}
+
+    # Snapshots
+
+    def create_snapshot(self) -> dict:
+        raise ValueError(f"The {self.name} storage backend has no snapshots.")
+
+    def list_snapshots(self) -> list:
+        raise ValueError(f"The {self.name} storage backend has no snapshots.")
+
+    def release_snapshot(self, name: str):
+        raise ValueError(f"The {self.name} storage backend has no snapshots.")
+
+    def close(self):
+        pass
+
+
+def _select(entry: dict, fields) -> dict:
+    if fields is None:
+        return dict(entry)
+    selected = {"document_id": entry["document_id"]}
+    for field in fields:
+        if field in entry:
+            selected[field] = entry[field]
+    return selected
+
+
+class MongoStorage(IndexStorage):
+    """The index in the collections of a connected Database."""
+
+    name = "mongo"
+
+    def __init__(self, db):
+        self.db = db
+
+    def fetch_documents(self, document_ids: list) -> dict:
+        documents = {}
+        if not document_ids:
+            return documents
+        if self.db.transformed_docs_col is not None:
+            for document in self.db.transformed_docs_col.find(
+                {"_id": {"$in": document_ids}}
+            ):
+                documents[document["_id"]] = document_to_index_input(document)
+        else:
+            # Handle mock data
+            for document_id in document_ids:
+                document_content = fetch_document_content_mock(document_id)
+                document_metadata = fetch_document_metadata_mock(document_id)
+                if document_content and document_metadata:
+                    documents[document_id] = (document_content, document_metadata)
+        return documents
+
+    def _find_by_document_ids(self, collection, document_ids: list, projection):
+        for start in range(0, len(document_ids), TERM_BATCH_SIZE):
+            yield from collection.find(
+                {"document_id": {"$in": document_ids[start : start + TERM_BATCH_SIZE]}},
+                projection,
+            )
+
+    def load_forward_entries(self, document_ids: list, fields=None) -> dict:
+        projection = {"_id": 0}
+        if fields is not None:
+            projection.update({"document_id": 1, **{field: 1 for field in fields}})
+        entries = {}
+        for entry in self._find_by_document_ids(
+            self.db.forward_index_col, list(document_ids), projection
+        ):
+            if "terms" in entry:
+                entry["terms"] = decode_forward_terms(entry["terms"])
+            entries[entry["document_id"]] = entry
+        return entries
+
+    def load_metadata_entries(self, document_ids: list) -> dict:
+        return {
+            entry["document_id"]: entry
+            for entry in self._find_by_document_ids(
+                self.db.doc_metadata_col, list(document_ids), {"_id": 0}
+            )
+        }
+
+    def near_duplicate_candidates(self, document_id: str, bands: list) -> list:
+        return list(
+            self.db.forward_index_col.find(
+                {"simhash_bands": {"$in": bands}, "document_id": {"$ne": document_id}},
+                {"_id": 0, "document_id": 1, "simhash": 1},
+            )
+        )
+
+    def load_term_headers(self, terms, fields=None) -> dict:
+        projection = None
+        if fields is not None:
+            projection = {"_id": 0, "term": 1, **{field: 1 for field in fields}}
+        return load_term_headers(self.db, terms, projection)
+
+    def load_postings(self, terms) -> dict:
+        return load_postings(self.db, terms)
+
+    def iter_postings(self, term: str, after: str = None, positions: bool = True):
+        return iter_postings(self.db, term, after, positions)
+
+    def iter_term_frequencies(self):
+        for header in self.db.inverted_index_col.find(
+            {"df": {"$gt": 0}}, {"_id": 0, "term": 1, "df": 1}
+        ):
+            yield header["term"], header["df"]
+
+    def write_documents(self, changes: dict, entries=(), deleted=()) -> dict:
+        write_stats = apply_posting_changes(self.db, changes)
+
+        forward_operations = []
+        metadata_operations = []
+        for entry in entries:
+            query = {"document_id": entry["document_id"]}
+            forward_operations.append(
+                ReplaceOne(
+                    query,
+                    {**entry, "terms": forward_terms_for_storage(entry["terms"])},
+                    upsert=True,
+                )
+            )
+            metadata_operations.append(
+                ReplaceOne(
+                    query,
+                    {
+                        "document_id": entry["document_id"],
+                        "total_terms": entry.get("total_terms", 0),
+                        "metadata": entry.get("metadata", {}),
+                    },
+                    upsert=True,
+                )
+            )
+        for document_id in deleted:
+            forward_operations.append(DeleteOne({"document_id": document_id}))
+            metadata_operations.append(DeleteOne({"document_id": document_id}))
+
+        # Forward index and metadata store change together
+        def write_entries(session):
+            for start in range(0, len(forward_operations), BULK_WRITE_BATCH_SIZE):
+                self.db.forward_index_col.bulk_write(
+                    forward_operations[start : start + BULK_WRITE_BATCH_SIZE],
+                    ordered=False,
+                    session=session,
+                )
+                self.db.doc_metadata_col.bulk_write(
+                    metadata_operations[start : start + BULK_WRITE_BATCH_SIZE],
+                    ordered=False,
+                    session=session,
+                )
+
+        if forward_operations:
+            self.db.with_transaction(write_entries)
+        return write_stats
+
+    def increment_doc_stats(self, doc_count_delta: int, length_delta: int):
+        increment_doc_stats(self.db, doc_count_delta, length_delta)
+
+    def read_doc_stats(self) -> dict:
+        return read_doc_stats(self.db)
+
+    def reconcile_doc_stats(self, apply: bool = True) -> dict:
+        return reconcile_doc_stats(self.db, apply=apply)
+
+    def load_analyzer_config(self):
+        settings = self.db.index_db["index_settings"].find_one({"_id": "analyzer"})
+        return settings["config"] if settings else None
+
+    def save_analyzer_config(self, config: dict):
+        self.db.index_db["index_settings"].replace_one(
+            {"_id": "analyzer"}, {"_id": "analyzer", "config": config}, upsert=True
+        )
+
+    def compact(self, suspects: set = None) -> dict:
+        return compact_postings(self.db, suspects)
+
+
+class JsonlDocumentSource:
+    """
+    Documents shaped like TRANSFORMED, one JSON object per line, looked up by
+    "_id" through an index of line offsets that is rebuilt when the file
+    changes.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._offsets = {}
+        self._signature = None
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            self._offsets = {}
+            self._signature = None
+            return
+        signature = (stat.st_mtime_ns, stat.st_size)
+        if signature == self._signature:
+            return
+        offsets = {}
+        offset = 0
+        with open(self.path, "rb") as source:
+            for line in source:
+                if line.strip():
+                    offsets[str(json.loads(line)["_id"])] = offset
+                offset += len(line)
+        self._offsets = offsets
+        self._signature = signature
+
+    def find(self, document_ids: list) -> dict:
+        with self._lock:
+            self._refresh()
+            offsets = {
+                document_id: self._offsets[document_id]
+                for document_id in document_ids
+                if document_id in self._offsets
+            }
+        documents = {}
+        if offsets:
+            with open(self.path, "rb") as source:
+                for document_id, offset in offsets.items():
+                    source.seek(offset)
+                    documents[document_id] = json.loads(source.readline())
+        return documents
+
+
+# Length prefix of every write-ahead log record
+WAL_RECORD = struct.Struct("<I")
+
+MANIFEST = "segments.json"
+WRITE_AHEAD_LOG = "wal.log"
+SOURCE_DOCUMENTS = "documents.jsonl"
+SNAPSHOTS = "snapshots"
+ANALYZER_CONFIG = "analyzer.json"
+
+# The single segment of indexes written before segments were appended
+LEGACY_BASE_SEGMENT = "base.seg"
+
+
+def _write_json(path: str, value):
+    """Write value to path atomically."""
+    with open(path + ".tmp", "w") as target:
+        json.dump(value, target)
+        target.flush()
+        os.fsync(target.fileno())
+    os.replace(path + ".tmp", path)
+
+
+def _read_deletes(path: str) -> list:
+    with open(path) as deletes:
+        return json.load(deletes)
+
+
+def _block_postings(blocks) -> LazyPostings:
+    postings = LazyPostings()
+    for block in blocks:
+        postings.add_block(block)
+    return postings
+
+
+class LocalStorage(IndexStorage):
+    """
+    Embedded, log-structured index in a directory.
+
+    Writes go to an in-memory buffer after being appended to a write-ahead
+    log. The buffer is flushed as a new immutable segment (app.segments) once
+    it holds LOCAL_FLUSH_POSTINGS postings or is LOCAL_FLUSH_INTERVAL seconds
+    old. Updating or deleting a document leaves a tombstone on the segment
+    holding its previous version. A background thread merges segments with
+    the tiered policy of app.segments.pick_merge, dropping deleted documents.
+    The manifest lists the live segments and their tombstone files. It is
+    replaced atomically on every flush and merge, after which files it no
+    longer names are removed unless a snapshot still holds them.
+
+    Every write bumps a generation. Tombstones carry the generation of the
+    write that made them, so a read sees the segments and the buffer as of
+    one generation and reads the memory-mapped segments outside the lock.
+
+    The document source is SOURCE_DOCUMENTS in the same directory. Statistics
+    are kept exactly from the stored documents, so increment_doc_stats has
+    nothing to do.
+    """
+
+    name = "local"
+
+    def __init__(self, path: str = LOCAL_STORAGE_PATH, merges: str = SEGMENT_MERGES):
+        self.path = path
+        os.makedirs(os.path.join(path, SNAPSHOTS), exist_ok=True)
+        self.source = JsonlDocumentSource(os.path.join(path, SOURCE_DOCUMENTS))
+        self._lock = threading.RLock()
+        self._merge_lock = threading.Lock()  # one merge at a time
+        self._generation = 0
+        self._commit_count = 0
+        self._next_segment = 0
+        self._segments = []  # LiveSegments, oldest first
+        self._merges = Counter()
+        self._load_manifest()
+
+        self._doc_count = sum(state.live_documents for state in self._segments)
+        self._total_length = sum(state.live_length for state in self._segments)
+        self._reset_buffer()
+        self._wal_path = os.path.join(path, WRITE_AHEAD_LOG)
+        replayed = self._replay_wal()
+        self._wal = open(self._wal_path, "ab")
+        self._remove_unreferenced_files(temporary=True)
+        logger.info(
+            f"Opened local index in {path}: {len(self._segments)} segments, "
+            f"{self._doc_count} documents, {replayed} logged writes replayed."
+        )
+
+        self._closing = threading.Event()
+        self._wake = threading.Event()
+        self._scheduler = None
+        if merges == "background":
+            self._scheduler = threading.Thread(
+                target=self._run_scheduler, name="segment-merges", daemon=True
+            )
+            self._scheduler.start()
+
+    def _reset_buffer(self):
+        self._documents = {}  # doc_id -> forward entry, None once deleted
+        self._postings = {}  # term -> {doc_id: posting} of buffered documents
+        self._max_tf = {}
+        self._min_doc_length = {}
+        self._buffered_postings = 0
+        self._buffered_since = None
+
+    # Manifest and files
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _load_manifest(self):
+        manifest_path = self._file(MANIFEST)
+        if not os.path.exists(manifest_path):
+            if os.path.exists(self._file(LEGACY_BASE_SEGMENT)):
+                os.replace(
+                    self._file(LEGACY_BASE_SEGMENT), self._file("seg_000000.seg")
+                )
+                self._segments.append(
+                    LiveSegment("seg_000000", Segment(self._file("seg_000000.seg")))
+                )
+                self._next_segment = 1
+                self._commit()
+            return
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+        self._commit_count = manifest["commit"]
+        self._next_segment = manifest["next_segment"]
+        for listed in manifest["segments"]:
+            state = LiveSegment(
+                listed["name"], Segment(self._file(f"{listed['name']}.seg"))
+            )
+            if listed.get("deletes"):
+                for document_id in _read_deletes(self._file(listed["deletes"])):
+                    state.delete(document_id, 0)
+                state.deletes_file = listed["deletes"]
+                state.dirty = False
+            self._segments.append(state)
+
+    def _manifest_segments(self) -> list:
+        return [
+            {"name": state.name, "deletes": state.deletes_file}
+            for state in self._segments
+        ]
+
+    def _commit(self):
+        """Persist changed tombstones and write a new manifest."""
+        self._commit_count += 1
+        for state in self._segments:
+            if state.dirty:
+                state.deletes_file = f"{state.name}.{self._commit_count}.del"
+                _write_json(self._file(state.deletes_file), sorted(state.deleted))
+                state.dirty = False
+        _write_json(
+            self._file(MANIFEST),
+            {
+                "commit": self._commit_count,
+                "next_segment": self._next_segment,
+                "segments": self._manifest_segments(),
+            },
+        )
+        self._remove_unreferenced_files()
+
+    def _snapshot_path(self, name: str) -> str:
+        return os.path.join(self.path, SNAPSHOTS, f"{name}.json")
+
+    def _read_snapshots(self) -> list:
+        snapshots = []
+        directory = os.path.join(self.path, SNAPSHOTS)
+        for file_name in sorted(os.listdir(directory)):
+            if file_name.endswith(".json"):
+                with open(os.path.join(directory, file_name)) as snapshot_file:
+                    snapshots.append(json.load(snapshot_file))
+        return snapshots
+
+    def _remove_unreferenced_files(self, temporary: bool = False):
+        """
+        Remove the segment and tombstone files that neither the manifest nor a
+        snapshot names, and with temporary the leftovers of interrupted writes.
+        """
+        suffixes = (".seg", ".del", ".tmp") if temporary else (".seg", ".del")
+        referenced = set()
+        for listed in self._manifest_segments() + [
+            listed
+            for snapshot in self._read_snapshots()
+            for listed in snapshot["segments"]
+        ]:
+            referenced.add(f"{listed['name']}.seg")
+            if listed["deletes"]:
+                referenced.add(listed["deletes"])
+        for file_name in os.listdir(self.path):
+            if file_name.endswith(suffixes) and file_name not in referenced:
+                os.remove(self._file(file_name))
+
+    def _new_segment_name(self) -> str:
+        name = f"seg_{self._next_segment:06d}"
+        self._next_segment += 1
+        return name
+
+    # Write-ahead log
+
+    def _replay_wal(self) -> int:
+        if not os.path.exists(self._wal_path):
+            return 0
+        with open(self._wal_path, "rb") as wal:
+            data = wal.read()
+        offset = 0
+        replayed = 0
+        while offset + WAL_RECORD.size <= len(data):
+            (length,) = WAL_RECORD.unpack_from(data, offset)
+            end = offset + WAL_RECORD.size + length
+            if end > len(data):
+                break
+            record = bson.decode(data[offset + WAL_RECORD.size : end])
+            self._apply(record["entries"], record["deleted"])
+            offset = end
+            replayed += 1
+        if offset < len(data):
+            # A write interrupted before it was acknowledged
+            logger.warning(
+                f"Discarding {len(data) - offset} bytes of a torn write at the "
+                f"end of {self._wal_path}."
+            )
+            with open(self._wal_path, "r+b") as wal:
+                wal.truncate(offset)
+        return replayed
+
+    def _log(self, entries: list, deleted: list) -> int:
+        record = bson.encode({"entries": entries, "deleted": deleted})
+        self._wal.write(WAL_RECORD.pack(len(record)) + record)
+        self._wal.flush()
+        if LOCAL_SYNC_WRITES:
+            os.fsync(self._wal.fileno())
+        return WAL_RECORD.size + len(record)
+
+    # Buffered writes
+
+    def _apply(self, entries: list, deleted: list):
+        self._generation += 1
+        for entry in entries:
+            self._replace(entry["document_id"], entry)
+        for document_id in deleted:
+            self._replace(document_id, None)
+
+    def _replace(self, document_id: str, entry):
+        if document_id in self._documents:
+            previous = self._documents[document_id]
+            if previous is not None:
+                for term in previous["terms"]:
+                    postings = self._postings[term]
+                    del postings[document_id]
+                    if not postings:
+                        del self._postings[term]
+                self._doc_count -= 1
+                self._total_length -= previous.get("total_terms", 0)
+        else:
+            for state in self._segments:
+                if state.is_live(document_id):
+                    state.delete(document_id, self._generation)
+                    self._doc_count -= 1
+                    self._total_length -= state.segment.document_length(document_id)
+                    break
+
+        self._documents[document_id] = entry
+        if self._buffered_since is None:
+            self._buffered_since = time.monotonic()
+        if entry is None:
+            return
+        doc_length = entry.get("total_terms", 0)
+        for term, info in entry["terms"].items():
+            self._postings.setdefault(term, {})[document_id] = info
+            self._max_tf[term] = max(self._max_tf.get(term, 0), info["frequency"])
+            self._min_doc_length[term] = min(
+                self._min_doc_length.get(term, doc_length), doc_length
+            )
+        self._doc_count += 1
+        self._total_length += doc_length
+        self._buffered_postings += len(entry["terms"])
+
+    def write_documents(self, changes: dict, entries=(), deleted=()) -> dict:
+        entries = list(entries)
+        deleted = list(deleted)
+        with self._lock:
+            bytes_sent = self._log(entries, deleted)
+            self._apply(entries, deleted)
+            if self._buffered_postings >= LOCAL_FLUSH_POSTINGS:
+                self.flush()
+        return {
+            "terms": len(changes),
+            "round_trips": 1,
+            "bytes_sent": bytes_sent,
+        }
+
+    def flush(self) -> dict:
+        """Write the buffered documents as a new segment and commit it."""
+        with self._lock:
+            if not self._documents:
+                return {"documents_flushed": 0}
+            entries = [
+                entry
+                for _, entry in sorted(self._documents.items())
+                if entry is not None
+            ]
+            if entries:
+                name = self._new_segment_name()
+                writer = SegmentWriter(self._file(f"{name}.seg.tmp"))
+                try:
+                    for term in sorted(self._postings):
+                        writer.add_term(
+                            term, self._postings[term], self._min_doc_length[term]
+                        )
+                    for entry in entries:
+                        writer.add_document(entry)
+                    writer.finish()
+                except BaseException:
+                    writer.abort()
+                    raise
+                os.replace(writer.path, self._file(f"{name}.seg"))
+                self._segments.append(
+                    LiveSegment(name, Segment(self._file(f"{name}.seg")))
+                )
+            self._commit()
+            self._reset_buffer()
+            self._wal.truncate(0)
+            self._wal.flush()
+            os.fsync(self._wal.fileno())
+        self._wake.set()
+        logger.debug(f"Flushed {len(entries)} documents into a new segment.")
+        return {"documents_flushed": len(entries)}
+
+    # Merges
+
+    def _run_scheduler(self):
+        while not self._closing.is_set():
+            self._wake.wait(LOCAL_FLUSH_INTERVAL)
+            self._wake.clear()
+            if self._closing.is_set():
+                return
+            try:
+                with self._lock:
+                    due = self._buffered_since is not None and (
+                        time.monotonic() - self._buffered_since >= LOCAL_FLUSH_INTERVAL
+                    )
+                if due:
+                    self.flush()
+                while not self._closing.is_set() and self.merge_once():
+                    pass
+            except Exception as e:
+                logger.error(f"Segment maintenance failed: {e}")
+
+    def merge_once(self) -> bool:
+        """Run the next merge the tiered policy asks for, if any."""
+        with self._merge_lock:
+            with self._lock:
+                inputs = pick_merge(
+                    self._segments, SEGMENT_MERGE_FACTOR, SEGMENT_EXPUNGE_RATIO
+                )
+            if not inputs:
+                return False
+            self._merge(inputs, "expunge" if len(inputs) == 1 else "tiered")
+            return True
+
+    def _merge(self, inputs: list, reason: str):
+        """
+        Merge inputs into one segment. The merge reads the inputs as of the
+        current generation outside the lock; documents deleted from them in
+        the meantime are carried over as tombstones on the merged segment.
+        """
+        with self._lock:
+            generation = self._generation
+            sources = [
+                (
+                    state.segment,
+                    state.deleted_as_of(generation),
+                    Counter(state.df_deleted),
+                )
+                for state in inputs
+            ]
+            for state in inputs:
+                state.merging = True
+            name = self._new_segment_name()
+
+        writer = SegmentWriter(self._file(f"{name}.seg.tmp"))
+        try:
+            write_merged(writer, sources)
+            writer.finish()
+        except BaseException:
+            writer.abort()
+            with self._lock:
+                for state in inputs:
+                    state.merging = False
+            raise
+
+        with self._lock:
+            os.replace(writer.path, self._file(f"{name}.seg"))
+            merged = LiveSegment(name, Segment(self._file(f"{name}.seg")))
+            for state in inputs:
+                for document_id, deleted_at in state.deleted.items():
+                    if deleted_at > generation:
+                        merged.delete(document_id, deleted_at)
+            position = self._segments.index(inputs[0])
+            self._segments = [state for state in self._segments if state not in inputs]
+            if merged.segment.document_count:
+                self._segments.insert(position, merged)
+            self._commit()
+            self._merges[reason] += 1
+        logger.info(
+            f"Merged {len(inputs)} segments ({reason}) into {name} with "
+            f"{merged.live_documents} documents."
+        )
+
+    # Reads
+
+    def _view(self) -> list:
+        """(segment, deleted) of every live segment as of this generation."""
+        return [
+            (state.segment, state.deleted_as_of(self._generation))
+            for state in self._segments
+        ]
+
+    def fetch_documents(self, document_ids: list) -> dict:
+        return {
+            document_id: document_to_index_input(document)
+            for document_id, document in self.source.find(document_ids).items()
+        }
+
+    def load_forward_entries(self, document_ids: list, fields=None) -> dict:
+        with_terms = fields is None or "terms" in fields
+        entries = {}
+        with self._lock:
+            buffered = {
+                document_id: self._documents[document_id]
+                for document_id in document_ids
+                if document_id in self._documents
+            }
+            view = self._view()
+        for document_id in document_ids:
+            if document_id in buffered:
+                entry = buffered[document_id]
+            else:
+                entry = _segment_entry(view, document_id, with_terms)
+            if entry is not None:
+                entries[document_id] = _select(entry, fields)
+        return entries
+
+    def load_metadata_entries(self, document_ids: list) -> dict:
+        return self.load_forward_entries(document_ids, ("total_terms", "metadata"))
+
+    def near_duplicate_candidates(self, document_id: str, bands: list) -> list:
+        # No band index: the segments' dictionaries keep every SimHash in place
+        bands = set(bands)
+        candidates = []
+        with self._lock:
+            for candidate_id, entry in self._documents.items():
+                if (
+                    entry is not None
+                    and candidate_id != document_id
+                    and bands.intersection(entry.get("simhash_bands", ()))
+                ):
+                    candidates.append(
+                        {"document_id": candidate_id, "simhash": entry["simhash"]}
+                    )
+            buffered = set(self._documents)
+            view = self._view()
+        for segment, deleted in view:
+            for candidate_id, _, signature in segment.iter_documents():
+                if (
+                    candidate_id != document_id
+                    and candidate_id not in deleted
+                    and candidate_id not in buffered
+                    and bands.intersection(simhash_bands(signature))
+                ):
+                    candidates.append(
+                        {"document_id": candidate_id, "simhash": f"{signature:016x}"}
+                    )
+        return candidates
+
+    def load_term_headers(self, terms, fields=None) -> dict:
+        headers = {}
+        with self._lock:
+            for term in terms:
+                header = {"term": term, "df": 0, "max_tf": 0}
+                for state in self._segments:
+                    segment_header = state.segment.term_header(term)
+                    if segment_header is None:
+                        continue
+                    header["df"] += segment_header["df"] - state.df_deleted.get(term, 0)
+                    header["max_tf"] = max(header["max_tf"], segment_header["max_tf"])
+                    header["min_doc_length"] = min(
+                        header.get("min_doc_length", segment_header["min_doc_length"]),
+                        segment_header["min_doc_length"],
+                    )
+                if term in self._postings:
+                    header["df"] += len(self._postings[term])
+                    header["max_tf"] = max(header["max_tf"], self._max_tf[term])
+                    header["min_doc_length"] = min(
+                        header.get("min_doc_length", self._min_doc_length[term]),
+                        self._min_doc_length[term],
+                    )
+                if header["df"] > 0:
+                    headers[term] = header
+        return headers
+
+    def load_postings(self, terms) -> dict:
+        terms = list(terms)
+        with self._lock:
+            buffered = {term: dict(self._postings.get(term, {})) for term in terms}
+            view = self._view()
+        postings = {}
+        for term in terms:
+            documents = _segment_postings(view, term, buffered[term])
+            if documents:
+                postings[term] = documents
+        return postings
+
+    def iter_postings(self, term: str, after: str = None, positions: bool = True):
+        # Merge the segments' postings as they are decoded, instead of
+        # gathering them all like load_postings
+        with self._lock:
+            buffered = dict(self._postings.get(term, {}))
+            view = self._view()
+        blocks = []
+        for segment, deleted in view:
+            block = segment.postings_block(term)
+            if block is not None:
+                blocks.append({**block, "deleted": deleted})
+        blocks.append({"documents": buffered})
+        for document_id, entry in merge_block_entries(blocks):
+            if after is None or document_id > after:
+                yield document_id, posting_entry(entry, positions)
+
+    def iter_term_frequencies(self):
+        frequencies = Counter()
+        with self._lock:
+            for state in self._segments:
+                for header, _ in state.segment.iter_terms():
+                    frequencies[header["term"]] += header["df"]
+                frequencies.subtract(state.df_deleted)
+            for term, documents in self._postings.items():
+                frequencies[term] += len(documents)
+        for term, df in frequencies.items():
+            if df > 0:
+                yield term, df
+
+    # Statistics
+
+    def increment_doc_stats(self, doc_count_delta: int, length_delta: int):
+        pass
+
+    def read_doc_stats(self) -> dict:
+        with self._lock:
+            return _doc_stats(self._doc_count, self._total_length)
+
+    def reconcile_doc_stats(self, apply: bool = True) -> dict:
+        with self._lock:
+            counted = {"docCount": self._doc_count, "totalLength": self._total_length}
+            actual = {"docCount": 0, "totalLength": 0}
+            for segment, deleted in self._view():
+                for document_id, total_terms, _ in segment.iter_documents():
+                    if document_id not in deleted:
+                        actual["docCount"] += 1
+                        actual["totalLength"] += total_terms
+            for entry in self._documents.values():
+                if entry is not None:
+                    actual["docCount"] += 1
+                    actual["totalLength"] += entry.get("total_terms", 0)
+            drift = {name: actual[name] - counted[name] for name in counted}
+            applied = False
+            if apply and any(drift.values()):
+                self._doc_count = actual["docCount"]
+                self._total_length = actual["totalLength"]
+                applied = True
+        return {
+            "counted": counted,
+            "actual": actual,
+            "drift": drift,
+            "stable": True,
+            "applied": applied,
+        }
+
+    # Settings
+
+    def load_analyzer_config(self):
+        path = self._file(ANALYZER_CONFIG)
+        if not os.path.exists(path):
+            return None
+        with open(path) as settings:
+            return json.load(settings)
+
+    def save_analyzer_config(self, config: dict):
+        _write_json(self._file(ANALYZER_CONFIG), config)
+
+    # Maintenance
+
+    def compact(self, suspects: set = None) -> dict:
+        """Flush the buffer and merge every segment into one."""
+        flushed = self.flush()["documents_flushed"]
+        with self._merge_lock:
+            with self._lock:
+                inputs = list(self._segments)
+            if len(inputs) > 1 or any(state.deleted for state in inputs):
+                self._merge(inputs, "full")
+                merged = len(inputs)
+            else:
+                merged = 0
+        return {
+            "documents_flushed": flushed,
+            "segments_merged": merged,
+            "suspects": set(),
+        }
+
+    def storage_stats(self) -> dict:
+        with self._lock:
+            return {
+                "backend": self.name,
+                "generation": self._generation,
+                "buffered_documents": len(self._documents),
+                "buffered_postings": self._buffered_postings,
+                "segments": [
+                    {
+                        "name": state.name,
+                        "documents": state.segment.document_count,
+                        "deleted": len(state.deleted),
+                        "bytes": os.path.getsize(self._file(f"{state.name}.seg")),
+                        "merging": state.merging,
+                    }
+                    for state in self._segments
+                ],
+                "merges": dict(self._merges),
+            }
+
+    # Snapshots
+
+    def create_snapshot(self) -> dict:
+        """
+        Flush the buffer and record the current segments and tombstones. The
+        files stay on disk until the snapshot is released, so they can be
+        copied or opened with open_snapshot while the index keeps changing.
+        """
+        with self._lock:
+            self.flush()
+            created = datetime.now(timezone.utc)
+            snapshot = {
+                "name": f"{created:%Y%m%dT%H%M%S}-{self._commit_count}",
+                "created": created.isoformat(),
+                "documents": self._doc_count,
+                "segments": self._manifest_segments(),
+            }
+            _write_json(self._snapshot_path(snapshot["name"]), snapshot)
+        return snapshot
+
+    def list_snapshots(self) -> list:
+        with self._lock:
+            return self._read_snapshots()
+
+    def release_snapshot(self, name: str):
+        with self._lock:
+            try:
+                os.remove(self._snapshot_path(name))
+            except FileNotFoundError:
+                raise ValueError(f"Snapshot {name} does not exist.")
+            self._remove_unreferenced_files()
+
+    def open_snapshot(self, name: str) -> "SegmentSnapshot":
+        with self._lock:
+            if not os.path.exists(self._snapshot_path(name)):
+                raise ValueError(f"Snapshot {name} does not exist.")
+            with open(self._snapshot_path(name)) as snapshot_file:
+                return SegmentSnapshot(self.path, json.load(snapshot_file))
+
+    def close(self):
+        self._closing.set()
+        self._wake.set()
+        if self._scheduler is not None:
+            self._scheduler.join()
+        with self._lock:
+            self._wal.close()
+            for state in self._segments:
+                state.segment.close()
+
+
+def _doc_stats(doc_count: int, total_length: int) -> dict:
+    return {
+        "docCount": doc_count,
+        "totalLength": total_length,
+        "avgDocLength": total_length / doc_count if doc_count > 0 else 0.0,
+    }
+
+
+def _segment_entry(view: list, document_id: str, with_terms: bool):
+    for segment, deleted in view:
+        if document_id in deleted:
+            continue
+        entry = segment.metadata(document_id)
+        if entry is not None:
+            if with_terms:
+                entry["terms"] = segment.forward_terms(document_id)
+            return entry
+    return None
+
+
+def _segment_postings(view: list, term: str, buffered: dict = None) -> LazyPostings:
+    blocks = []
+    for segment, deleted in view:
+        block = segment.postings_block(term)
+        if block is not None:
+            blocks.append({**block, "deleted": deleted})
+    if buffered:
+        blocks.append({"documents": buffered})
+    return _block_postings(blocks)
+
+
+class SegmentSnapshot:
+    """Read-only view of the segments recorded by LocalStorage.create_snapshot."""
+
+    def __init__(self, path: str, snapshot: dict):
+        self.name = snapshot["name"]
+        self._view = []
+        for listed in snapshot["segments"]:
+            deleted = ()
+            if listed["deletes"]:
+                deleted = frozenset(
+                    _read_deletes(os.path.join(path, listed["deletes"]))
+                )
+            self._view.append(
+                (Segment(os.path.join(path, f"{listed['name']}.seg")), deleted)
+            )
+
+    def load_forward_entries(self, document_ids: list, fields=None) -> dict:
+        with_terms = fields is None or "terms" in fields
+        entries = {}
+        for document_id in document_ids:
+            entry = _segment_entry(self._view, document_id, with_terms)
+            if entry is not None:
+                entries[document_id] = _select(entry, fields)
+        return entries
+
+    def load_postings(self, terms) -> dict:
+        postings = {}
+        for term in terms:
+            documents = _segment_postings(self._view, term)
+            if documents:
+                postings[term] = documents
+        return postings
+
+    def read_doc_stats(self) -> dict:
+        doc_count = 0
+        total_length = 0
+        for segment, deleted in self._view:
+            for document_id, total_terms, _ in segment.iter_documents():
+                if document_id not in deleted:
+                    doc_count += 1
+                    total_length += total_terms
+        return _doc_stats(doc_count, total_length)
+
+    def close(self):
+        for segment, _ in self._view:
+            segment.close()
@@ -0,0 +1,231 @@
+# app/terms.py
+"""
+In-memory dictionary of the indexed terms and their document frequencies.
+
+The terms are kept in a sorted array, with a second sorted array of the
+reversed terms, so a prefix ("app*") or a suffix ("*tion") is a contiguous
+range found by bisection. Patterns with no literal prefix or suffix
+("*ppl*") scan the whole array. Every expansion stops after
+WILDCARD_MAX_SCAN dictionary entries and keeps at most WILDCARD_MAX_TERMS
+terms, the most frequent ones, and reports what it cost. Misspelled terms
+are looked up in a trigram index of the terms (app.fuzzy), maintained along
+with the sorted arrays.
+
+The dictionary is loaded from storage at startup. This worker's writes
+update it from their staged posting changes. Terms invalidated by other
+workers are re-read from their headers.
+"""
+
+from bisect import bisect_left, insort
+import heapq
+import logging
+import os
+import re
+import threading
+
+from app.fuzzy import FUZZY_INDEX, FUZZY_MAX_SCAN, TrigramIndex, auto_distance
+
+logger = logging.getLogger(__name__)
+
+# Whether the term dictionary is loaded; wildcards and autocomplete need it
+TERM_DICTIONARY = os.getenv("INDEX_TERM_DICTIONARY", "true").lower() == "true"
+
+# Most terms one wildcard expands to, and most dictionary entries it examines
+WILDCARD_MAX_TERMS = int(os.getenv("INDEX_WILDCARD_MAX_TERMS", "1000"))
+WILDCARD_MAX_SCAN = int(os.getenv("INDEX_WILDCARD_MAX_SCAN", "100000"))
+
+WILDCARD = "*"
+
+
+def _pattern_regex(pattern: str):
+    return re.compile(".*".join(re.escape(part) for part in pattern.split(WILDCARD)))
+
+
+class TermDictionary:
+    """Sorted terms with their document frequencies; see the module docstring."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._terms = []
+        self._reversed = []
+        self._df = {}
+        self._trigrams = TrigramIndex() if FUZZY_INDEX else None
+        self.loaded = False
+
+    def __len__(self) -> int:
+        return len(self._df)
+
+    def df(self, term: str) -> int:
+        return self._df.get(term, 0)
+
+    def load(self, frequencies):
+        """Replace the contents with the (term, df) pairs of frequencies."""
+        df = {term: count for term, count in frequencies if count > 0}
+        terms = sorted(df)
+        reversed_terms = sorted(term[::-1] for term in terms)
+        trigram_index = None
+        if self._trigrams is not None:
+            trigram_index = TrigramIndex()
+            trigram_index.load(terms)
+        with self._lock:
+            self._df = df
+            self._terms = terms
+            self._reversed = reversed_terms
+            self._trigrams = trigram_index
+            self.loaded = True
+        logger.info(f"Loaded {len(terms)} terms into the term dictionary.")
+
+    def set_frequencies(self, frequencies: dict):
+        """Set the df of each term, removing the terms whose df is 0."""
+        if not self.loaded:
+            return
+        with self._lock:
+            for term, count in frequencies.items():
+                self._set(term, count)
+
+    def _set(self, term: str, count: int):
+        if count > 0:
+            if term not in self._df:
+                insort(self._terms, term)
+                insort(self._reversed, term[::-1])
+                if self._trigrams is not None:
+                    self._trigrams.add(term)
+            self._df[term] = count
+        elif self._df.pop(term, None) is not None:
+            del self._terms[bisect_left(self._terms, term)]
+            del self._reversed[bisect_left(self._reversed, term[::-1])]
+            if self._trigrams is not None:
+                self._trigrams.remove(term)
+
+    def apply_changes(self, changes: dict):
+        """Apply the df changes of posting changes staged with app.postings."""
+        if not self.loaded:
+            return
+        with self._lock:
+            for term, change in changes.items():
+                if change["new"] or change["unset"]:
+                    self._set(
+                        term,
+                        self._df.get(term, 0)
+                        + len(change["new"])
+                        - len(change["unset"]),
+                    )
+
+    def refresh(self, storage, terms):
+        """Re-read the df of terms from storage."""
+        terms = list(terms)
+        if not self.loaded or not terms:
+            return
+        headers = storage.load_term_headers(terms, {"term": 1, "df": 1})
+        self.set_frequencies(
+            {term: headers.get(term, {}).get("df", 0) for term in terms}
+        )
+
+    def _range(self, array: list, prefix: str, reverse: bool):
+        start = bisect_left(array, prefix)
+        for index in range(start, len(array)):
+            if not array[index].startswith(prefix):
+                return
+            yield array[index][::-1] if reverse else array[index]
+
+    def _candidates(self, pattern: str):
+        """Terms that can match pattern, as narrow a range as the pattern allows."""
+        prefix, _, rest = pattern.partition(WILDCARD)
+        suffix = pattern.rpartition(WILDCARD)[2]
+        if prefix or not rest:
+            return self._range(self._terms, prefix, False)
+        if suffix:
+            return self._range(self._reversed, suffix[::-1], True)
+        return iter(self._terms)
+
+    def expand(
+        self,
+        pattern: str,
+        max_terms: int = WILDCARD_MAX_TERMS,
+        max_scan: int = WILDCARD_MAX_SCAN,
+    ) -> tuple:
+        """
+        Return the terms matching pattern, where * stands for any characters,
+        and a report of the expansion's cost.
+        """
+        if not pattern.replace(WILDCARD, ""):
+            raise ValueError(f"'{pattern}' needs at least one literal character")
+        regex = _pattern_regex(pattern)
+        matched = []
+        scanned = 0
+        truncated = False
+        with self._lock:
+            for term in self._candidates(pattern):
+                if scanned >= max_scan:
+                    truncated = True
+                    break
+                scanned += 1
+                if regex.fullmatch(term):
+                    matched.append((self._df[term], term))
+        if len(matched) > max_terms:
+            matched = heapq.nlargest(max_terms, matched)
+            truncated = True
+        terms = sorted(term for _, term in matched)
+        return terms, {
+            "pattern": pattern,
+            "terms": len(terms),
+            "scanned": scanned,
+            "postings": sum(count for count, _ in matched),
+            "truncated": truncated,
+        }
+
+    def complete(
+        self, prefix: str, limit: int = 10, max_scan: int = WILDCARD_MAX_SCAN
+    ) -> tuple:
+        """The limit terms starting with prefix that have the highest df."""
+        scanned = 0
+        truncated = False
+        candidates = []
+        with self._lock:
+            for term in self._range(self._terms, prefix, False):
+                if scanned >= max_scan:
+                    truncated = True
+                    break
+                scanned += 1
+                candidates.append((self._df[term], term))
+        best = heapq.nsmallest(limit, candidates, key=lambda item: (-item[0], item[1]))
+        return [{"term": term, "df": count} for count, term in best], {
+            "scanned": scanned,
+            "truncated": truncated,
+        }
+
+    def fuzzy(
+        self,
+        term: str,
+        max_distance: int = 2,
+        limit: int = 10,
+        max_scan: int = FUZZY_MAX_SCAN,
+    ) -> tuple:
+        """
+        The limit terms closest to term, within max_distance edits as allowed
+        by auto_distance, ranked by distance and then by df.
+        """
+        if self._trigrams is None:
+            raise ValueError("Fuzzy lookups need the trigram index (INDEX_FUZZY_INDEX)")
+        distance = auto_distance(term, max_distance)
+        with self._lock:
+            matched, scanned, truncated = self._trigrams.matches(
+                term, distance, max_scan
+            )
+            ranked = [
+                (found, self._df[candidate], candidate)
+                for candidate, found in matched.items()
+                if candidate != term
+            ]
+        best = heapq.nsmallest(
+            limit, ranked, key=lambda item: (item[0], -item[1], item[2])
+        )
+        return [
+            {"term": candidate, "distance": found, "df": count}
+            for found, count, candidate in best
+        ], {
+            "max_distance": distance,
+            "matched": len(ranked),
+            "scanned": scanned,
+            "truncated": truncated,
+        }
@@ -1,8 +1,39 @@
 # app/utils.py
-import re
+from app.analysis import ANALYZER
 
 
 def extract_terms(text: str) -> list:
-    """Tokenizes and normalizes the input text."""
-    tokens = re.findall(r"\b\w+\b", text.lower())
-    return tokens
+    """Tokenizes and normalizes the input text with the configured analyzer."""
+    return ANALYZER.analyze(text)
+
+
+def analyze_document(text: str) -> tuple:
+    """
+    Per-term frequency and positions of text and its number of terms. The
+    text is analyzed as a stream, without a list of all its tokens.
+    """
+    term_info = build_term_info(ANALYZER.tokens(text))
+    return term_info, sum(info["frequency"] for info in term_info.values())
+
+
+def build_term_info(terms) -> dict:
+    """Aggregates a token stream into per-term frequency and positions."""
+    term_info = {}
+    for position, term in enumerate(terms):
+        info = term_info.get(term)
+        if info is None:
+            info = term_info[term] = {"frequency": 0, "positions": []}
+        info["frequency"] += 1
+        info["positions"].append(position)
+    return term_info
+
+
+def document_to_index_input(document: dict):
+    """Split a TRANSFORMED document into its text and the metadata we index."""
+    document_content = document.get("text", "")
+    document_metadata = {
+        "url": document.get("url", ""),
+        "type": document.get("type", ""),
+        "text_length": document.get("text_length", len(document_content.split())),
+    }
+    return document_content, document_metadata
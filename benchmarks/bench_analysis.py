@@ -0,0 +1,77 @@
+# benchmarks/bench_analysis.py
+"""
+Analyzer throughput in tokens per second.
+
+Analyzes a synthetic English-like text, with word frequencies following Zipf's
+law, under several analyzer configurations and next to the original
+re.findall tokenizer. Run from the repository root:
+
+    python -m benchmarks.bench_analysis --words 1000000
+"""
+
+import argparse
+import random
+import re
+import time
+
+from app.analysis import ENGLISH_STOPWORDS, Analyzer
+from app.utils import build_term_info
+
+CONFIGURATIONS = {
+    "default": {},
+    "nfkc": {"normalization": "nfkc"},
+    "stopwords": {"stopwords": "english"},
+    "stopwords+stem": {"stopwords": "english", "stemmer": "s"},
+    "full": {
+        "normalization": "nfkc",
+        "stopwords": "english",
+        "stemmer": "s",
+        "min_length": 2,
+        "max_length": 40,
+    },
+}
+
+
+def synthetic_text(words: int, vocabulary: int = 50000, seed: int = 7) -> str:
+    rng = random.Random(seed)
+    lexicon = sorted(ENGLISH_STOPWORDS) + [
+        f"term{i}{'s' if i % 3 == 0 else ''}" for i in range(vocabulary)
+    ]
+    weights = [1 / rank for rank in range(1, len(lexicon) + 1)]
+    return " ".join(rng.choices(lexicon, weights=weights, k=words))
+
+
+def legacy_tokens(text: str) -> list:
+    return re.findall(r"\b\w+\b", text.lower())
+
+
+def measure(name: str, analyze, text: str, words: int, repeat: int):
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        term_info = build_term_info(analyze(text))
+        best = min(best, time.perf_counter() - started)
+    kept = sum(info["frequency"] for info in term_info.values())
+    print(
+        f"{name:>16}  {words / best:>12,.0f} tokens/s  "
+        f"{kept:>10,} terms kept  {len(term_info):>7,} distinct"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--words", type=int, default=1000000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    text = synthetic_text(args.words)
+    measure("legacy findall", legacy_tokens, text, args.words, args.repeat)
+    for name, config in CONFIGURATIONS.items():
+        analyzer = Analyzer(**config)
+        measure(name, analyzer.tokens, text, args.words, args.repeat)
+        if analyzer.stem_cache_info() is not None:
+            print(f"{'':>16}  stem cache: {analyzer.stem_cache_info()}")
+
+
+if __name__ == "__main__":
+    main()
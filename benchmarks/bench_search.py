@@ -0,0 +1,159 @@
+# benchmarks/bench_search.py
+"""
+Search latency against result-set size.
+
+Seeds a scratch index database with N documents that all contain one term and
+times a search paging through every match for growing N, next to the previous
+one-find_one-per-hit lookup. Run from the repository root:
+
+    python -m benchmarks.bench_search --sizes 10 100 1000 10000
+"""
+
+import argparse
+import os
+import time
+from types import SimpleNamespace
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Never benchmark against the live index
+os.environ["INDEX_DATABASE_NAME"] = os.getenv(
+    "INDEX_BENCH_DATABASE_NAME", "lspt_index_bench"
+)
+
+from app.db import Database  # noqa: E402
+from app.services import search_documents  # noqa: E402
+from app.postings import load_postings, migrate_legacy_postings  # noqa: E402
+
+TERM = "benchmark"
+WORDS_PER_DOC = 200
+
+
+def clear_caches(db):
+    db.metadata_cache.clear()
+    db.postings_cache.clear()
+    db.search_cache.clear()
+
+
+def seed(db, size: int):
+    db.forward_index_col.delete_many({})
+    db.inverted_index_col.delete_many({})
+    db.posting_blocks_col.delete_many({})
+    db.doc_metadata_col.delete_many({})
+    clear_caches(db)
+
+    postings = {}
+    forward_entries = []
+    for i in range(size):
+        document_id = f"bench{i:07d}"
+        # A realistic term map so the forward entries carry their full weight
+        terms = {
+            f"word{j}": {"frequency": 1, "positions": [j]} for j in range(WORDS_PER_DOC)
+        }
+        terms[TERM] = {"frequency": 1, "positions": [WORDS_PER_DOC]}
+        postings[document_id] = terms[TERM]
+        forward_entries.append(
+            {
+                "document_id": document_id,
+                "terms": terms,
+                "metadata": {
+                    "url": f"https://example.com/{document_id}",
+                    "type": "html",
+                    "text_length": WORDS_PER_DOC + 1,
+                },
+                "total_terms": WORDS_PER_DOC + 1,
+            }
+        )
+    for start in range(0, size, 1000):
+        batch = forward_entries[start : start + 1000]
+        db.forward_index_col.insert_many(batch)
+        db.doc_metadata_col.insert_many(
+            [
+                {
+                    "document_id": entry["document_id"],
+                    "total_terms": entry["total_terms"],
+                    "metadata": entry["metadata"],
+                }
+                for entry in batch
+            ]
+        )
+    db.inverted_index_col.insert_one({"term": TERM, "documents": postings})
+    migrate_legacy_postings(db)
+
+
+def search_all_pages(request, term: str) -> dict:
+    """Every match of term, following next_cursor from page to page."""
+    documents = {}
+    cursor = None
+    while True:
+        page = search_documents(request, term, cursor=cursor)
+        documents.update(page["documents"])
+        cursor = page["next_cursor"]
+        if cursor is None:
+            return documents
+
+
+def search_one_by_one(db, term: str):
+    """The previous implementation: one forward find_one per matching document."""
+    postings = load_postings(db, [term]).get(term, {})
+    result = {}
+    for doc, term_data in postings.items():
+        forward_entry = db.forward_index_col.find_one({"document_id": doc})
+        if forward_entry:
+            result[doc] = {
+                "metadata": forward_entry.get("metadata", {}),
+                "terms": {term: term_data},
+            }
+    return result
+
+
+def timed(func, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--skip-baseline",
+        action="store_true",
+        help="Do not time the one-find_one-per-hit lookup",
+    )
+    args = parser.parse_args()
+
+    db = Database()
+    db.connect_to_databases()
+    request = SimpleNamespace(app=SimpleNamespace(state=SimpleNamespace(db=db)))
+
+    print(f"{'matches':>10} {'batched ms':>12} {'per-hit ms':>12} {'speedup':>8}")
+    try:
+        for size in args.sizes:
+            seed(db, size)
+            # Measure the store itself, not the warm caches
+            batched = timed(
+                lambda: (clear_caches(db), search_all_pages(request, TERM)),
+                args.repeat,
+            )
+            if args.skip_baseline:
+                print(f"{size:>10} {batched:>12.1f} {'-':>12} {'-':>8}")
+                continue
+            per_hit = timed(lambda: search_one_by_one(db, TERM), args.repeat)
+            print(
+                f"{size:>10} {batched:>12.1f} {per_hit:>12.1f} "
+                f"{per_hit / batched:>7.1f}x"
+            )
+    finally:
+        db.index_client.drop_database(db.index_db.name)
+        db.close_database_connections()
+
+
+if __name__ == "__main__":
+    main()
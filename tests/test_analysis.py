@@ -0,0 +1,62 @@
+# tests/test_analysis.py
+import re
+
+import pytest
+
+from app.analysis import LEGACY_CONFIG, Analyzer, check_analyzer_config, s_stem
+from app.query import parse_query
+from app.storage import LocalStorage
+
+
+def test_default_analyzer_matches_legacy_tokenizer():
+    text = "The QUICK brown-fox's_tail, naïve café; İstanbul ½ x2 — ünïcode!"
+    analyzer = Analyzer()
+    assert analyzer.config == LEGACY_CONFIG
+    assert analyzer.analyze(text) == re.findall(r"\b\w+\b", text.lower())
+    tokens = analyzer.tokens(text)
+    assert iter(tokens) is tokens and next(tokens) == "the"
+
+
+def test_analyzer_stages():
+    analyzer = Analyzer(
+        normalization="nfkc", stopwords="english", stemmer="s", min_length=2
+    )
+    assert analyzer.analyze("The ｆｕｌｌ-width Queries of a Cat and its Glasses") == [
+        "full",
+        "width",
+        "query",
+        "cat",
+        "it",
+        "glasse",
+    ]
+    assert [s_stem(term) for term in ("studies", "bus", "glass", "toes")] == [
+        "study",
+        "bus",
+        "glass",
+        "toe",
+    ]
+    analyzer.analyze("cats cats cats")
+    assert analyzer.stem_cache_info().hits >= 2
+    with pytest.raises(ValueError):
+        Analyzer(stemmer="snowball")
+
+
+def test_query_drops_stopwords(monkeypatch):
+    monkeypatch.setattr("app.utils.ANALYZER", Analyzer(stopwords="english"))
+    monkeypatch.setattr("app.query.ANALYZER", Analyzer(stopwords="english"))
+    assert parse_query("the cat AND NOT (a dog)") == (
+        "and",
+        [("term", "cat"), ("not", ("term", "dog"))],
+    )
+    assert parse_query('"cat in the hat"') == ("phrase", ["cat", "hat"])
+    with pytest.raises(ValueError):
+        parse_query("the OR a")
+
+
+def test_analyzer_config_is_recorded(tmp_path):
+    storage = LocalStorage(str(tmp_path), merges="off")
+    assert check_analyzer_config(storage, Analyzer(stemmer="s"))["stemmer"] == "s"
+    # A different analyzer leaves the recorded configuration alone
+    assert check_analyzer_config(storage, Analyzer())["stemmer"] == "s"
+    assert storage.load_analyzer_config()["stemmer"] == "s"
+    storage.close()
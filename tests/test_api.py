@@ -1,8 +1,12 @@
 # tests/test_api.py
 from fastapi.testclient import TestClient
 from app.main import app
+from app.analysis import Analyzer
 from app.db import Database
 from app.mocks import fetch_document_content_mock, fetch_document_metadata_mock
+from app.schema import SCHEMA_VERSION, schema_version, missing_indexes
+from app.services import encode_cursor
+import json
 import pytest
 from datetime import datetime, timezone
 
@@ -36,16 +40,22 @@ def setup_and_teardown():
     if db.transformed_docs_col is not None:
         db.transformed_docs_col.delete_one({"_id": "doc123"})
     db.forward_index_col.delete_one({"document_id": "doc123"})
-    db.inverted_index_col.delete_many({"documents.doc123": {"$exists": True}})
+    db.doc_metadata_col.delete_one({"document_id": "doc123"})
+    test_terms = [
+        block["term"]
+        for block in db.posting_blocks_col.find({"documents.doc123": {"$exists": True}})
+    ]
+    db.posting_blocks_col.delete_many({"term": {"$in": test_terms}})
+    db.inverted_index_col.delete_many({"term": {"$in": test_terms}})
     db.inverted_index_col.delete_many(
-        {"documents": {"$size": 0}}
+        {"df": {"$lte": 0}}
     )  # Remove entries with no documents
-    db.doc_stats_col.update_one(
+    db.doc_stats_col.update_many(
         {},
         {
             "$set": {
                 "docCount": 0,
-                "avgDocLength": 0.0,
+                "totalLength": 0,
                 "last_updated": datetime.now(timezone.utc),
             }
         },
@@ -53,6 +63,12 @@ def setup_and_teardown():
     db.close_database_connections()
 
 
+def test_schema():
+    db = app.state.db
+    assert schema_version(db) == SCHEMA_VERSION
+    assert missing_indexes(db) == {}
+
+
 def test_ping_add():
     response = client.post(
         "/index/ping",
@@ -87,16 +103,226 @@ def test_search():
     assert response.json()["documents"]["doc123"]["terms"]["sample"]["frequency"] == 1
     assert response.json()["documents"]["doc123"]["terms"]["sample"]["positions"] == [3]
 
+    hits = client.get("/index/cache-stats").json()["search"]["hits"]
+    response = client.get("/index/search", params={"term": "sample"})
+    assert "doc123" in response.json()["documents"]
+    assert client.get("/index/cache-stats").json()["search"]["hits"] == hits + 1
+
+
+def test_search_analyzes_term(monkeypatch):
+    monkeypatch.setattr(
+        "app.utils.ANALYZER", Analyzer(stopwords="english", stemmer="s")
+    )
+    response = client.get("/index/search", params={"term": "Samples"})
+    assert response.status_code == 200
+    assert set(response.json()["documents"]["doc123"]["terms"]) == {"sample"}
+
+    response = client.get("/index/search", params={"term": "The"})
+    assert response.status_code == 400
+
+
+def test_term_statistics_analyzes_terms(monkeypatch):
+    monkeypatch.setattr(
+        "app.utils.ANALYZER", Analyzer(stopwords="english", stemmer="s")
+    )
+    response = client.post(
+        "/index/doc-stats/terms", json={"terms": ["Samples", "sample", "The"]}
+    )
+    assert response.status_code == 200
+    terms = response.json()["terms"]
+    assert terms["Samples"] == terms["sample"] >= 1
+    assert terms["The"] == 0
+
+
+def test_search_boolean():
+    response = client.get("/index/search/boolean", params={"q": "sample AND document"})
+    assert response.status_code == 200
+    documents = response.json()["documents"]
+    assert "doc123" in documents
+    assert set(documents["doc123"]["terms"]) == {"sample", "document"}
+
+    response = client.get("/index/search/boolean", params={"q": "sample NOT testing"})
+    assert response.status_code == 200
+    assert "doc123" not in response.json()["documents"]
+
+    response = client.get("/index/search/boolean", params={"q": "NOT sample"})
+    assert response.status_code == 400
+
+
+def test_search_wildcard_and_autocomplete():
+    response = client.get("/index/search/boolean", params={"q": "sampl* AND *ing"})
+    assert response.status_code == 200
+    assert "doc123" in response.json()["documents"]
+    assert response.json()["wildcards"][0]["pattern"] == "sampl*"
+
+    response = client.get("/index/autocomplete", params={"prefix": "Sam"})
+    assert response.status_code == 200
+    assert {"term": "sample", "df": 1} in response.json()["completions"]
+
+    response = client.get("/index/terms", params={"pattern": "*"})
+    assert response.status_code == 400
+
+
+def test_search_pages_fields_and_stream():
+    response = client.get("/index/search", params={"term": "sample", "limit": 1})
+    assert response.status_code == 200
+    assert response.json()["next_cursor"] is None
+    assert "positions" in response.json()["documents"]["doc123"]["terms"]["sample"]
+
+    response = client.get(
+        "/index/search", params={"term": "sample", "fields": "metadata,frequency"}
+    )
+    assert response.json()["documents"]["doc123"]["terms"] == {
+        "sample": {"frequency": 1}
+    }
+    response = client.get("/index/search", params={"term": "sample", "fields": "url"})
+    assert response.status_code == 400
+
+    cursor = encode_cursor("doc123")
+    response = client.get("/index/search", params={"term": "sample", "cursor": cursor})
+    assert response.json()["documents"] == {}
+
+    response = client.get(
+        "/index/search",
+        params={"term": "sample", "fields": "metadata", "stream": True},
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert lines == [
+        {
+            "document_id": "doc123",
+            "metadata": fetch_document_metadata_mock("doc123"),
+        }
+    ]
+
+
+def test_search_returns_every_match_without_limit(monkeypatch):
+    db = app.state.db
+    if db.transformed_docs_col is None:
+        pytest.skip("needs the Document Data Store")
+    monkeypatch.setattr("app.services.SEARCH_PAGE_SIZE", 1)
+    db.transformed_docs_col.insert_one(
+        {"_id": "doc124", "text_length": 13, "text": "Another sample.", "type": "txt"}
+    )
+    try:
+        response = client.post(
+            "/index/ping",
+            json={
+                "document_id": "doc124",
+                "operation": "add",
+                "timestamp": "2024-11-20T10:05:00Z",
+            },
+        )
+        assert response.status_code == 200
+
+        response = client.get("/index/search", params={"term": "sample"})
+        assert set(response.json()["documents"]) == {"doc123", "doc124"}
+        assert response.json()["next_cursor"] is None
+
+        # A cursor alone pages by SEARCH_PAGE_SIZE
+        cursor = encode_cursor("doc")
+        response = client.get(
+            "/index/search", params={"term": "sample", "cursor": cursor}
+        )
+        assert list(response.json()["documents"]) == ["doc123"]
+        assert response.json()["next_cursor"] is not None
+    finally:
+        client.post(
+            "/index/ping",
+            json={
+                "document_id": "doc124",
+                "operation": "delete",
+                "timestamp": "2024-11-20T10:06:00Z",
+            },
+        )
+        db.transformed_docs_col.delete_one({"_id": "doc124"})
+
+
+def test_fuzzy_search():
+    response = client.get("/index/fuzzy", params={"term": "Sampel"})
+    assert response.status_code == 200
+    assert {"term": "sample", "distance": 2, "df": 1} in response.json()["candidates"]
+
+    # An indexed term is searched as is, whatever its case
+    response = client.get("/index/search", params={"term": "Sample", "fuzzy": True})
+    assert set(response.json()["documents"]["doc123"]["terms"]) == {"sample"}
+    assert "corrections" not in response.json()
+
+    response = client.get("/index/search", params={"term": "documnt", "fuzzy": True})
+    assert response.status_code == 200
+    assert "document" in response.json()["documents"]["doc123"]["terms"]
+    assert response.json()["corrections"][0]["term"] == "document"
+
+    response = client.get(
+        "/index/search",
+        params={"term": "documnt", "fuzzy": True, "stream": True, "limit": 1},
+    )
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert lines[0]["corrections"][0]["term"] == "document"
+    assert lines[1]["document_id"] == "doc123"
+
+
+def test_search_phrase():
+    response = client.get("/index/search/phrase", params={"q": "Sample Document"})
+    assert response.status_code == 200
+    assert response.json()["documents"]["doc123"]["matches"] == [3]
+
+    response = client.get("/index/search/phrase", params={"q": "document sample"})
+    assert response.status_code == 200
+    assert "doc123" not in response.json()["documents"]
+
+    response = client.get(
+        "/index/search/phrase", params={"q": "sample indexing", "distance": 5}
+    )
+    assert response.status_code == 200
+    assert "doc123" in response.json()["documents"]
+
+    response = client.get(
+        "/index/search/phrase", params={"q": "sample indexing", "distance": 4}
+    )
+    assert response.status_code == 200
+    assert "doc123" not in response.json()["documents"]
+
+    response = client.get(
+        "/index/search/boolean", params={"q": '"sample document" AND testing'}
+    )
+    assert response.status_code == 200
+    assert "doc123" in response.json()["documents"]
+
+
+def test_search_ranked():
+    response = client.get(
+        "/index/search/ranked", params={"q": "sample indexing", "limit": 5}
+    )
+    assert response.status_code == 200
+    documents = response.json()["documents"]
+    assert documents[0]["document_id"] == "doc123"
+    assert documents[0]["score"] > 0
+    assert documents[0]["metadata"]["url"] == "https://example.com/doc123"
+
+    response = client.get(
+        "/index/search/ranked", params={"q": "sample", "limit": 5, "offset": 5}
+    )
+    assert response.status_code == 200
+    assert all(doc["document_id"] != "doc123" for doc in response.json()["documents"])
+
+    inverted_entry = app.state.db.inverted_index_col.find_one({"term": "sample"})
+    assert inverted_entry["max_tf"] == 1
+    assert inverted_entry["min_doc_length"] == 13
+
 
 def test_inverted_index():
     db = app.state.db
     term = "sample"
     inverted_entry = db.inverted_index_col.find_one({"term": term})
     assert inverted_entry is not None, f"Inverted index missing term: {term}"
-    assert "doc123" in inverted_entry.get(
-        "documents", {}
-    ), f"Document doc123 missing for term: {term}"
-    term_data = inverted_entry["documents"]["doc123"]
+    assert inverted_entry["df"] >= 1
+    posting_block = db.posting_blocks_col.find_one(
+        {"term": term, "documents.doc123": {"$exists": True}}
+    )
+    assert posting_block is not None, f"Document doc123 missing for term: {term}"
+    term_data = posting_block["documents"]["doc123"]
     assert term_data["frequency"] == 1, f"Incorrect frequency for term: {term}"
     assert term_data["positions"] == [3], f"Incorrect positions for term: {term}"
 
@@ -109,6 +335,115 @@ def test_forward_index():
     assert forward_entry["metadata"]["url"] == "https://example.com/doc123"
     assert forward_entry["metadata"]["type"] == "pdf"
     assert forward_entry["total_terms"] == 13
+    assert len(forward_entry["fingerprint"]) == 64
+    assert len(forward_entry["simhash_bands"]) == 4
+
+
+def test_metadata():
+    response = client.get("/index/metadata/doc123")
+    assert response.status_code == 200
+    data = response.json()
+    assert data["document_id"] == "doc123"
+    assert data["total_terms"] == 13
+    assert data["metadata"]["url"] == "https://example.com/doc123"
+
+    metadata_entry = app.state.db.doc_metadata_col.find_one({"document_id": "doc123"})
+    assert metadata_entry is not None
+    assert "terms" not in metadata_entry
+
+    response = client.get("/index/metadata/missing-doc")
+    assert response.status_code == 404
+
+
+def test_doc_stats():
+    response = client.get("/index/doc-stats")
+    assert response.status_code == 200
+    stats = response.json()
+    assert stats["docCount"] >= 1
+    assert stats["avgDocLength"] == stats["totalLength"] / stats["docCount"]
+
+    response = client.post(
+        "/index/doc-stats/terms", json={"terms": ["sample", "notindexedterm"]}
+    )
+    assert response.status_code == 200
+    term_stats = response.json()
+    assert term_stats["docCount"] == stats["docCount"]
+    assert term_stats["terms"]["sample"] >= 1
+    assert term_stats["terms"]["notindexedterm"] == 0
+
+    response = client.post("/index/doc-stats/reconcile")
+    assert response.status_code == 200
+    report = response.json()
+    assert report["actual"][
+        "docCount"
+    ] == app.state.db.forward_index_col.count_documents({})
+    assert (
+        client.get("/index/doc-stats").json()["docCount"]
+        == report["actual"]["docCount"]
+    )
+
+
+def test_ping_update_unchanged():
+    skipped = client.get("/index/ingest-stats").json().get("updates_skipped", 0)
+    response = client.post(
+        "/index/ping",
+        json={
+            "document_id": "doc123",
+            "operation": "update",
+            "timestamp": "2024-11-20T10:04:00Z",
+        },
+    )
+    assert response.status_code == 200
+    stats = client.get("/index/ingest-stats").json()
+    assert stats["updates_skipped"] == skipped + 1
+
+
+def test_near_duplicates():
+    response = client.get("/index/near-duplicates/doc123")
+    assert response.status_code == 200
+    duplicates = response.json()["duplicates"]
+    assert all(duplicate["document_id"] != "doc123" for duplicate in duplicates)
+
+    response = client.get("/index/near-duplicates/doc123", params={"max_distance": 9})
+    assert response.status_code == 400
+
+
+def test_ping_update():
+    db = app.state.db
+    if db.transformed_docs_col is None:
+        pytest.skip("Document Data Store not available")
+    original_text = db.transformed_docs_col.find_one({"_id": "doc123"})["text"]
+    db.transformed_docs_col.update_one(
+        {"_id": "doc123"},
+        {"$set": {"text": original_text.replace("indexing", "ranking")}},
+    )
+    unchanged_block = db.posting_blocks_col.find_one({"term": "sample"})
+    try:
+        response = client.post(
+            "/index/ping",
+            json={
+                "document_id": "doc123",
+                "operation": "update",
+                "timestamp": "2024-11-20T10:05:00Z",
+            },
+        )
+        assert response.status_code == 200
+
+        response = client.get("/index/search", params={"term": "ranking"})
+        assert "doc123" in response.json()["documents"]
+        response = client.get("/index/search", params={"term": "indexing"})
+        assert "doc123" not in response.json()["documents"]
+
+        # Postings of terms that did not change are not rewritten
+        block = db.posting_blocks_col.find_one({"term": "sample"})
+        assert block["version"] == unchanged_block["version"]
+        forward_entry = db.forward_index_col.find_one({"document_id": "doc123"})
+        assert "ranking" in forward_entry["terms"]
+        assert "indexing" not in forward_entry["terms"]
+    finally:
+        db.transformed_docs_col.update_one(
+            {"_id": "doc123"}, {"$set": {"text": original_text}}
+        )
 
 
 def test_ping_delete():
@@ -126,11 +461,84 @@ def test_ping_delete():
     # Verify removal from forward_index collection
     forward_entry = app.state.db.forward_index_col.find_one({"document_id": "doc123"})
     assert forward_entry is None
+    assert app.state.db.doc_metadata_col.find_one({"document_id": "doc123"}) is None
+    assert client.get("/index/metadata/doc123").status_code == 404
+
+    # Cached search responses for the document's terms were invalidated
+    response = client.get("/index/search", params={"term": "sample"})
+    assert "doc123" not in response.json()["documents"]
+    response = client.get("/index/search/phrase", params={"q": "sample document"})
+    assert "doc123" not in response.json()["documents"]
 
     # Verify doc_stats_col
     doc_stats = app.state.db.doc_stats_col.find_one({})
     assert doc_stats is not None
 
+    # Terms left without postings were removed along with the document
+    document_terms = ["sample", "document", "testing", "indexing", "component"]
+    assert (
+        app.state.db.inverted_index_col.count_documents(
+            {"term": {"$in": document_terms}, "df": {"$lte": 0}}
+        )
+        == 0
+    )
+
+
+def test_ping_batch():
+    response = client.post(
+        "/index/ping/batch",
+        json={
+            "operations": [
+                {
+                    "document_id": "doc123",
+                    "operation": "add",
+                    "timestamp": "2024-11-20T10:20:00Z",
+                },
+                {
+                    "document_id": "doc123",
+                    "operation": "update",
+                    "timestamp": "2024-11-20T10:21:00Z",
+                },
+                {
+                    "document_id": "missing-doc",
+                    "operation": "delete",
+                    "timestamp": "2024-11-20T10:22:00Z",
+                },
+            ]
+        },
+    )
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert [result["status"] for result in results] == ["success", "success", "error"]
+
+    forward_entry = app.state.db.forward_index_col.find_one({"document_id": "doc123"})
+    assert forward_entry is not None
+    posting_block = app.state.db.posting_blocks_col.find_one(
+        {"term": "sample", "documents.doc123": {"$exists": True}}
+    )
+    assert posting_block["documents"]["doc123"]["positions"] == [3]
+
+    response = client.post(
+        "/index/ping/batch",
+        json={
+            "operations": [
+                {
+                    "document_id": "doc123",
+                    "operation": "delete",
+                    "timestamp": "2024-11-20T10:30:00Z",
+                }
+            ]
+        },
+    )
+    assert response.status_code == 200
+    assert response.json()["results"][0]["status"] == "success"
+    forward_entry = app.state.db.forward_index_col.find_one({"document_id": "doc123"})
+    assert forward_entry is None
+
+    response = client.post("/index/compact")
+    assert response.status_code == 200
+    assert "dead_postings" in response.json()
+
 
 # def test_connection():
 #     response = client.get("/index/test-connection")
@@ -141,3 +549,18 @@ def test_ping_delete():
 #     assert "forward_index" in data["collections"]
 #     assert "inverted_index" in data["collections"]
 #     assert "doc_stats" in data["collections"]
+
+
+def test_shared_invalidation_evicts_metadata():
+    log = app.state.db.index_db["cache_invalidations_test"]
+    writer, reader = Database(), Database()
+    for worker in (writer, reader):
+        worker.shared_cache = True
+        worker.cache_invalidations_col = log
+        worker.storage = app.state.db.storage
+    reader.metadata_cache.set("doc9", {"document_id": "doc9", "metadata": {}})
+
+    writer.invalidate_cached_terms(["sample"], ["doc9"])
+    assert reader.sync_cache_invalidations() == 1
+    assert reader.metadata_cache.get("doc9") is None
+    log.drop()
@@ -0,0 +1,59 @@
+# tests/test_build_index.py
+from types import SimpleNamespace
+
+import pytest
+
+from app.build_index import (
+    Inverter,
+    build_index,
+    tokenize_documents,
+    tokenized_batches,
+)
+from app.storage import LocalStorage
+
+DOCUMENTS = [
+    {"_id": "doc3", "url": "u3", "type": "txt", "text": "b c c"},
+    {"_id": "doc1", "url": "u1", "type": "html", "text": "a b"},
+    {"_id": "doc2", "url": "u2", "type": "pdf", "text_length": 7, "text": "c a a"},
+]
+
+
+def test_tokenize_documents():
+    entries = tokenize_documents(DOCUMENTS)
+    assert [entry["document_id"] for entry in entries] == ["doc3", "doc1", "doc2"]
+    assert entries[0]["terms"]["c"] == {"frequency": 2, "positions": [1, 2]}
+    assert entries[0]["total_terms"] == 3
+    assert entries[2]["total_terms"] == 7
+    assert entries[1]["metadata"]["url"] == "u1"
+    assert entries[0]["fingerprint"] and entries[0]["simhash_bands"]
+
+
+def test_tokenized_batches_keep_order():
+    batches = list(tokenized_batches(DOCUMENTS, workers=1, batch_size=2))
+    assert [len(batch) for batch in batches] == [2, 1]
+    assert [entry["document_id"] for batch in batches for entry in batch] == [
+        "doc3",
+        "doc1",
+        "doc2",
+    ]
+
+
+def test_inverter_spills_and_merges(tmp_path, monkeypatch):
+    # Runs are written and merged one block-sized chunk at a time
+    monkeypatch.setattr("app.build_index.POSTING_BLOCK_SIZE", 1)
+    inverter = Inverter(str(tmp_path), run_size=3)
+    for entry in tokenize_documents(DOCUMENTS):
+        inverter.add(entry["document_id"], entry["terms"], entry["total_terms"])
+    merged = [(term, list(postings)) for term, postings in inverter.merged()]
+    assert len(inverter.runs) == 2
+    assert [term for term, _ in merged] == ["a", "b", "c"]
+    postings = dict(merged)
+    assert postings["a"] == [("doc1", 1, [0], 2), ("doc2", 2, [1, 2], 7)]
+    assert [posting[0] for posting in postings["c"]] == ["doc2", "doc3"]
+
+
+def test_build_index_rejects_local_backend(tmp_path):
+    db = SimpleNamespace(storage=LocalStorage(str(tmp_path), merges="off"))
+    with pytest.raises(ValueError, match="INDEX_LOCAL_STORAGE_PATH"):
+        build_index(db, DOCUMENTS, workers=1)
+    db.storage.close()
@@ -0,0 +1,61 @@
+# tests/test_cache.py
+from app.cache import LRUCache
+
+
+def test_lru_eviction_and_stats():
+    cache = LRUCache(2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    stats = cache.stats()
+    assert stats["evictions"] == 1
+    assert stats["hits"] == 2
+    assert stats["misses"] == 1
+    assert stats["hit_rate"] == 2 / 3
+
+
+def test_ttl_expiry():
+    cache = LRUCache(10, ttl=0.01)
+    cache.set("a", 1)
+    assert cache.get("a") == 1
+    cache._entries["a"] = (1, 0, ())
+    assert cache.get("a") is None
+    assert cache.stats()["expirations"] == 1
+
+
+def test_tag_invalidation():
+    cache = LRUCache(10)
+    cache.set(("search", "x"), {"doc": 1}, tags=("x",))
+    cache.set(("boolean", "x AND y"), {}, tags=("x", "y"))
+    cache.set(("search", "z"), {}, tags=("z",))
+    cache.invalidate_tags(["y"])
+    assert cache.get(("boolean", "x AND y")) is None
+    assert cache.get(("search", "x")) == {"doc": 1}
+    cache.invalidate_tags(["x"])
+    assert cache.get(("search", "x")) is None
+    assert cache.get(("search", "z")) == {}
+    assert len(cache) == 1
+
+
+def test_stale_load_is_refused():
+    cache = LRUCache(10)
+    generation = cache.generation()
+    # A write invalidates the term while the value is being loaded
+    cache.invalidate_tags(["x"])
+    assert not cache.set("x", "stale", tags=("x",), generation=generation)
+    assert cache.get("x") is None
+    # Other tags are unaffected
+    assert cache.set("y", "fresh", tags=("y",), generation=generation)
+    generation = cache.generation()
+    assert cache.set("x", "fresh", tags=("x",), generation=generation)
+
+
+def test_forgotten_tags_refuse_older_loads():
+    cache = LRUCache(10, max_tracked_tags=1)
+    generation = cache.generation()
+    cache.invalidate_tags(["a", "b"])
+    cache.invalidate_tags(["c"])
+    assert not cache.set("z", 1, tags=("z",), generation=generation)
@@ -0,0 +1,52 @@
+# tests/test_codec.py
+import pytest
+from app.codec import (
+    encode_varints,
+    decode_varints,
+    encode_positions,
+    decode_positions,
+    encode_doc_ids,
+    decode_doc_ids,
+    encode_posting_block,
+    iter_encoded_block,
+)
+
+
+def test_varints_round_trip():
+    values = [0, 1, 127, 128, 300, 2**31, 2**40]
+    assert decode_varints(encode_varints(values)) == values
+    assert len(encode_varints([127])) == 1
+    with pytest.raises(ValueError):
+        encode_varints([-1])
+    with pytest.raises(ValueError):
+        decode_varints(b"\x80")
+
+
+def test_positions_are_delta_encoded():
+    positions = [3, 4, 5, 1000, 1001]
+    encoded = encode_positions(positions)
+    assert decode_positions(encoded) == positions
+    assert len(encoded) == 6
+
+
+def test_doc_ids_are_front_coded():
+    doc_ids = sorted(["doc1", "doc10", "doc100", "doc2", "ünïcode"])
+    assert decode_doc_ids(encode_doc_ids(doc_ids)) == doc_ids
+
+    doc_ids = [f"https://example.com/page{i:04d}" for i in range(100)]
+    encoded = encode_doc_ids(doc_ids)
+    assert decode_doc_ids(encoded) == doc_ids
+    assert len(encoded) < sum(len(doc_id) for doc_id in doc_ids) / 4
+
+
+def test_posting_block_round_trip():
+    documents = {
+        "doc2": {"frequency": 1, "positions": [7]},
+        "doc1": {"frequency": 2, "positions": [0, 9]},
+    }
+    block = encode_posting_block(documents)
+    decoded = [
+        (doc_id, frequency, decode_positions(positions))
+        for doc_id, frequency, positions in iter_encoded_block(block)
+    ]
+    assert decoded == [("doc1", 2, [0, 9]), ("doc2", 1, [7])]
@@ -0,0 +1,41 @@
+# tests/test_fingerprint.py
+from app.fingerprint import (
+    SIMHASH_BANDS,
+    content_fingerprint,
+    simhash,
+    simhash_bands,
+    hamming_distance,
+)
+from app.utils import extract_terms, build_term_info
+
+
+def _simhash(text):
+    return simhash(build_term_info(extract_terms(text)))
+
+
+def test_content_fingerprint():
+    metadata = {"url": "https://example.com/a", "type": "html", "text_length": 3}
+    fingerprint = content_fingerprint("some page text", metadata)
+    assert fingerprint == content_fingerprint("some page text", dict(metadata))
+    assert fingerprint != content_fingerprint("some page text!", metadata)
+    assert fingerprint != content_fingerprint(
+        "some page text", {**metadata, "type": "pdf"}
+    )
+
+
+def test_simhash_near_duplicates():
+    text = " ".join(f"word{i}" for i in range(200))
+    near = text + " extra"
+    other = " ".join(f"other{i}" for i in range(200))
+    assert _simhash(text) == _simhash(text)
+    assert hamming_distance(_simhash(text), _simhash(near)) < SIMHASH_BANDS
+    assert hamming_distance(_simhash(text), _simhash(other)) > SIMHASH_BANDS
+
+
+def test_simhash_bands_share_a_band_within_distance():
+    value = _simhash("a b c d e f g")
+    flipped = value ^ (1 << 3) ^ (1 << 20) ^ (1 << 40)
+    bands = simhash_bands(value)
+    assert len(bands) == SIMHASH_BANDS
+    assert set(bands) & set(simhash_bands(flipped))
+    assert simhash_bands(0) == ["0:0000", "1:0000", "2:0000", "3:0000"]
@@ -0,0 +1,92 @@
+# tests/test_ingest_queue.py
+import threading
+
+from app.ingest_queue import IngestQueue, coalesce
+
+
+def test_coalesce():
+    assert coalesce(["add", "update", "update"], False) == ("add", 0)
+    assert coalesce(["add", "delete"], False) == (None, 0)
+    assert coalesce(["delete", "add"], True) == ("update", 0)
+    assert coalesce(["update", "delete"], True) == ("delete", 0)
+    assert coalesce(["update", "update"], True) == ("update", 0)
+    # Operations rejected at their turn are skipped
+    assert coalesce(["add", "update"], True) == ("update", 1)
+    assert coalesce(["update", "delete"], False) == (None, 2)
+
+
+def test_queue_orders_operations_per_document(tmp_path):
+    queue = IngestQueue(str(tmp_path / "queue.db"))
+    processed = []
+    lock = threading.Lock()
+
+    def process(document_id, operations):
+        with lock:
+            processed.append((document_id, operations))
+        return {"applied": 1}
+
+    queue.enqueue([("a", "add"), ("b", "add"), ("a", "update"), ("a", "delete")])
+    queue.start(process, workers=2)
+    assert queue.wait_until_empty(timeout=5)
+    queue.enqueue([("a", "add")])
+    assert queue.wait_until_empty(timeout=5)
+    stats = queue.stats()
+    queue.close()
+
+    assert sorted(processed) == [
+        ("a", ["add"]),
+        ("a", ["add", "update", "delete"]),
+        ("b", ["add"]),
+    ]
+    assert processed.index(("a", ["add", "update", "delete"])) < processed.index(
+        ("a", ["add"])
+    )
+    assert stats["depth"] == 0 and stats["enqueued"] == 5 and stats["applied"] == 3
+
+
+def test_queue_is_durable_and_retries(tmp_path, monkeypatch):
+    monkeypatch.setattr("app.ingest_queue.INGEST_RETRY_SECONDS", 0)
+    path = str(tmp_path / "queue.db")
+    queue = IngestQueue(path)
+    queue.enqueue([("a", "add"), ("b", "add")])
+    assert queue.stats()["depth"] == 2
+    queue.close()
+
+    queue = IngestQueue(path)
+    attempts = []
+
+    def process(document_id, operations):
+        attempts.append(document_id)
+        if document_id == "b" and attempts.count("b") < 3:
+            raise RuntimeError("store unavailable")
+        return {"applied": 1}
+
+    queue.start(process, workers=1)
+    assert queue.wait_until_empty(timeout=5)
+    stats = queue.stats()
+    queue.close()
+    assert attempts.count("a") == 1 and attempts.count("b") == 3
+    assert stats["applied"] == 2 and stats["failed"] == 2
+
+
+def test_claims_hold_across_queues_on_one_file(tmp_path):
+    path = str(tmp_path / "queue.db")
+    first, second = IngestQueue(path), IngestQueue(path)
+    first.enqueue([("a", "add"), ("b", "add")])
+    with first._lock:
+        document_id, rows = first._claim()
+    assert document_id == "a"
+
+    # Another process skips the claimed document, even its newer operations
+    second.enqueue([("a", "update")])
+    with second._lock:
+        assert second._claim()[0] == "b"
+        assert second._claim() is None
+    assert second.stats()["claimed"] == 2
+
+    first._finish(document_id, rows, True, {"applied": 1})
+    with second._lock:
+        document_id, rows = second._claim()
+    assert document_id == "a" and [row[1] for row in rows] == ["update"]
+    first.close()
+    second.close()
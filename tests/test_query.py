@@ -0,0 +1,167 @@
+# tests/test_query.py
+import pytest
+from app.query import (
+    parse_query,
+    query_terms,
+    all_query_terms,
+    intersect_postings,
+    union_postings,
+    difference_postings,
+    evaluate_query,
+    phrase_matches,
+    proximity_matches,
+    bm25_idf,
+    bm25_term_score,
+    top_k_maxscore,
+)
+import random
+
+POSTINGS = {
+    "python": ["d1", "d2", "d3", "d5"],
+    "fastapi": ["d2", "d5"],
+    "flask": ["d3", "d4"],
+    "django": ["d5"],
+}
+
+
+def postings_for(term):
+    return POSTINGS.get(term, [])
+
+
+def test_parse_query_precedence_and_implicit_and():
+    tree = parse_query("Python fastapi OR flask")
+    assert tree == (
+        "or",
+        [("and", [("term", "python"), ("term", "fastapi")]), ("term", "flask")],
+    )
+
+
+def test_parse_query_rejects_malformed_queries():
+    for query in ["", "(python", "python AND", "OR python", "python )"]:
+        with pytest.raises(ValueError):
+            parse_query(query)
+
+
+def test_parse_query_phrases():
+    tree = parse_query('"Sample document" NOT index')
+    assert tree == (
+        "and",
+        [("phrase", ["sample", "document"]), ("not", ("term", "index"))],
+    )
+    with pytest.raises(ValueError):
+        parse_query('"unterminated phrase')
+
+
+def test_query_terms_split_positive_and_negative():
+    tree = parse_query("python AND NOT (django OR flask)")
+    assert query_terms(tree) == {"python"}
+    assert all_query_terms(tree) == {"python", "django", "flask"}
+
+
+def test_posting_list_operations():
+    long_list = [f"d{i:04d}" for i in range(1000)]
+    assert intersect_postings([long_list, ["d0005", "d0500", "x"]]) == [
+        "d0005",
+        "d0500",
+    ]
+    assert intersect_postings([["a", "b"], []]) == []
+    assert union_postings([["a", "c"], ["b", "c"]]) == ["a", "b", "c"]
+    assert difference_postings(["a", "b", "c"], ["b", "z"]) == ["a", "c"]
+
+
+def test_evaluate_query():
+    assert evaluate_query(parse_query("python fastapi"), postings_for) == [
+        "d2",
+        "d5",
+    ]
+    assert evaluate_query(
+        parse_query("python AND (fastapi OR flask) NOT django"), postings_for
+    ) == ["d2", "d3"]
+    with pytest.raises(ValueError):
+        evaluate_query(parse_query("NOT django"), postings_for)
+
+
+def test_phrase_matches():
+    # "to be or not to be"
+    to, be = [0, 4], [1, 5]
+    assert phrase_matches([to, be]) == [0, 4]
+    assert phrase_matches([be, to]) == []
+    assert phrase_matches([to, be, [2], [3], to, be]) == [0]
+
+
+def test_proximity_matches():
+    assert proximity_matches([[0, 10], [3, 30]], 3) == [0]
+    assert proximity_matches([[0, 10], [3, 30]], 2) == []
+    assert proximity_matches([[7], [5], [6]], 2) == [5]
+    assert proximity_matches([[1], []], 5) == []
+
+
+def test_top_k_maxscore_matches_exhaustive_scoring():
+    rng = random.Random(7)
+    doc_count = 500
+    lengths = {f"d{i:04d}": rng.randint(5, 200) for i in range(doc_count)}
+    avg_doc_length = sum(lengths.values()) / doc_count
+
+    term_lists = []
+    for df in (3, 40, 250):
+        doc_ids = sorted(rng.sample(sorted(lengths), df))
+        tfs = [rng.randint(1, 5) for _ in doc_ids]
+        idf = bm25_idf(doc_count, df)
+        upper_bound = bm25_term_score(
+            max(tfs), min(lengths[d] for d in doc_ids), idf, avg_doc_length
+        )
+        term_lists.append(
+            {"doc_ids": doc_ids, "tfs": tfs, "idf": idf, "upper_bound": upper_bound}
+        )
+
+    def score(tf, doc_length, idf):
+        return bm25_term_score(tf, doc_length, idf, avg_doc_length)
+
+    expected = {}
+    for term_list in term_lists:
+        for doc_id, tf in zip(term_list["doc_ids"], term_list["tfs"]):
+            expected[doc_id] = expected.get(doc_id, 0) + score(
+                tf, lengths[doc_id], term_list["idf"]
+            )
+    expected_top = sorted(expected.items(), key=lambda item: (-item[1], item[0]))
+
+    looked_up = []
+
+    def doc_lengths(doc_ids):
+        looked_up.extend(doc_ids)
+        return {doc_id: lengths[doc_id] for doc_id in doc_ids}
+
+    top = top_k_maxscore(term_lists, 10, doc_lengths, score, batch_size=16)
+    assert [doc_id for _, doc_id in top] == [doc_id for doc_id, _ in expected_top[:10]]
+    for (actual, _), (_, wanted) in zip(top, expected_top):
+        assert actual == pytest.approx(wanted)
+    # Pruning must skip some documents that only contain the common term
+    assert len(looked_up) < len(expected)
+
+
+def test_top_k_maxscore_pages_through_ties():
+    term_lists = [
+        {
+            "doc_ids": ["a", "b", "c", "d"],
+            "tfs": [1, 1, 2, 1],
+            "idf": 1.0,
+            "upper_bound": 2.0,
+        }
+    ]
+
+    def doc_lengths(doc_ids):
+        return {doc_id: 1 for doc_id in doc_ids}
+
+    def score(tf, doc_length, idf):
+        return float(tf)
+
+    ranking = ["c", "a", "b", "d"]
+    for k in range(1, 5):
+        top = top_k_maxscore(term_lists, k, doc_lengths, score)
+        assert [doc_id for _, doc_id in top] == ranking[:k]
+    # One result per page: every document once, none skipped
+    pages = [
+        top_k_maxscore(term_lists, offset + 1, doc_lengths, score)[offset][1]
+        for offset in range(4)
+    ]
+    assert pages == ranking
@@ -0,0 +1,192 @@
+# tests/test_storage.py
+import json
+import os
+from unittest.mock import ANY
+
+from app.fingerprint import simhash_fields
+from app.postings import LazyPostings, block_fields
+from app.segments import Segment, SegmentWriter
+from app.storage import LocalStorage, SOURCE_DOCUMENTS, WRITE_AHEAD_LOG
+from app.utils import extract_terms, build_term_info
+
+
+def _entry(document_id, text):
+    term_info = build_term_info(extract_terms(text))
+    return {
+        "document_id": document_id,
+        "terms": term_info,
+        "metadata": {"url": f"https://example.com/{document_id}"},
+        "total_terms": len(extract_terms(text)),
+        "fingerprint": text,
+        **simhash_fields(term_info),
+    }
+
+
+def test_lazy_postings_keep_their_sorted_doc_ids():
+    posting = {"frequency": 1, "positions": [0]}
+    postings = LazyPostings()
+    postings.add_block(block_fields({"a": posting, "c": posting}, "compact"))
+    postings.add_block({"documents": {"d": posting, "e": posting}})
+    assert postings.doc_ids() == ["a", "c", "d", "e"]
+    assert postings.doc_ids() is postings.doc_ids()
+
+    # Blocks added out of order, as segments and the buffer are, get sorted
+    postings.add_block({"documents": {"b": posting}})
+    assert postings.doc_ids() == ["a", "b", "c", "d", "e"]
+
+
+def test_segment_round_trip(tmp_path):
+    path = str(tmp_path / "test.seg")
+    writer = SegmentWriter(path)
+    writer.add_term("apple", {"a": {"frequency": 2, "positions": [0, 3]}}, 4)
+    writer.add_term("pear", {"a": {"frequency": 1, "positions": [1]}}, 4)
+    writer.add_document(_entry("a", "apple pear x apple"))
+    writer.finish()
+
+    segment = Segment(path)
+    assert (segment.document_count, segment.total_length, segment.term_count) == (
+        1,
+        4,
+        2,
+    )
+    assert segment.term_header("apple") == {
+        "term": "apple",
+        "df": 1,
+        "max_tf": 2,
+        "min_doc_length": 4,
+    }
+    assert segment.term_header("banana") is None
+    assert segment.metadata("a")["metadata"] == {"url": "https://example.com/a"}
+    assert segment.forward_terms("a")["apple"]["positions"] == [0, 3]
+    assert "b" not in segment
+    segment.close()
+
+
+def test_local_storage(tmp_path):
+    storage = LocalStorage(str(tmp_path), merges="off")
+    storage.write_documents({}, [_entry("a", "red apple"), _entry("b", "green apple")])
+    storage.flush()
+    storage.write_documents({}, [_entry("a", "red pear")], ["b"])
+
+    assert storage.load_term_headers(["apple", "pear", "red"]) == {
+        "pear": {"term": "pear", "df": 1, "max_tf": 1, "min_doc_length": 2},
+        "red": {"term": "red", "df": 1, "max_tf": 1, "min_doc_length": 2},
+    }
+    assert dict(storage.iter_postings("red")) == {
+        "a": {"frequency": 1, "positions": [0]}
+    }
+    assert set(storage.load_forward_entries(["a", "b"])) == {"a"}
+    assert storage.read_doc_stats()["docCount"] == 1
+    storage.close()
+
+    # Reopening replays the log over the segments and their tombstones
+    storage = LocalStorage(str(tmp_path), merges="off")
+    assert set(storage.load_postings(["pear", "apple"])) == {"pear"}
+    assert storage.reconcile_doc_stats()["drift"] == {"docCount": 0, "totalLength": 0}
+    storage.flush()
+    assert len(storage.storage_stats()["segments"]) == 2
+    assert storage.compact()["segments_merged"] == 2
+    assert storage.storage_stats()["segments"] == [
+        {
+            "name": "seg_000002",
+            "documents": 1,
+            "deleted": 0,
+            "bytes": ANY,
+            "merging": False,
+        }
+    ]
+    assert os.path.getsize(tmp_path / WRITE_AHEAD_LOG) == 0
+    assert storage.load_metadata_entries(["a"])["a"]["total_terms"] == 2
+    storage.close()
+
+
+def test_local_storage_streams_postings_from_a_cursor(tmp_path):
+    storage = LocalStorage(str(tmp_path), merges="off")
+    storage.write_documents({}, [_entry("c", "apple"), _entry("a", "apple pie")])
+    storage.flush()
+    storage.write_documents({}, [_entry("b", "an apple")])
+    storage.flush()
+    storage.write_documents({}, [_entry("d", "apple apple"), _entry("a", "apple")])
+
+    postings = storage.iter_postings("apple")
+    assert iter(postings) is postings
+    assert [document_id for document_id, _ in postings] == ["a", "b", "c", "d"]
+    assert list(storage.iter_postings("apple", after="b", positions=False)) == [
+        ("c", {"frequency": 1}),
+        ("d", {"frequency": 2}),
+    ]
+    assert list(storage.iter_postings("apple", after="c"))[0][1]["positions"] == [
+        0,
+        1,
+    ]
+    storage.close()
+
+
+def test_local_storage_tiered_merges(tmp_path, monkeypatch):
+    monkeypatch.setattr("app.storage.SEGMENT_MERGE_FACTOR", 3)
+    storage = LocalStorage(str(tmp_path), merges="off")
+    for number in range(9):
+        storage.write_documents({}, [_entry(f"d{number}", f"apple word{number}")])
+        storage.flush()
+
+    merges = 0
+    while storage.merge_once():
+        merges += 1
+    # Three merges of three single-document segments, then one of their results
+    assert merges == 4
+    assert [
+        segment["documents"] for segment in storage.storage_stats()["segments"]
+    ] == [9]
+
+    # A segment that lost most of its documents is rewritten on its own
+    storage.write_documents({}, [], [f"d{number}" for number in range(5)])
+    assert storage.merge_once()
+    assert storage.storage_stats()["merges"] == {"tiered": 4, "expunge": 1}
+    assert storage.load_term_headers(["apple"])["apple"]["df"] == 4
+    assert sorted(storage.load_postings(["apple"])["apple"]) == [
+        f"d{number}" for number in range(5, 9)
+    ]
+    assert len([name for name in os.listdir(tmp_path) if name.endswith(".seg")]) == 1
+    storage.close()
+
+
+def test_local_storage_snapshot(tmp_path):
+    storage = LocalStorage(str(tmp_path), merges="off")
+    storage.write_documents({}, [_entry("a", "red apple"), _entry("b", "green apple")])
+    snapshot = storage.create_snapshot()
+    storage.write_documents({}, [_entry("c", "blue apple")], ["a"])
+    storage.compact()
+
+    view = storage.open_snapshot(snapshot["name"])
+    assert sorted(view.load_postings(["apple"])["apple"]) == ["a", "b"]
+    assert view.read_doc_stats()["docCount"] == 2
+    view.close()
+    assert sorted(storage.load_postings(["apple"])["apple"]) == ["b", "c"]
+
+    assert [listed["name"] for listed in storage.list_snapshots()] == [snapshot["name"]]
+    storage.release_snapshot(snapshot["name"])
+    assert len([name for name in os.listdir(tmp_path) if name.endswith(".seg")]) == 1
+    storage.close()
+
+
+def test_local_storage_discards_torn_write(tmp_path):
+    storage = LocalStorage(str(tmp_path))
+    storage.write_documents({}, [_entry("a", "red apple")])
+    storage.close()
+    with open(tmp_path / WRITE_AHEAD_LOG, "ab") as wal:
+        wal.write(b"\x40\x00\x00\x00partial")
+
+    storage = LocalStorage(str(tmp_path))
+    assert set(storage.load_forward_entries(["a"])) == {"a"}
+    storage.close()
+
+
+def test_local_document_source(tmp_path):
+    with open(tmp_path / SOURCE_DOCUMENTS, "w") as source:
+        source.write(json.dumps({"_id": "a", "text": "Some text", "type": "txt"}))
+        source.write("\n")
+    storage = LocalStorage(str(tmp_path))
+    content, metadata = storage.fetch_documents(["a", "missing"])["a"]
+    assert content == "Some text"
+    assert metadata["text_length"] == 2
+    storage.close()
@@ -0,0 +1,110 @@
+# tests/test_terms.py
+import itertools
+
+from app.fuzzy import TrigramIndex, edit_distance
+from app.query import expand_wildcards, parse_query
+from app.storage import LocalStorage
+from app.terms import TermDictionary
+from tests.test_storage import _entry
+
+
+def _dictionary():
+    dictionary = TermDictionary()
+    dictionary.load(
+        [("apple", 5), ("applet", 1), ("apply", 3), ("banana", 2), ("grape", 4)]
+    )
+    return dictionary
+
+
+def test_expand_patterns():
+    dictionary = _dictionary()
+    assert dictionary.expand("app*")[0] == ["apple", "applet", "apply"]
+    terms, cost = dictionary.expand("*e")
+    assert terms == ["apple", "grape"]
+    assert cost["scanned"] == 2 and cost["postings"] == 9
+    assert dictionary.expand("*an*")[0] == ["banana"]
+    assert dictionary.expand("a*e*")[0] == ["apple", "applet"]
+
+    # Capped expansions keep the most frequent terms and say so
+    terms, cost = dictionary.expand("a*", max_terms=2)
+    assert terms == ["apple", "apply"] and cost["truncated"]
+    assert dictionary.expand("*p*", max_scan=2)[1]["truncated"]
+
+
+def test_complete_and_incremental_changes():
+    dictionary = _dictionary()
+    assert dictionary.complete("app", 2)[0] == [
+        {"term": "apple", "df": 5},
+        {"term": "apply", "df": 3},
+    ]
+    dictionary.apply_changes(
+        {
+            "appendix": {"set": {}, "new": {"d1", "d2"}, "unset": set()},
+            "applet": {"set": {}, "new": set(), "unset": {"d3"}},
+        }
+    )
+    assert dictionary.expand("app*")[0] == ["appendix", "apple", "apply"]
+    assert dictionary.expand("*xidn*")[0] == []
+    assert dictionary.df("appendix") == 2 and dictionary.df("applet") == 0
+
+
+def test_fuzzy_lookup():
+    assert edit_distance("kitten", "sitting", 3) == 3
+    assert edit_distance("kitten", "sitting", 1) == 2
+    dictionary = _dictionary()
+    candidates, cost = dictionary.fuzzy("appl")
+    # Within one edit for a four letter term, closest first, then by df
+    assert candidates == [
+        {"term": "apple", "distance": 1, "df": 5},
+        {"term": "apply", "distance": 1, "df": 3},
+    ]
+    assert cost["max_distance"] == 1 and not cost["truncated"]
+    assert dictionary.fuzzy("bananna")[0] == [
+        {"term": "banana", "distance": 1, "df": 2}
+    ]
+    assert dictionary.fuzzy("ap")[0] == []
+
+    # The trigram index follows the dictionary's changes
+    dictionary.apply_changes(
+        {
+            "grape": {"set": {}, "new": set(), "unset": {"d1", "d2", "d3", "d4"}},
+            "grapes": {"set": {}, "new": {"d1"}, "unset": set()},
+        }
+    )
+    assert [found["term"] for found in dictionary.fuzzy("grapse")[0]] == ["grapes"]
+
+
+def test_trigram_index_matches_every_term_within_distance():
+    words = ["".join(letters) for letters in itertools.product("abc", repeat=4)]
+    index = TrigramIndex()
+    index.load(words)
+    for query in ("abca", "cccc", "bab"):
+        for distance in (1, 2):
+            matched = index.matches(query, distance)[0]
+            assert matched == {
+                word: edit_distance(query, word, distance)
+                for word in words
+                if edit_distance(query, word, distance) <= distance
+            }
+
+
+def test_query_wildcards():
+    tree = parse_query("App* AND NOT gr*pe")
+    assert tree == ("and", [("wildcard", "app*"), ("not", ("wildcard", "gr*pe"))])
+    dictionary = _dictionary()
+    assert expand_wildcards(tree, lambda pattern: dictionary.expand(pattern)[0]) == (
+        "and",
+        [
+            ("or", [("term", "apple"), ("term", "applet"), ("term", "apply")]),
+            ("not", ("term", "grape")),
+        ],
+    )
+
+
+def test_local_term_frequencies(tmp_path):
+    storage = LocalStorage(str(tmp_path), merges="off")
+    storage.write_documents({}, [_entry("a", "red apple"), _entry("b", "green apple")])
+    storage.flush()
+    storage.write_documents({}, [_entry("c", "red pear")], ["b"])
+    assert dict(storage.iter_term_frequencies()) == {"apple": 1, "red": 2, "pear": 1}
+    storage.close()